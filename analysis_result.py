@@ -0,0 +1,162 @@
+import io
+import json
+
+import numpy as np
+
+from analytics import EMOTION_LABELS, as_score_array
+
+# Per-segment flag bits
+FLAG_DRIFT = 1  # inside at least one drift
+FLAG_CONFUSION = 2
+
+# Bump when the npz layout changes; from_bytes() refuses other versions
+FORMAT_VERSION = 1
+
+def _pack_strings(strings):
+    # One UTF-8 blob plus end offsets, so no object arrays (and no pickle) are needed
+    encoded = [s.encode("utf-8") for s in strings]
+    ends = np.cumsum([len(b) for b in encoded], dtype=np.int64) if encoded else np.zeros(0, dtype=np.int64)
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), ends
+
+def _unpack_strings(blob, ends):
+    data = blob.tobytes()
+    starts = np.concatenate(([0], ends[:-1])) if len(ends) else ends
+    return [data[start:end].decode("utf-8") for start, end in zip(starts.tolist(), ends.tolist())]
+
+class AnalysisResult:
+    # Result of one analysis (run_pipeline, AnalysisSession), array-backed:
+    #   scores       N x 7 float32, in EMOTION_LABELS order
+    #   drifts       D x 2 int32 [start, end) segment ranges
+    #   confusions   C int32 segment indices
+    #   explanations D + C strings: one per drift, then one per confusion
+    #   flags        N uint8 bitmask of FLAG_DRIFT / FLAG_CONFUSION
+    # plus a CSR index from each segment to the drifts covering it, so every
+    # per-segment lookup is O(1) (plus the number of drifts it is in).
+    #
+    # Unpacks like the (chunks, emotion_vectors, drifts, confusions,
+    # explanations) tuple run_pipeline used to return, with explanations as
+    # the old {"drift_3_7": ..., "confusion_5": ...} dict.
+
+    def __init__(self, chunks, scores, drifts, confusions, explanations):
+        self.chunks = list(chunks)
+        self.scores = as_score_array(scores)
+        self.drifts = np.asarray(drifts, dtype=np.int32).reshape(-1, 2)
+        self.confusions = np.asarray(confusions, dtype=np.int32).reshape(-1)
+        self.explanations = list(explanations.values()) if isinstance(explanations, dict) else list(explanations)
+        if len(self.explanations) != len(self.drifts) + len(self.confusions):
+            raise ValueError(f"Expected {len(self.drifts) + len(self.confusions)} explanations "
+                             f"(one per drift and confusion), got {len(self.explanations)}")
+        self._build_index()
+
+    def _build_index(self):
+        n = self.n_segments
+        starts = np.clip(self.drifts[:, 0], 0, n).astype(np.int64)
+        ends = np.clip(self.drifts[:, 1], 0, n).astype(np.int64)
+        lengths = np.maximum(ends - starts, 0)
+        total = int(lengths.sum())
+        # Every (segment, drift) pair, grouped by segment
+        drift_ids = np.repeat(np.arange(len(self.drifts), dtype=np.int32), lengths)
+        offsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        segments = np.repeat(starts, lengths) + offsets
+        order = np.argsort(segments, kind="stable")
+        self.drift_indices = drift_ids[order]
+        per_segment = np.bincount(segments, minlength=n)[:n] if total else np.zeros(n, dtype=np.int64)
+        self.drift_indptr = np.concatenate(([0], np.cumsum(per_segment))).astype(np.int64)
+
+        self.flags = np.zeros(n, dtype=np.uint8)
+        self.flags[per_segment > 0] |= FLAG_DRIFT
+        confusions = self.confusions[(self.confusions >= 0) & (self.confusions < n)]
+        self.flags[confusions] |= FLAG_CONFUSION
+        # Explanation of each segment's confusion, -1 if it is not one
+        self.confusion_explanation = np.full(n, -1, dtype=np.int32)
+        self.confusion_explanation[confusions] = len(self.drifts) + np.flatnonzero(
+            (self.confusions >= 0) & (self.confusions < n))
+
+    @property
+    def n_segments(self):
+        return len(self.chunks)
+
+    @property
+    def emotion_vectors(self):
+        return self.scores.tolist()
+
+    @property
+    def flagged(self):
+        return self.flags != 0
+
+    def flagged_segments(self):
+        return np.flatnonzero(self.flags).tolist()
+
+    def is_flagged(self, idx):
+        return bool(self.flags[idx])
+
+    def segment_drifts(self, idx):
+        # Indices into self.drifts of the drifts covering segment idx
+        return self.drift_indices[self.drift_indptr[idx]:self.drift_indptr[idx + 1]].tolist()
+
+    def segment_explanations(self, idx):
+        explanation_ids = self.segment_drifts(idx)
+        if self.confusion_explanation[idx] >= 0:
+            explanation_ids.append(int(self.confusion_explanation[idx]))
+        return [self.explanations[i] for i in explanation_ids]
+
+    def drift_list(self):
+        return [tuple(drift) for drift in self.drifts.tolist()]
+
+    def explanation_dict(self):
+        # The old string-keyed form
+        keys = [f"drift_{start}_{end}" for start, end in self.drifts.tolist()]
+        keys += [f"confusion_{idx}" for idx in self.confusions.tolist()]
+        return dict(zip(keys, self.explanations))
+
+    def __iter__(self):
+        return iter((self.chunks, self.emotion_vectors, self.drift_list(), self.confusions.tolist(),
+                     self.explanation_dict()))
+
+    def to_dict(self, include_chunks=False):
+        # JSON-friendly
+        result = {
+            "n_chunks": self.n_segments,
+            "emotion_labels": EMOTION_LABELS,
+            "emotion_vectors": self.emotion_vectors,
+            "drifts": self.drifts.tolist(),
+            "confusions": self.confusions.tolist(),
+            "explanations": self.explanation_dict(),
+        }
+        if include_chunks:
+            result["chunks"] = self.chunks
+        return result
+
+    def save(self, file):
+        # Compressed .npz; file is a path or a binary file object
+        chunk_blob, chunk_ends = _pack_strings(self.chunks)
+        explanation_blob, explanation_ends = _pack_strings(self.explanations)
+        np.savez_compressed(
+            file,
+            format_version=np.int32(FORMAT_VERSION),
+            emotion_labels=np.frombuffer(json.dumps(EMOTION_LABELS).encode("utf-8"), dtype=np.uint8),
+            chunk_blob=chunk_blob, chunk_ends=chunk_ends,
+            scores=self.scores, drifts=self.drifts, confusions=self.confusions,
+            explanation_blob=explanation_blob, explanation_ends=explanation_ends,
+        )
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file, allow_pickle=False) as data:
+            version = int(data["format_version"])
+            if version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported AnalysisResult format version {version}")
+            labels = json.loads(data["emotion_labels"].tobytes().decode("utf-8"))
+            if labels != EMOTION_LABELS:
+                raise ValueError(f"Saved with emotion labels {labels}, expected {EMOTION_LABELS}")
+            return cls(_unpack_strings(data["chunk_blob"], data["chunk_ends"]), data["scores"], data["drifts"],
+                       data["confusions"], _unpack_strings(data["explanation_blob"], data["explanation_ends"]))
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        self.save(buffer)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.load(io.BytesIO(data))
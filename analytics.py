@@ -0,0 +1,93 @@
+import numpy as np
+
+# Our user-facing labels, in the order used by every emotion vector
+EMOTION_LABELS = ["Inspirational", "Informative", "Neutral", "Empathetic", "Assertive", "Aggressive", "Defensive"]
+
+def as_score_array(emotion_vectors):
+    # N x 7 float32 array; accepts lists of lists or an existing array
+    return np.asarray(emotion_vectors, dtype=np.float32).reshape(-1, len(EMOTION_LABELS))
+
+def entropy(scores):
+    # Shannon entropy of every row after normalizing it to sum to 1
+    p = scores / (scores.sum(axis=1, keepdims=True) + 1e-9)
+    return -(p * np.log(p + 1e-9)).sum(axis=1)
+
+def lttb_indices(y, n_out):
+    # Largest-Triangle-Three-Buckets downsampling of a series plotted against
+    # its index: picks n_out indices (always the first and last) that keep the
+    # peaks and dips a line chart would show
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # n_out - 2 buckets between the first and last point; the extra edge makes
+    # the last point the "next bucket" of the final one
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype(np.int64), n)
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi, next_hi = edges[i], edges[i + 1], edges[i + 2]
+        avg_x = (hi + next_hi - 1) / 2
+        avg_y = y[hi:next_hi].mean()
+        xs = np.arange(lo, hi)
+        area = np.abs((a - avg_x) * (y[lo:hi] - y[a]) - (a - xs) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+class EmotionAnalytics:
+    # Every summary statistic the pipeline and the analyzer page need,
+    # computed once and vectorized over all segments
+
+    def __init__(self, emotion_vectors, target_emotion=None, confusion_threshold=0.75, top_k=3):
+        scores = as_score_array(emotion_vectors)
+        self.scores = scores
+        self.n_segments = len(scores)
+
+        # Per segment
+        self.entropy = entropy(scores)
+        self.confusion_mask = self.entropy > confusion_threshold
+        self.dominant_idx = scores.argmax(axis=1)
+        self.dominant_intensity = scores.max(axis=1)
+        # Stable, so ties keep label order like the sorted() calls this replaces
+        self.top_k_idx = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+
+        # Per label
+        if self.n_segments:
+            self.mean = scores.mean(axis=0)
+            self.variance = scores.var(axis=0)
+        else:
+            self.mean = np.zeros(len(EMOTION_LABELS), dtype=np.float32)
+            self.variance = np.zeros(len(EMOTION_LABELS), dtype=np.float32)
+        self.consistency_score = max(0.0, 100 - float(self.variance.mean()) * 1000)
+        self.overall_dominant_idx = int(self.mean.argmax())
+
+        # Against the target emotion, when one is set
+        self.target_emotion = target_emotion if target_emotion in EMOTION_LABELS else None
+        if self.target_emotion is not None:
+            self.target_idx = EMOTION_LABELS.index(self.target_emotion)
+            self.target_score = float(self.mean[self.target_idx])
+            self.target_match_mask = self.dominant_idx == self.target_idx
+        else:
+            self.target_idx = None
+            self.target_score = None
+            self.target_match_mask = np.ones(self.n_segments, dtype=bool)
+
+    @property
+    def confusions(self):
+        return np.flatnonzero(self.confusion_mask).tolist()
+
+    @property
+    def mismatches(self):
+        return np.flatnonzero(~self.target_match_mask).tolist()
+
+    @property
+    def overall_dominant(self):
+        return EMOTION_LABELS[self.overall_dominant_idx]
+
+    def dominant_label(self, idx):
+        return EMOTION_LABELS[self.dominant_idx[idx]]
+
+    def top_k(self, idx):
+        return [(EMOTION_LABELS[i], float(self.scores[idx, i])) for i in self.top_k_idx[idx]]
@@ -1,7 +1,24 @@
 import streamlit as st
-import plotly.graph_objects as go
-from ml_pipeline import run_pipeline, regenerate_text
+# Cheap to import: torch, transformers, spaCy and plotly are loaded on first use
+from ml_pipeline import (
+    MODELS,
+    analyze_granularity,
+    cached_rewrites,
+    get_result_cache,
+    iter_regenerate_text,
+    regenerate_texts,
+    result_at,
+    score_sentences,
+)
+from session import AnalysisSession
+from analytics import EMOTION_LABELS, EmotionAnalytics, lttb_indices
+from instrumentation import start_metrics_server
+from warmup import is_ready, start_warmup
+import functools
 import os
+import threading
+
+import numpy as np
 
 # Page Configuration
 st.set_page_config(
@@ -26,9 +43,23 @@ if 'page' not in st.session_state:
 if 'recommendations' not in st.session_state:
     st.session_state.recommendations = {}
 
+# Prometheus metrics on EDD_METRICS_PORT, when set
+start_metrics_server()
+
+# Keeps the previous analysis so re-analyzing an edited text only redoes the edited part
+if 'analysis_session' not in st.session_state:
+    st.session_state.analysis_session = AnalysisSession()
+
+# Memo keys of this session's analyses, so it can forget them without touching other sessions'
+if 'result_keys' not in st.session_state:
+    st.session_state.result_keys = set()
+
 def show_landing_page():
     """Display the landing page with marketing content"""
     
+    # Load the models while the visitor reads, so the analyzer is ready when they get there
+    start_warmup()
+    
     # Hero Section
     st.markdown("""
         <div style='text-align: center; padding: 3rem 0 2rem 0;'>
@@ -174,11 +205,172 @@ def show_landing_page():
         </div>
     """, unsafe_allow_html=True)
 
+TIMELINE_COLORS = ['#DE638A', '#4A3267', '#C6BADE', '#F7B9C4', '#F3D9E5', '#8B5A8E', '#6B4668']
+# Above this many segments the timeline is drawn with WebGL and without markers
+TIMELINE_WEBGL_POINTS = int(os.environ.get("EDD_TIMELINE_WEBGL_POINTS", 300))
+# Points per emotion line; longer timelines are downsampled (LTTB) to this
+TIMELINE_MAX_POINTS = int(os.environ.get("EDD_TIMELINE_MAX_POINTS", 1500))
+SEGMENTS_PER_PAGE = int(os.environ.get("EDD_SEGMENTS_PER_PAGE", 25))
+# "segment" is the analysis itself; the others are built from sentence scores
+GRANULARITY_OPTIONS = {"segment": "Model segments", "sentence": "Sentences", "paragraph": "Paragraphs",
+                       "window": "Sliding window"}
+# Widget keys that belong to one analysis and are reset by the next
+ANALYSIS_VIEW_KEYS = ("timeline_range", "segment_filter_flagged", "segment_filter_emotions", "journey_page",
+                      "breakdown_page", "flagged_page", "recommendations_page")
+
+def build_timeline_figure(emotion_vectors, labels, offset=0):
+    """Line chart of every emotion's intensity across the segments (numbered from offset)"""
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    colors = TIMELINE_COLORS
+    scores = np.asarray(emotion_vectors, dtype=np.float32).reshape(-1, len(labels))
+    webgl = len(scores) > TIMELINE_WEBGL_POINTS
+    scatter = go.Scattergl if webgl else go.Scatter
+    
+    for i, label in enumerate(labels):
+        # Each line keeps its own peaks, so each is downsampled separately
+        points = lttb_indices(scores[:, i], TIMELINE_MAX_POINTS)
+        fig.add_trace(scatter(
+            x=(points + offset).tolist(),
+            y=scores[points, i].tolist(),
+            mode='lines' if webgl else 'lines+markers',
+            name=label,
+            line=dict(width=2 if webgl else 3, color=colors[i % len(colors)]),
+            marker=dict(size=8)
+        ))
+    
+    fig.update_layout(
+        title={
+            'text': "Emotional Tone Across Content Segments",
+            'x': 0.5,
+            'xanchor': 'center',
+            'font': {'size': 20, 'color': '#4A3267', 'family': 'Inter'}
+        },
+        xaxis_title="Content Segment",
+        yaxis_title="Emotional Intensity",
+        hovermode='x unified',
+        plot_bgcolor='rgba(255, 255, 255, 0.5)',
+        paper_bgcolor='rgba(255, 255, 255, 0)',
+        font=dict(family='Inter', color='#4A3267'),
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        ),
+        height=500
+    )
+    return fig
+
+def stream_analysis(events, labels):
+    """Draw the timeline and segment list while the analysis is still running; returns the final results"""
+    status_placeholder = st.empty()
+    progress_bar = st.progress(0.0)
+    chart_placeholder = st.empty()
+    segments_placeholder = st.empty()
+    
+    chunks = []
+    emotion_vectors = []
+    segment_lines = []
+    results = None
+    try:
+        for event in events:
+            if event[0] == "chunks":
+                chunks = event[1]
+                status_placeholder.markdown(f"🧠 Analyzing **{len(chunks)}** segments...")
+            elif event[0] == "scores":
+                _, start, vectors, _ = event
+                emotion_vectors.extend(vectors)
+                for idx, vec in enumerate(vectors, start=start):
+                    dominant = labels[vec.index(max(vec))]
+                    segment_lines.append(f"**Segment {idx+1}**: {dominant} - {chunks[idx][:60]}...")
+                progress_bar.progress(len(emotion_vectors) / max(len(chunks), 1))
+                if len(emotion_vectors) < len(chunks):
+                    status_placeholder.markdown(f"🧠 Analyzed **{len(emotion_vectors)}** of **{len(chunks)}** segments...")
+                else:
+                    status_placeholder.markdown("🌊 Detecting tone drifts and confusion points...")
+                chart_placeholder.plotly_chart(build_timeline_figure(emotion_vectors, labels), use_container_width=True,
+                                               key=f"live_timeline_{len(emotion_vectors)}")
+                # Newest segments first so progress stays visible without scrolling
+                segments_placeholder.markdown("\n\n".join(reversed(segment_lines[-20:])))
+            elif event[0] == "result":
+                results = event[1]
+    finally:
+        status_placeholder.empty()
+        progress_bar.empty()
+        chart_placeholder.empty()
+        segments_placeholder.empty()
+    return results
+
+def cancel_rewrite():
+    """Stop the rewrite that is still generating, if any (new analysis, new rewrite, leaving the page)"""
+    cancel_event = st.session_state.get('rewrite_cancel')
+    if cancel_event is not None:
+        cancel_event.set()
+
+def stream_rewrite(chunk, target_emotion, rec_key):
+    """Show a rewrite word by word as it is generated and keep it in the recommendations; None if it failed"""
+    cancel_rewrite()
+    cancel_event = st.session_state.rewrite_cancel = threading.Event()
+    placeholder = st.empty()
+    placeholder.caption("✍️ Rewriting...")
+    rewrite = ""
+    pieces = iter_regenerate_text(chunk, target_emotion, cancel_event=cancel_event)
+    try:
+        for piece in pieces:
+            rewrite += piece
+            placeholder.success(rewrite + " ▌")
+    finally:
+        # A rerun interrupts the loop; closing the generator stops the model
+        pieces.close()
+    rewrite = rewrite.strip()
+    if not rewrite:
+        # Nothing stored, so the button stays there for another try
+        placeholder.error("Couldn't generate a revision for this segment. Please try again.")
+        return None
+    placeholder.empty()
+    st.session_state.recommendations[rec_key] = rewrite
+    return rewrite
+
+def paginate(indices, key, noun="segments"):
+    """Page through a long list of segment indices; returns the ones on the current page"""
+    n_pages = max(1, -(-len(indices) // SEGMENTS_PER_PAGE))
+    if n_pages == 1:
+        return indices
+    # Filters can shrink the list under a page that no longer exists
+    if st.session_state.get(key, 1) > n_pages:
+        st.session_state[key] = n_pages
+    page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1, key=key)
+    first = (page - 1) * SEGMENTS_PER_PAGE
+    shown = indices[first:first + SEGMENTS_PER_PAGE]
+    st.caption(f"Showing {first + 1}-{first + len(shown)} of {len(indices)} {noun}")
+    return shown
+
+def granular_analysis(analysis_session, text, granularity, window=5):
+    """Results at another granularity; the sentences are scored once per analysis, every view after that is instant"""
+    key = analysis_session.result_key(text)
+    cached = st.session_state.get('granular_cache')
+    if cached is None or cached['key'] != key:
+        with st.spinner("🧠 Scoring individual sentences..."):
+            sentence_scores = score_sentences(text, max_tokens=analysis_session.max_tokens,
+                                              segmentation_mode=analysis_session.segmentation_mode)
+        cached = st.session_state.granular_cache = {'key': key, 'sentence_scores': sentence_scores, 'views': {}}
+    view = (granularity, window)
+    if view not in cached['views']:
+        cached['views'][view] = analyze_granularity(cached['sentence_scores'], granularity,
+                                                    max_tokens=analysis_session.max_tokens, window=window)
+    return cached['views'][view]
+
 def show_analyzer_page():
     """Display the analyzer page"""
     
+    # Also covers visitors who skip the landing page; does nothing if already started
+    start_warmup()
+    
     # Back button
     if st.button("← Back to Home", key="back_button"):
+        cancel_rewrite()
         st.session_state.page = 'landing'
         st.rerun()
     
@@ -219,21 +411,67 @@ def show_analyzer_page():
         col_btn1, col_btn2, col_btn3 = st.columns([2, 2, 2])
         with col_btn2:
             analyze_button = st.button("🔍 Analyze Content", use_container_width=True)
+        if not is_ready():
+            st.caption("⏳ Loading the emotion model in the background...")
 
-        if analyze_button:
+        # The last analysis stays on screen across reruns (moving the drift
+        # sensitivity slider, generating a rewrite); only the button starts a new one
+        if analyze_button or st.session_state.get('analysis_shown', False):
             if text_input and len(text_input.strip()) > 50:
                 # Labels for emotions
-                labels = ["Inspirational", "Informative", "Neutral", "Empathetic", "Assertive", "Aggressive", "Defensive"]
+                labels = EMOTION_LABELS
                 
                 # Show loading message
                 loading_placeholder = st.empty()
                 
                 with st.spinner("🧠 Processing your content with AI models..."):
                     try:
-                        # run_pipeline now returns 5 values (chunks, emotion_vectors, drifts, confusions, explanations)
-                        chunks, emotion_vectors, drifts, confusions, explanations = run_pipeline(text_input, target_emotion)
-                        # Clear old session data on new analysis
-                        st.session_state.recommendations = {}
+                        # Results stream in as batches finish; an AnalysisResult like run_pipeline's at the end
+                        analysis_session = st.session_state.analysis_session
+                        if analyze_button:
+                            cancel_rewrite()
+                            events = analysis_session.iter_update(text_input, target_emotion)
+                            result = stream_analysis(events, labels)
+                            st.session_state.result_keys.add(
+                                analysis_session.result_key(analysis_session.text, target_emotion))
+                            # Clear old session data on new analysis
+                            st.session_state.recommendations = {}
+                            st.session_state.analysis_shown = True
+                            # Raw text, since paragraph breaks do not survive cleaning
+                            st.session_state.analyzed_text = text_input
+                            for key in ANALYSIS_VIEW_KEYS:
+                                st.session_state.pop(key, None)
+                            st.session_state.pop('shown_granularity', None)
+                        else:
+                            result = analysis_session.results()
+                        
+                        # Other resolutions are aggregated from one scoring pass over the
+                        # sentences, and drift detection runs on whichever is shown
+                        granularity = st.radio("📏 Granularity", list(GRANULARITY_OPTIONS), key="granularity",
+                                               format_func=GRANULARITY_OPTIONS.get, horizontal=True)
+                        window = 5
+                        if granularity == "window":
+                            window = st.slider("Sentences per window", min_value=2, max_value=20, value=5,
+                                               key="granularity_window")
+                        drift_path, result_for_index = analysis_session.drift_path, analysis_session.results_at
+                        if granularity != "segment":
+                            result, drift_path = granular_analysis(
+                                analysis_session, st.session_state.get('analyzed_text', analysis_session.text),
+                                granularity, window)
+                            result_for_index = functools.partial(result_at, result.chunks, result.scores, drift_path)
+                        if st.session_state.get('shown_granularity') != (granularity, window):
+                            # New analysis or granularity: segment numbers mean something else
+                            # now, and rewrites come back from the rewrite cache
+                            st.session_state.recommendations = {}
+                            st.session_state.pop('timeline_range', None)
+                            st.session_state.drift_sensitivity = len(drift_path) - 1 - drift_path.default_index
+                            st.session_state.shown_granularity = (granularity, window)
+                        chunks, emotion_vectors = result.chunks, result.scores
+                        # Every summary statistic below, computed once
+                        analytics = EmotionAnalytics(emotion_vectors, target_emotion)
+                        # Rewrites generated earlier, in this or any other session, show up right away
+                        for idx, rewrite in cached_rewrites(chunks, target_emotion).items():
+                            st.session_state.recommendations.setdefault(f"rec_{idx}", rewrite)
                         
                         # Clear loading message
                         loading_placeholder.empty()
@@ -248,11 +486,8 @@ def show_analyzer_page():
                             st.markdown("## 🎯 Target Emotion Match")
                             
                             # Calculate match with target emotion
-                            avg_emotions = [sum(vec[i] for vec in emotion_vectors) / len(emotion_vectors) for i in range(len(labels))]
-                            target_idx = labels.index(target_emotion)
-                            target_score = avg_emotions[target_idx]
-                            overall_dominant_idx = avg_emotions.index(max(avg_emotions))
-                            overall_dominant = labels[overall_dominant_idx]
+                            target_score = analytics.target_score
+                            overall_dominant = analytics.overall_dominant
                             
                             # Calculate match percentage
                             match_percentage = target_score * 100
@@ -269,7 +504,7 @@ def show_analyzer_page():
                             else:
                                 match_status = "error"
                                 match_icon = "❌"
-                                match_message = f"**Low match.** Your content is predominantly **{overall_dominant}** ({max(avg_emotions):.1%}), not **{target_emotion}** ({match_percentage:.1f}%)."
+                                match_message = f"**Low match.** Your content is predominantly **{overall_dominant}** ({analytics.mean.max():.1%}), not **{target_emotion}** ({match_percentage:.1f}%)."
                             
                             # Display match result
                             if match_status == "success":
@@ -361,45 +596,38 @@ def show_analyzer_page():
                         st.markdown("---")
                         st.markdown("## 📊 Emotional Timeline")
                         
-                        # Timeline Visualization
-                        fig = go.Figure()
-                        colors = ['#DE638A', '#4A3267', '#C6BADE', '#F7B9C4', '#F3D9E5', '#8B5A8E', '#6B4668']
-                        
-                        for i, label in enumerate(labels):
-                            fig.add_trace(go.Scatter(
-                                x=list(range(len(chunks))),
-                                y=[vec[i] for vec in emotion_vectors],
-                                mode='lines+markers',
-                                name=label,
-                                line=dict(width=3, color=colors[i % len(colors)]),
-                                marker=dict(size=8)
-                            ))
-                        
-                        fig.update_layout(
-                            title={
-                                'text': "Emotional Tone Across Content Segments",
-                                'x': 0.5,
-                                'xanchor': 'center',
-                                'font': {'size': 20, 'color': '#4A3267', 'family': 'Inter'}
-                            },
-                            xaxis_title="Content Segment",
-                            yaxis_title="Emotional Intensity",
-                            hovermode='x unified',
-                            plot_bgcolor='rgba(255, 255, 255, 0.5)',
-                            paper_bgcolor='rgba(255, 255, 255, 0)',
-                            font=dict(family='Inter', color='#4A3267'),
-                            legend=dict(
-                                orientation="h",
-                                yanchor="bottom",
-                                y=1.02,
-                                xanchor="right",
-                                x=1
-                            ),
-                            height=500
-                        )
+                        # Timeline Visualization; long documents are downsampled, and
+                        # zooming in on a range brings back every segment in it
+                        lo, hi = 0, len(emotion_vectors)
+                        if len(emotion_vectors) > TIMELINE_MAX_POINTS:
+                            first, last = st.slider(
+                                "🔎 Zoom to segments",
+                                min_value=1,
+                                max_value=len(emotion_vectors),
+                                value=(1, len(emotion_vectors)),
+                                key="timeline_range",
+                                help=f"Ranges of up to {TIMELINE_MAX_POINTS} segments are drawn at full resolution"
+                            )
+                            lo, hi = first - 1, last
+                        fig = build_timeline_figure(emotion_vectors[lo:hi], labels, offset=lo)
                         
                         st.plotly_chart(fig, use_container_width=True)
                         
+                        # Drifts for every sensitivity were found with the analysis, so
+                        # moving the slider needs neither inference nor a re-fit
+                        if len(drift_path) > 1:
+                            # Highest penalty (fewest drifts) is sensitivity level 1
+                            drift_counts = drift_path.drift_counts()[::-1]
+                            sensitivity = st.select_slider(
+                                "🎚️ Drift sensitivity",
+                                options=list(range(len(drift_path))),
+                                format_func=lambda level: f"{level + 1} ({drift_counts[level]} drifts)",
+                                key="drift_sensitivity",
+                                help="Higher settings also flag smaller tone shifts"
+                            )
+                            result = result_for_index(len(drift_path) - 1 - sensitivity)
+                        drifts, confusions = result.drifts, result.confusions
+                        
                         # Statistics
                         st.markdown("---")
                         st.markdown("## 📈 Analysis Summary")
@@ -443,10 +671,9 @@ def show_analyzer_page():
                         # Emotional Journey
                         st.markdown("### 🎭 Emotional Journey")
                         journey_text = ""
-                        for idx, vec in enumerate(emotion_vectors):
-                            dominant_idx = vec.index(max(vec))
-                            dominant_emotion = labels[dominant_idx]
-                            intensity = max(vec)
+                        for idx in paginate(range(analytics.n_segments), "journey_page"):
+                            dominant_emotion = analytics.dominant_label(idx)
+                            intensity = analytics.dominant_intensity[idx]
                             
                             emoji_map = {
                                 "Inspirational": "✨",
@@ -470,14 +697,7 @@ def show_analyzer_page():
                         st.markdown("### 💡 Key Insights")
                         
                         # Calculate overall emotional consistency
-                        emotion_variances = []
-                        for i in range(len(labels)):
-                            values = [vec[i] for vec in emotion_vectors]
-                            variance = sum((x - sum(values)/len(values))**2 for x in values) / len(values)
-                            emotion_variances.append(variance)
-                        
-                        avg_variance = sum(emotion_variances) / len(emotion_variances)
-                        consistency_score = max(0, 100 - (avg_variance * 1000))
+                        consistency_score = analytics.consistency_score
                         
                         insights = []
                         
@@ -490,9 +710,8 @@ def show_analyzer_page():
                             insights.append("❌ **Low Emotional Consistency**: Significant emotional shifts may confuse your audience.")
                         
                         # Dominant emotion overall
-                        avg_emotions = [sum(vec[i] for vec in emotion_vectors) / len(emotion_vectors) for i in range(len(labels))]
-                        overall_dominant = labels[avg_emotions.index(max(avg_emotions))]
-                        insights.append(f"🎯 **Overall Tone**: Your content is predominantly **{overall_dominant}** ({max(avg_emotions):.1%} average intensity)")
+                        overall_dominant = analytics.overall_dominant
+                        insights.append(f"🎯 **Overall Tone**: Your content is predominantly **{overall_dominant}** ({analytics.mean.max():.1%} average intensity)")
                         
                         # Drift analysis
                         if len(drifts) > 0:
@@ -515,16 +734,31 @@ def show_analyzer_page():
                         st.markdown("---")
                         st.markdown("### 📊 Segment-by-Segment Breakdown")
                         
-                        for idx, (chunk, vec) in enumerate(zip(chunks, emotion_vectors)):
-                            dominant_idx = vec.index(max(vec))
-                            dominant_emotion = labels[dominant_idx]
+                        # One expander per segment does not scale to long documents:
+                        # filter, then show a page at a time
+                        filter_col1, filter_col2 = st.columns([1, 2])
+                        with filter_col1:
+                            flagged_only = st.checkbox("🚩 Flagged segments only", key="segment_filter_flagged")
+                        with filter_col2:
+                            emotion_filter = st.multiselect("Dominant emotion", labels, key="segment_filter_emotions",
+                                                            placeholder="Any dominant emotion")
+                        shown = np.ones(len(chunks), dtype=bool)
+                        if flagged_only:
+                            shown &= result.flagged
+                        if emotion_filter:
+                            shown &= np.isin(analytics.dominant_idx, [labels.index(label) for label in emotion_filter])
+                        shown_segments = np.flatnonzero(shown).tolist()
+                        if not shown_segments:
+                            st.info("No segments match these filters.")
+                        
+                        for idx in paginate(shown_segments, "breakdown_page"):
+                            chunk = chunks[idx]
+                            dominant_emotion = analytics.dominant_label(idx)
                             
                             # Get top 3 emotions
-                            emotion_scores = list(zip(labels, vec))
-                            emotion_scores.sort(key=lambda x: x[1], reverse=True)
-                            top_3 = emotion_scores[:3]
+                            top_3 = analytics.top_k(idx)
                             
-                            is_flagged = any(start <= idx < end for start, end in drifts) or idx in confusions
+                            is_flagged = result.is_flagged(idx)
                             border_color = "#DE638A" if is_flagged else "#C6BADE"
                             
                             with st.expander(f"{'🚩' if is_flagged else '✓'} Segment {idx+1}: {dominant_emotion} - {chunk[:60]}...", expanded=False):
@@ -538,9 +772,8 @@ def show_analyzer_page():
                                 
                                 # Show explanations and recommendations if flagged
                                 if is_flagged:
-                                    for key, exp in explanations.items():
-                                        if str(idx) in key:
-                                            st.warning(f"**⚠️ Issue Detected:** {exp}")
+                                    for exp in result.segment_explanations(idx):
+                                        st.warning(f"**⚠️ Issue Detected:** {exp}")
                                             
                                     # On-demand recommendation button
                                     if target_emotion and not target_emotion.startswith("None"):
@@ -550,37 +783,34 @@ def show_analyzer_page():
                                             st.success(st.session_state.recommendations[rec_key])
                                         else:
                                             if st.button(f"✨ Generate AI Recommendation", key=f"btn_{idx}"):
-                                                with st.spinner("Rewriting..."):
-                                                    suggestion = regenerate_text(chunk, target_emotion)
-                                                    st.session_state.recommendations[rec_key] = suggestion
-                                                    st.success(st.session_state.recommendations[rec_key])
+                                                st.markdown(f"**✨ Suggested Revision (to match {target_emotion}):**")
+                                                suggestion = stream_rewrite(chunk, target_emotion, rec_key)
+                                                if suggestion:
+                                                    st.success(suggestion)
                         
                         # Flagged Sections Summary
-                        if drifts or confusions:
+                        if len(drifts) or len(confusions):
                             st.markdown("---")
                             st.markdown("## 🚩 Flagged Sections")
                             st.markdown("*Click on any section below to view details and recommendations*")
                             
-                            for idx, chunk in enumerate(chunks):
-                                is_flagged = any(start <= idx < end for start, end in drifts) or idx in confusions
-                                
-                                if is_flagged:
-                                    with st.expander(f"📍 Segment {idx+1}: {chunk[:80]}{'...' if len(chunk) > 80 else ''}", expanded=False):
-                                        st.markdown(f"**Full Text:**")
-                                        st.info(chunk)
-                                        
-                                        # Show explanations and recommendations
-                                        for key, exp in explanations.items():
-                                            if str(idx) in key:
-                                                st.warning(f"**⚠️ Issue Detected:** {exp}")
-                                                
-                                        # Show recommendation if exists in session state
-                                        rec_key = f"rec_{idx}"
-                                        if rec_key in st.session_state.recommendations:
-                                            st.markdown(f"**✨ Suggested Revision (to match {target_emotion}):**")
-                                            st.success(st.session_state.recommendations[rec_key])
+                            for idx in paginate(result.flagged_segments(), "flagged_page", "flagged segments"):
+                                chunk = chunks[idx]
+                                with st.expander(f"📍 Segment {idx+1}: {chunk[:80]}{'...' if len(chunk) > 80 else ''}", expanded=False):
+                                    st.markdown(f"**Full Text:**")
+                                    st.info(chunk)
+                                    
+                                    # Show explanations and recommendations
+                                    for exp in result.segment_explanations(idx):
+                                        st.warning(f"**⚠️ Issue Detected:** {exp}")
+                                            
+                                    # Show recommendation if exists in session state
+                                    rec_key = f"rec_{idx}"
+                                    if rec_key in st.session_state.recommendations:
+                                        st.markdown(f"**✨ Suggested Revision (to match {target_emotion}):**")
+                                        st.success(st.session_state.recommendations[rec_key])
 
-                        if not drifts and not confusions:
+                        if not len(drifts) and not len(confusions):
                             st.markdown("---")
                             st.success("🎉 **Great news!** No significant issues detected in your content. Your emotional tone is consistent throughout!")
                         
@@ -616,18 +846,26 @@ def show_analyzer_page():
                         
                         # AI Regeneration Suggestions
                         if target_emotion and not target_emotion.startswith("None"):
-                            mismatches = []
-                            labels_list = ["Inspirational", "Informative", "Neutral", "Empathetic", "Assertive", "Aggressive", "Defensive"]
-                            for i, vec in enumerate(emotion_vectors):
-                                dominant_idx = vec.index(max(vec))
-                                dominant_emotion = labels_list[dominant_idx]
-                                if dominant_emotion != target_emotion:
-                                    mismatches.append(i)
+                            mismatches = analytics.mismatches
                             
                             if mismatches:
                                 with st.expander(f"✨ AI Tone Recommendations (to match {target_emotion})", expanded=True):
                                     st.markdown(f"The following segments don't quite match your target **{target_emotion}** tone. Click to see AI-generated improvements.")
-                                    for idx in mismatches:
+                                    pending = [idx for idx in mismatches if f"rec_{idx}" not in st.session_state.recommendations]
+                                    if len(pending) > 1:
+                                        if st.button(f"✨ Rewrite All {len(pending)} Segments", key="rewrite_all_btn"):
+                                            with st.spinner(f"Rewriting {len(pending)} segments..."):
+                                                # One batched generation pass instead of a click and a rerun per segment
+                                                rewrites = regenerate_texts([chunks[idx] for idx in pending], target_emotion)
+                                                for idx, rewrite in zip(pending, rewrites):
+                                                    if rewrite and rewrite.strip():
+                                                        st.session_state.recommendations[f"rec_{idx}"] = rewrite.strip()
+                                            failed = sum(1 for rewrite in rewrites if not (rewrite and rewrite.strip()))
+                                            if not failed:
+                                                st.rerun()
+                                            # The failed segments keep their buttons below
+                                            st.warning(f"{failed} of {len(pending)} rewrites failed. Generate them again below.")
+                                    for idx in paginate(mismatches, "recommendations_page"):
                                         chunk_preview = chunks[idx][:60] + "..."
                                         st.markdown(f"**Segment {idx+1}**: *\"{chunk_preview}\"*")
                                         rec_key = f"rec_{idx}"
@@ -635,13 +873,11 @@ def show_analyzer_page():
                                             st.success(st.session_state.recommendations[rec_key])
                                         else:
                                             if st.button(f"Generate Revision for Segment {idx+1}", key=f"suggest_btn_{idx}"):
-                                                with st.spinner("Rewriting..."):
-                                                    st.session_state.recommendations[rec_key] = regenerate_text(chunks[idx], target_emotion)
+                                                if stream_rewrite(chunks[idx], target_emotion, rec_key):
                                                     st.rerun()
                         
                         # General suggestions based on dominant emotion
-                        avg_emotions = [sum(vec[i] for vec in emotion_vectors) / len(emotion_vectors) for i in range(len(labels))]
-                        overall_dominant = labels[avg_emotions.index(max(avg_emotions))]
+                        overall_dominant = analytics.overall_dominant
                         
                         emotion_suggestions = {
                             "Inspirational": {
@@ -730,6 +966,38 @@ def show_analyzer_page():
                                 for tip in suggestion['tips']:
                                     st.markdown(f"• {tip}")
                         
+                        # Where the time went in the last analysis run
+                        trace = analysis_session.last_trace
+                        if trace is not None:
+                            with st.expander("⏱️ Performance", expanded=False):
+                                update = analysis_session.last_update
+                                st.markdown(f"**{trace.wall_s:.2f}s** wall, **{trace.cpu_s:.2f}s** CPU · "
+                                            f"{update.get('mode', 'full')} run, {update.get('rescored_chunks', 0)} segments scored, "
+                                            f"{update.get('reused_chunks', 0)} reused")
+                                st.dataframe(
+                                    [{"Stage": row["stage"], "Calls": row["calls"], "Wall (ms)": round(row["wall_ms"], 1),
+                                      "CPU (ms)": round(row["cpu_ms"], 1), "Share": f"{row['share']:.0%}"}
+                                     for row in trace.stage_rows()],
+                                    use_container_width=True, hide_index=True
+                                )
+                                counters = trace.as_dict()["counters"]
+                                lookups = counters.get("score_cache_hits", 0) + counters.get("score_cache_misses", 0)
+                                if lookups:
+                                    st.markdown(f"Score cache hit rate: **{counters.get('score_cache_hits', 0) / lookups:.0%}**")
+                                st.json({name: int(value) for name, value in counters.items()}, expanded=False)
+                                result_cache = get_result_cache()
+                                if result_cache is not None:
+                                    memo = result_cache.stats()
+                                    st.markdown(f"Analyses kept in memory: **{memo['items']}** "
+                                                f"(~{memo['bytes'] / 2**20:.1f} of {result_cache.max_bytes / 2**20:.0f} MB)")
+                                    if st.button("🧹 Forget my cached analyses", key="clear_result_cache"):
+                                        forgotten = sum(result_cache.evict(key) for key in st.session_state.result_keys)
+                                        st.session_state.result_keys.clear()
+                                        st.toast(f"Forgot {forgotten} cached analyses")
+                                resident = {name: s["bytes"] for name, s in MODELS.stats().items() if s["loaded"]}
+                                st.markdown("Models in memory: " + (", ".join(
+                                    f"**{name}** (~{size / 2**20:.0f} MB)" for name, size in resident.items()) or "none"))
+                        
                     except Exception as e:
                         st.error(f"❌ An error occurred during analysis: {str(e)}")
                         st.info("Please try again with different text or check your input.")
@@ -0,0 +1,232 @@
+"""Headless batch runner for the emotional drift pipeline.
+
+Analyze text files, directories of .txt/.md files, or a JSONL manifest of
+{"id", "text" | "path", "target_emotion"} records, and write one result per
+document as JSONL or Parquet:
+
+    python batch_analyze.py posts/ --output results.jsonl --workers 4
+    python batch_analyze.py --manifest corpus.jsonl --output results.parquet
+
+Every finished document is appended to the output (or, for Parquet, to a
+JSONL spool next to it) and its id to a .done checkpoint file, so re-running
+the same command after an interruption skips what is already done.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+TEXT_EXTENSIONS = (".txt", ".md")
+# Files above this size are analyzed in long-document mode (longdoc.py), which
+# never reads the whole file into memory
+LONG_DOCUMENT_BYTES = int(os.environ.get("EDD_LONG_DOCUMENT_BYTES", 16 * 1024 * 1024))
+
+def iter_documents(inputs, manifest=None):
+    # Yields (doc_id, path, text, target_emotion); exactly one of path/text is set
+    for pattern in inputs:
+        paths = sorted(glob.glob(pattern)) or [pattern]
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for name in sorted(files):
+                        if name.endswith(TEXT_EXTENSIONS):
+                            file_path = os.path.join(root, name)
+                            yield file_path, file_path, None, None
+            else:
+                yield path, path, None, None
+    if manifest:
+        with open(manifest, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                doc_id = str(record.get("id", f"{manifest}:{line_no}"))
+                yield doc_id, record.get("path"), record.get("text"), record.get("target_emotion")
+
+def _init_worker(threads_per_worker):
+    # Load the classifier once per worker process, not once per document
+    import torch
+    from ml_pipeline import get_emotion_classifier
+    if threads_per_worker:
+        torch.set_num_threads(threads_per_worker)
+    get_emotion_classifier()
+
+def analyze_long_document(doc_id, path, target_emotion, include_chunks=False):
+    from longdoc import analyze_long_document as analyze_file
+
+    start = time.perf_counter()
+    document = analyze_file(path)
+    try:
+        record = {
+            "id": doc_id,
+            "source": path,
+            "target_emotion": target_emotion,
+            "words": document.words,
+            "n_chunks": len(document),
+            "emotion_vectors": document.scores.tolist(),
+            "drifts": [list(drift) for drift in document.drifts],
+            "confusions": document.confusions,
+            "explanations": document.explanations,
+            "elapsed_s": time.perf_counter() - start,
+        }
+        if include_chunks:
+            record["chunks"] = list(document.iter_chunks())
+    finally:
+        document.cleanup()
+    return record
+
+def analyze_document(doc_id, path, text, target_emotion, include_chunks=False, long_document_bytes=LONG_DOCUMENT_BYTES):
+    from ml_pipeline import run_pipeline
+
+    if text is None and os.path.getsize(path) > long_document_bytes:
+        return analyze_long_document(doc_id, path, target_emotion, include_chunks)
+    start = time.perf_counter()
+    if text is None:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    result = run_pipeline(text, target_emotion)
+    record = {
+        "id": doc_id,
+        "source": path,
+        "target_emotion": target_emotion,
+        "words": len(text.split()),
+        "n_chunks": result.n_segments,
+        "emotion_vectors": result.emotion_vectors,
+        "drifts": result.drifts.tolist(),
+        "confusions": result.confusions.tolist(),
+        "explanations": result.explanation_dict(),
+        "elapsed_s": time.perf_counter() - start,
+    }
+    if include_chunks:
+        record["chunks"] = result.chunks
+    return record
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+def _append_line(f, line):
+    f.write(line + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def write_parquet(spool_path, output_path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet output needs pyarrow (pip install pyarrow); "
+                         f"results are kept in {spool_path}")
+    records = []
+    with open(spool_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            # Keys differ per document, so explanations are stored as JSON text
+            record["explanations"] = json.dumps(record["explanations"])
+            records.append(record)
+    pq.write_table(pa.Table.from_pylist(records), output_path)
+
+def run_batch(documents, output, workers=1, include_chunks=False, progress_every=10,
+              long_document_bytes=LONG_DOCUMENT_BYTES, index_path=None):
+    parquet = output.endswith(".parquet")
+    results_path = output + ".partial.jsonl" if parquet else output
+    checkpoint_path = output + ".done"
+    errors_path = output + ".errors.jsonl"
+
+    done = load_checkpoint(checkpoint_path)
+    pending = (doc for doc in documents if doc[0] not in done)
+    if done:
+        print(f"Resuming: skipping {len(done)} documents already done", file=sys.stderr)
+
+    index = None
+    if index_path:
+        from similarity_index import ArcIndex
+        # Written from this process only, so the workers never share the SQLite file
+        index = ArcIndex(index_path)
+
+    n_docs = n_words = n_errors = 0
+    start = time.perf_counter()
+
+    def report(final=False):
+        elapsed = time.perf_counter() - start
+        print(f"{'Done' if final else 'Progress'}: {n_docs} documents ({n_errors} failed), {n_words} words "
+              f"in {elapsed:.1f}s - {n_docs / elapsed if elapsed else 0:.2f} docs/s, "
+              f"{n_words / elapsed if elapsed else 0:,.0f} words/s", file=sys.stderr)
+
+    with open(results_path, "a", encoding="utf-8") as results_file, \
+            open(checkpoint_path, "a", encoding="utf-8") as checkpoint_file, \
+            open(errors_path, "a", encoding="utf-8") as errors_file:
+
+        def record_result(doc, future):
+            nonlocal n_docs, n_words, n_errors
+            n_docs += 1
+            try:
+                record = (future.result() if future is not None
+                          else analyze_document(*doc, include_chunks, long_document_bytes))
+            except Exception as e:
+                n_errors += 1
+                _append_line(errors_file, json.dumps({"id": doc[0], "source": doc[1], "error": repr(e)}))
+                return
+            n_words += record["words"]
+            # Result first, then the checkpoint, so a crash in between re-runs the
+            # document rather than losing it
+            _append_line(results_file, json.dumps(record))
+            if index is not None and record["n_chunks"]:
+                index.add(doc[0], record["emotion_vectors"],
+                          {"source": record["source"], "words": record["words"], "n_chunks": record["n_chunks"]})
+            _append_line(checkpoint_file, doc[0])
+            if n_docs % progress_every == 0:
+                report()
+
+        if workers <= 1:
+            _init_worker(None)
+            for doc in pending:
+                record_result(doc, None)
+        else:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(threads_per_worker,)) as pool:
+                # Keep a bounded number of documents in flight so texts from a
+                # huge manifest are not all held in memory at once
+                in_flight = {}
+                for doc in pending:
+                    in_flight[pool.submit(analyze_document, *doc, include_chunks, long_document_bytes)] = doc
+                    if len(in_flight) >= workers * 2:
+                        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            record_result(in_flight.pop(future), future)
+                for future in list(in_flight):
+                    record_result(in_flight.pop(future), future)
+
+    if parquet:
+        write_parquet(results_path, output)
+    report(final=True)
+    return n_docs, n_errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="*", help="text files, directories or glob patterns")
+    parser.add_argument("--manifest", help="JSONL manifest of {id, text|path, target_emotion} records")
+    parser.add_argument("--output", required=True, help="results file, .jsonl or .parquet")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each with its own classifier")
+    parser.add_argument("--include-chunks", action="store_true", help="also store the chunk texts")
+    parser.add_argument("--long-document-bytes", type=int, default=LONG_DOCUMENT_BYTES,
+                        help="analyze files larger than this in memory-bounded long-document mode")
+    parser.add_argument("--index", help="also add every document's emotional arc to this similarity index (SQLite)")
+    args = parser.parse_args()
+
+    if not args.inputs and not args.manifest:
+        parser.error("give input files or --manifest")
+
+    _, n_errors = run_batch(iter_documents(args.inputs, args.manifest), args.output,
+                            workers=args.workers, include_chunks=args.include_chunks,
+                            long_document_bytes=args.long_document_bytes, index_path=args.index)
+    sys.exit(1 if n_errors else 0)
+
+if __name__ == "__main__":
+    main()
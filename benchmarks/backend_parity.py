@@ -0,0 +1,107 @@
+"""Check every inference backend against the eager fp32 model.
+
+Scores a reference corpus with each backend, maps the results to our 7
+labels the same way the pipeline does, and compares the vectors with the
+eager ones. Exits non-zero when any backend drifts past the tolerance.
+
+    python benchmarks/backend_parity.py [--input FILE ...] [--backends int8 onnx] [--tolerance 0.05]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_backends import BACKENDS, load_text_classifier
+from ml_pipeline import EMOTION_LABELS, EMOTION_MODEL, _score_chunks
+from utils import chunk_by_tokens
+
+REFERENCE_TEXTS = [
+    "We did it! After three years of hard work the clinic finally opened its doors, and I could not be prouder of this team.",
+    "The quarterly report lists revenue, operating costs and headcount for each region, followed by a short methodology note.",
+    "I'm so sorry for your loss. There are no right words, but please know we are here for you whenever you need us.",
+    "This is unacceptable. You ignored every warning, wasted our money and now you expect us to clean up your mess?",
+    "We must be careful here. If the audit finds anything, we will need to explain every single decision we made.",
+    "Wait, what? The results came back completely different from anything we expected.",
+    "Honestly, the food was disgusting and the staff could not have cared less.",
+    "The meeting is scheduled for 10am on Tuesday in room 4B.",
+    "I'm terrified of what happens if the funding does not come through next month.",
+    "Every challenge is a chance to grow. Keep going, the breakthrough is closer than you think.",
+]
+
+def load_corpus(paths):
+    if not paths:
+        return list(REFERENCE_TEXTS)
+    texts = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            texts.append(f.read())
+    return texts
+
+def score_with_backend(backend, model_id, texts):
+    start = time.perf_counter()
+    classifier = load_text_classifier(model_id, backend)
+    load_time = time.perf_counter() - start
+
+    chunks, token_ids = [], []
+    for text in texts:
+        text_chunks, text_ids = chunk_by_tokens(text, classifier.tokenizer)
+        chunks.extend(text_chunks)
+        token_ids.extend(text_ids)
+
+    start = time.perf_counter()
+    vectors = _score_chunks(chunks, 16, token_ids, emotion_classifier=classifier)
+    score_time = time.perf_counter() - start
+    return np.asarray(vectors), {"load_s": load_time, "score_s": score_time,
+                                 "chunks_per_s": len(chunks) / score_time if score_time else None}
+
+def compare(vectors, reference):
+    diff = np.abs(vectors - reference)
+    return {
+        "max_abs_diff": float(diff.max()) if diff.size else 0.0,
+        "mean_abs_diff": float(diff.mean()) if diff.size else 0.0,
+        "dominant_agreement": float((vectors.argmax(axis=1) == reference.argmax(axis=1)).mean()) if diff.size else 1.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", nargs="*", help="reference text files (default: built-in sentences)")
+    parser.add_argument("--model", default=EMOTION_MODEL)
+    parser.add_argument("--backends", nargs="*", default=[b for b in BACKENDS if b != "eager"])
+    parser.add_argument("--tolerance", type=float, default=0.05, help="largest acceptable per-label difference")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.input)
+    reference, eager_timing = score_with_backend("eager", args.model, texts)
+    results = {"chunks": len(reference), "labels": EMOTION_LABELS, "backends": {"eager": eager_timing}}
+    failed = False
+    for backend in args.backends:
+        try:
+            vectors, timing = score_with_backend(backend, args.model, texts)
+        except ImportError as e:
+            print(f"Skipping {backend}: {e}", file=sys.stderr)
+            continue
+        timing.update(compare(vectors, reference))
+        timing["ok"] = timing["max_abs_diff"] <= args.tolerance
+        failed |= not timing["ok"]
+        results["backends"][backend] = timing
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['chunks']} chunks, tolerance {args.tolerance}")
+        for backend, r in results["backends"].items():
+            line = f"{backend:6s} load {r['load_s']:.2f}s  score {r['score_s']:.2f}s ({r['chunks_per_s']:.1f} chunks/s)"
+            if backend != "eager":
+                line += (f"  max diff {r['max_abs_diff']:.4f}  mean diff {r['mean_abs_diff']:.4f}  "
+                         f"dominant agreement {r['dominant_agreement']:.1%}  {'OK' if r['ok'] else 'FAIL'}")
+            print(line)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Measure import-time cost of the app's modules.
+
+Imports each module in a fresh interpreter with -X importtime and reports
+the wall time of the import, and the slowest modules it pulled in. Also
+times the first model load, which the app now does on a background thread.
+
+    python benchmarks/import_profile.py [--modules app ml_pipeline] [--top 10] [--json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ("utils", "ml_pipeline", "session", "service", "app")
+# Libraries that should never be imported just by importing our modules
+HEAVY_MODULES = ("torch", "transformers", "spacy", "sklearn", "plotly", "ruptures")
+
+_TIMED_IMPORT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print("RESULT", elapsed, ",".join(sorted(m for m in {heavy!r} if m in sys.modules)))
+"""
+
+_TIMED_LOAD = """
+import time
+start = time.perf_counter()
+import ml_pipeline
+ml_pipeline.get_emotion_classifier()
+print("RESULT", time.perf_counter() - start)
+"""
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package" lines
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append({"module": name.strip(), "self_ms": int(self_us) / 1000,
+                        "cumulative_ms": int(cumulative_us) / 1000})
+    return modules
+
+def profile_import(module, top=10):
+    code = _TIMED_IMPORT.format(module=module, heavy=HEAVY_MODULES)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_DIR, capture_output=True,
+                          text=True, env={**os.environ, "STREAMLIT_GLOBAL_SHOW_WARNING_ON_DIRECT_EXECUTION": "false"})
+    result_line = next((line for line in proc.stdout.splitlines() if line.startswith("RESULT")), None)
+    if result_line is None:
+        return {"module": module, "error": proc.stderr.strip().splitlines()[-1:] or ["no output"]}
+    _, seconds, heavy = (result_line.split(" ", 2) + [""])[:3]
+    modules = parse_importtime(proc.stderr)
+    return {
+        "module": module,
+        "import_s": float(seconds),
+        "heavy_modules_loaded": [m for m in heavy.split(",") if m],
+        "modules_imported": len(modules),
+        "slowest": sorted(modules, key=lambda m: -m["self_ms"])[:top],
+    }
+
+def profile_model_load():
+    proc = subprocess.run([sys.executable, "-c", _TIMED_LOAD], cwd=REPO_DIR, capture_output=True, text=True)
+    result_line = next((line for line in proc.stdout.splitlines() if line.startswith("RESULT")), None)
+    if result_line is None:
+        return {"error": proc.stderr.strip().splitlines()[-1:] or ["no output"]}
+    return {"import_and_load_s": float(result_line.split()[1])}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="*", default=list(DEFAULT_MODULES))
+    parser.add_argument("--top", type=int, default=10, help="slowest imported modules to list")
+    parser.add_argument("--skip-model", action="store_true", help="do not time the first model load")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = {"imports": [profile_import(module, args.top) for module in args.modules]}
+    if not args.skip_model:
+        results["model_load"] = profile_model_load()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results["imports"]:
+        if "error" in r:
+            print(f"{r['module']:12s} failed: {r['error']}")
+            continue
+        heavy = ", ".join(r["heavy_modules_loaded"]) or "none"
+        print(f"{r['module']:12s} {r['import_s']:7.3f}s  {r['modules_imported']:5d} modules  heavy: {heavy}")
+        for m in r["slowest"][:3]:
+            print(f"{'':14s}{m['module']:40s} {m['self_ms']:8.1f} ms self")
+    if "model_load" in results:
+        load = results["model_load"]
+        if "error" in load:
+            print(f"model load failed: {load['error']}")
+        else:
+            print(f"first model load (import + classifier): {load['import_and_load_s']:.2f}s")
+
+if __name__ == "__main__":
+    main()
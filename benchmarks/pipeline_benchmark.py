@@ -0,0 +1,201 @@
+"""Time every pipeline stage on synthetic documents of growing size.
+
+For each document size, runs preprocess_and_chunk, chunk_by_tokens,
+classify_emotions, detect_drift, detect_confusion, regenerate_text and the
+end-to-end run_pipeline separately, and records wall time, throughput and
+peak memory per stage. Results are written as JSON together with the git
+revision and library versions, so runs can be compared over time.
+
+    python benchmarks/pipeline_benchmark.py --standin --sizes 1000 10000 100000 1000000
+    python benchmarks/pipeline_benchmark.py --stages classify_emotions run_pipeline --output bench.json
+
+--standin builds small random models (benchmarks/standin_model.py) and uses
+them instead of the real ones, so the suite runs offline; their timings say
+nothing about the real models' speed, only about the code around them.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import generate_document
+
+STAGES = ("preprocess_and_chunk", "chunk_by_tokens", "classify_emotions", "detect_drift", "detect_confusion",
+          "regenerate_text", "run_pipeline")
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def _environment():
+    import numpy
+    import torch
+    import transformers
+    import ml_pipeline
+    return {
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "numpy": numpy.__version__,
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "emotion_model": ml_pipeline.EMOTION_MODEL,
+        "rewrite_model": ml_pipeline.REWRITE_MODEL,
+        "inference_backend": ml_pipeline.INFERENCE_BACKEND,
+        "drift_algorithm": ml_pipeline.DRIFT_ALGORITHM,
+    }
+
+def _max_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def measure(fn, repeat=1, trace_memory=True):
+    # Best wall time over repeat runs, then one more run under tracemalloc for
+    # the peak of Python-side allocations (NumPy included, torch tensors not;
+    # max_rss_mb is the process high-water mark, which covers those too)
+    times = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    record = {"seconds": min(times), "seconds_all": times}
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            record["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    record["max_rss_mb"] = _max_rss_mb()
+    return result, record
+
+def _rate(count, seconds):
+    return count / seconds if seconds else None
+
+def benchmark_size(n_words, stages, repeat=1, trace_memory=True, batch_size=16, max_tokens=256,
+                   rewrite_samples=3, seed=0):
+    import ml_pipeline
+    from utils import chunk_by_tokens, preprocess_and_chunk
+
+    text = generate_document(n_words, seed)
+    words = len(text.split())
+    tokenizer = ml_pipeline.get_emotion_classifier().tokenizer
+    results = {"words": words, "characters": len(text), "stages": {}}
+
+    def run(stage, fn, items=None, item_name=None, whole_document=True):
+        print(f"  {stage}...", file=sys.stderr, flush=True)
+        value, record = measure(fn, repeat, trace_memory)
+        record["words_per_s"] = _rate(words, record["seconds"]) if whole_document else None
+        if items is not None:
+            record[item_name] = items
+            record[f"{item_name}_per_s"] = _rate(items, record["seconds"])
+        results["stages"][stage] = record
+        return value
+
+    # Later stages need the chunks and scores, so these are computed even when
+    # their own stage is not being timed
+    if "preprocess_and_chunk" in stages:
+        run("preprocess_and_chunk", lambda: preprocess_and_chunk(text))
+    if "chunk_by_tokens" in stages:
+        chunks, token_ids = run("chunk_by_tokens", lambda: chunk_by_tokens(text, tokenizer, max_tokens=max_tokens))
+        results["stages"]["chunk_by_tokens"]["chunks"] = len(chunks)
+    else:
+        chunks, token_ids = chunk_by_tokens(text, tokenizer, max_tokens=max_tokens)
+    results["chunks"] = len(chunks)
+
+    if "classify_emotions" in stages:
+        emotion_vectors, _ = run("classify_emotions",
+                                 lambda: ml_pipeline.classify_emotions(chunks, batch_size=batch_size,
+                                                                       token_ids=token_ids, use_cache=False),
+                                 len(chunks), "chunks")
+    elif {"detect_drift", "detect_confusion"} & set(stages):
+        emotion_vectors, _ = ml_pipeline.classify_emotions(chunks, batch_size=batch_size, token_ids=token_ids,
+                                                           use_cache=False)
+    if "detect_drift" in stages:
+        run("detect_drift", lambda: ml_pipeline.detect_drift(emotion_vectors), len(emotion_vectors), "segments")
+    if "detect_confusion" in stages:
+        run("detect_confusion", lambda: ml_pipeline.detect_confusion(emotion_vectors), len(emotion_vectors),
+            "segments")
+    if "regenerate_text" in stages and chunks:
+        # Generation time depends on the chunk, not the document, so only a few are rewritten
+        sample = chunks[:rewrite_samples]
+        ml_pipeline.get_regenerator()
+        run("regenerate_text", lambda: [ml_pipeline.regenerate_text(chunk, "Empathetic") for chunk in sample],
+            len(sample), "chunks", whole_document=False)
+    if "run_pipeline" in stages:
+        run("run_pipeline", lambda: ml_pipeline.run_pipeline(text, batch_size=batch_size, max_tokens=max_tokens),
+            len(chunks), "chunks")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="*", default=list(DEFAULT_SIZES), help="document sizes in words")
+    parser.add_argument("--stages", nargs="*", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per stage; the best one is reported")
+    parser.add_argument("--no-memory", action="store_true", help="skip the extra tracemalloc run per stage")
+    parser.add_argument("--standin", action="store_true", help="use small local stand-in models (works offline)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--rewrite-samples", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.standin:
+        from standin_model import ensure_standin_models
+        os.environ["EDD_EMOTION_MODEL"], os.environ["EDD_REWRITE_MODEL"] = ensure_standin_models()
+    # Every run must reach the models, not the score or rewrite cache of a previous one
+    os.environ["EDD_SCORE_CACHE"] = "0"
+    os.environ["EDD_REWRITE_CACHE"] = "0"
+
+    import ml_pipeline
+    start = time.perf_counter()
+    ml_pipeline.get_emotion_classifier()
+    load_time = time.perf_counter() - start
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "environment": _environment(),
+        "settings": {"stages": args.stages, "repeat": args.repeat, "batch_size": args.batch_size,
+                     "max_tokens": args.max_tokens, "seed": args.seed, "standin_models": args.standin},
+        "classifier_load_s": load_time,
+        "runs": [],
+    }
+    for n_words in args.sizes:
+        print(f"{n_words} words", file=sys.stderr, flush=True)
+        result = benchmark_size(n_words, args.stages, repeat=args.repeat, trace_memory=not args.no_memory,
+                                batch_size=args.batch_size, max_tokens=args.max_tokens,
+                                rewrite_samples=args.rewrite_samples, seed=args.seed)
+        report["runs"].append(result)
+        for stage, record in result["stages"].items():
+            memory = f"  peak {record['peak_traced_mb']:.1f} MB" if "peak_traced_mb" in record else ""
+            print(f"  {stage:22s} {record['seconds']:9.3f}s  {record['words_per_s'] or 0:12,.0f} words/s{memory}",
+                  file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
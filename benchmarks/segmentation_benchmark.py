@@ -0,0 +1,110 @@
+"""Compare the sentence segmentation modes in utils.
+
+Times the rule-based sentencizer against the parser-only en_core_web_sm
+pipeline, one document at a time and through nlp.pipe, and reports how often
+their sentence boundaries agree.
+
+    python benchmarks/segmentation_benchmark.py [--input FILE ...] [--n-process 2]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import SEGMENTATION_MODES, get_nlp
+
+SAMPLE_PARAGRAPHS = [
+    "I started this project with a lot of hope. The first weeks were exciting! Every morning felt like a new "
+    "chance to build something that mattered, and the team shared that energy.",
+    "Then the numbers came in. Revenue dropped by 40% in Q3, and Dr. Smith's report said the pilot had failed. "
+    "Nobody wanted to talk about it. We were scared, honestly, of what it meant for all of us.",
+    "But here's the thing: failure is data. We went back to the drawing board, e.g. by interviewing 120 users, "
+    "and we learned more in two weeks than in the previous six months.",
+    "Today the product serves customers in 14 countries. Is it perfect? No. Are we proud? Absolutely.",
+]
+
+def load_documents(paths, n_docs, paragraphs_per_doc):
+    if paths:
+        docs = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                docs.append(f.read())
+        return docs
+    return [" ".join(SAMPLE_PARAGRAPHS[(d + p) % len(SAMPLE_PARAGRAPHS)] for p in range(paragraphs_per_doc))
+            for d in range(n_docs)]
+
+def time_mode(mode, docs, n_process, batch_size):
+    start = time.perf_counter()
+    nlp = get_nlp(mode)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [[sent.start_char for sent in nlp(doc).sents] for doc in docs]
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in nlp.pipe(docs, n_process=n_process, batch_size=batch_size):
+        pass
+    pipe_time = time.perf_counter() - start
+
+    return {"load_s": load_time, "single_s": single_time, "pipe_s": pipe_time}, single
+
+def boundary_agreement(predicted, reference):
+    # Sentence starts are compared as character offsets; the first sentence of a
+    # document always starts at 0 and is left out so it cannot inflate the score
+    matched = n_pred = n_ref = identical = 0
+    for pred, ref in zip(predicted, reference):
+        pred, ref = set(pred) - {0}, set(ref) - {0}
+        matched += len(pred & ref)
+        n_pred += len(pred)
+        n_ref += len(ref)
+        identical += pred == ref
+    precision = matched / n_pred if n_pred else 1.0
+    recall = matched / n_ref if n_ref else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "identical_docs": identical / max(len(reference), 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", nargs="*", help="text files to segment (default: built-in sample documents)")
+    parser.add_argument("--docs", type=int, default=200, help="number of sample documents")
+    parser.add_argument("--paragraphs", type=int, default=20, help="paragraphs per sample document")
+    parser.add_argument("--n-process", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    docs = load_documents(args.input, args.docs, args.paragraphs)
+    words = sum(len(doc.split()) for doc in docs)
+
+    results = {"documents": len(docs), "words": words, "modes": {}}
+    boundaries = {}
+    for mode in SEGMENTATION_MODES:
+        try:
+            timings, boundaries[mode] = time_mode(mode, docs, args.n_process, args.batch_size)
+        except OSError as e:
+            # en_core_web_sm is not installed
+            print(f"Skipping {mode}: {e}", file=sys.stderr)
+            continue
+        timings["words_per_s"] = words / timings["pipe_s"] if timings["pipe_s"] else None
+        results["modes"][mode] = timings
+    if len(boundaries) == 2:
+        results["agreement"] = boundary_agreement(boundaries["sentencizer"], boundaries["parser"])
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{len(docs)} documents, {words} words")
+    for mode, t in results["modes"].items():
+        print(f"{mode:12s} load {t['load_s']:.2f}s  single {t['single_s']:.2f}s  "
+              f"pipe {t['pipe_s']:.2f}s  ({t['words_per_s']:,.0f} words/s)")
+    if "agreement" in results:
+        a = results["agreement"]
+        print(f"sentencizer vs parser boundaries: precision {a['precision']:.3f}  recall {a['recall']:.3f}  "
+              f"F1 {a['f1']:.3f}  identical docs {a['identical_docs']:.1%}")
+
+if __name__ == "__main__":
+    main()
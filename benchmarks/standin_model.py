@@ -0,0 +1,95 @@
+"""Small local stand-ins for the emotion classifier and the rewrite model.
+
+Both are randomly initialized, a few layers deep and trained on nothing, so
+their outputs are meaningless - but they have the same architecture family,
+tokenizer kind and label set as the real models, which is all the benchmarks
+need to exercise every stage without a network connection.
+
+    python benchmarks/standin_model.py [--output DIR]
+
+Point the pipeline at them with EDD_EMOTION_MODEL=DIR/classifier and
+EDD_REWRITE_MODEL=DIR/rewriter.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import DEFAULT_CACHE_DIR
+from synthetic import TONE_SENTENCES
+
+DEFAULT_STANDIN_DIR = os.path.join(DEFAULT_CACHE_DIR, "models", "standin")
+# Label names of j-hartmann/emotion-english-distilroberta-base, which ml_pipeline.emotion_map expects
+EMOTION_LABELS = ["anger", "disgust", "fear", "joy", "neutral", "sadness", "surprise"]
+
+def _training_text():
+    return [sentence for sentences in TONE_SENTENCES.values() for sentence in sentences] * 20
+
+def build_classifier(path, seed=0):
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast, RobertaConfig, RobertaForSequenceClassification
+
+    # Byte-level BPE with RoBERTa's special tokens, like the real classifier
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=["<s>", "<pad>", "</s>", "<unk>", "<mask>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(_training_text(), trainer)
+    tokenizer.post_processor = processors.RobertaProcessing(("</s>", 2), ("<s>", 0))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>",
+                                        pad_token="<pad>", unk_token="<unk>", cls_token="<s>", sep_token="</s>",
+                                        mask_token="<mask>", model_max_length=512)
+
+    torch.manual_seed(seed)
+    config = RobertaConfig(vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           intermediate_size=128, max_position_embeddings=514, pad_token_id=1,
+                           num_labels=len(EMOTION_LABELS), id2label=dict(enumerate(EMOTION_LABELS)),
+                           label2id={label: i for i, label in enumerate(EMOTION_LABELS)})
+    RobertaForSequenceClassification(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+def build_rewriter(path, seed=0):
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast, T5Config, T5ForConditionalGeneration
+
+    # T5 numbering: pad 0, eos 1, unk 2; every input ends with </s>
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer.decoder = decoders.Metaspace()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=["<pad>", "</s>", "<unk>"])
+    tokenizer.train_from_iterator(_training_text(), trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(single="$A </s>", special_tokens=[("</s>", 1)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="</s>", pad_token="<pad>",
+                                        unk_token="<unk>", model_max_length=512)
+
+    torch.manual_seed(seed)
+    config = T5Config(vocab_size=len(tokenizer), d_model=64, d_ff=128, d_kv=16, num_layers=2, num_heads=4,
+                      pad_token_id=0, eos_token_id=1, decoder_start_token_id=0)
+    T5ForConditionalGeneration(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+def ensure_standin_models(root=None):
+    # Builds the stand-ins once; returns (classifier_dir, rewriter_dir)
+    root = root or DEFAULT_STANDIN_DIR
+    classifier_dir = os.path.join(root, "classifier")
+    rewriter_dir = os.path.join(root, "rewriter")
+    if not os.path.exists(os.path.join(classifier_dir, "config.json")):
+        build_classifier(classifier_dir)
+    if not os.path.exists(os.path.join(rewriter_dir, "config.json")):
+        build_rewriter(rewriter_dir)
+    return classifier_dir, rewriter_dir
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=DEFAULT_STANDIN_DIR)
+    args = parser.parse_args()
+    classifier_dir, rewriter_dir = ensure_standin_models(args.output)
+    print(f"EDD_EMOTION_MODEL={classifier_dir}")
+    print(f"EDD_REWRITE_MODEL={rewriter_dir}")
+
+if __name__ == "__main__":
+    main()
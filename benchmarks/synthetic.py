@@ -0,0 +1,91 @@
+"""Deterministic synthetic long-form documents for the benchmarks.
+
+Documents are built from sections with one dominant tone each, so the
+classifier sees real tone shifts and drift detection has something to find.
+The same (n_words, seed) always gives the same text.
+
+    python benchmarks/synthetic.py 10000 > doc.txt
+"""
+import argparse
+import random
+
+TONE_SENTENCES = {
+    "inspirational": [
+        "Every setback taught us something we could not have learned any other way.",
+        "Imagine what this community can build when everyone brings their best ideas.",
+        "We started with nothing but a shared belief that things could be better.",
+        "The breakthrough came when we stopped waiting for permission and simply began.",
+        "You are closer to your goal today than you were yesterday, so keep going.",
+        "Small steps, taken every single day, add up to a life you can be proud of.",
+    ],
+    "informative": [
+        "The report covers revenue, operating costs and headcount for each region.",
+        "Version 2.3 adds support for batch exports and fixes three known issues.",
+        "The survey was sent to 1,200 customers and 34% of them responded.",
+        "Each module is tested separately before it is merged into the main branch.",
+        "The committee meets on the first Tuesday of every month in room 4B.",
+        "Prices are listed in euros and include value added tax where it applies.",
+    ],
+    "empathetic": [
+        "I know how hard this month has been for many of you, and that is okay.",
+        "There are no right words for a loss like this, but we are here for you.",
+        "It makes sense to feel tired when so much has changed so quickly.",
+        "Please reach out if you need to talk, even if it is late at night.",
+        "Your feelings are valid, and you do not have to carry them on your own.",
+        "We hear you, and we are sorry that the last update made things harder.",
+    ],
+    "aggressive": [
+        "This is completely unacceptable and someone needs to answer for it.",
+        "You ignored every warning and now you expect us to clean up your mess?",
+        "Frankly, the people who approved this plan should be ashamed of themselves.",
+        "Stop making excuses and fix the problem you created.",
+        "We are sick of hearing the same empty promises every single quarter.",
+        "The response was lazy, arrogant and insulting to everyone involved.",
+    ],
+    "defensive": [
+        "We followed every procedure that was in place at the time.",
+        "To be clear, nobody on our team was told about the change in advance.",
+        "Any suggestion that we acted in bad faith is simply not accurate.",
+        "If the audit finds anything, we will be able to explain each decision.",
+        "We are worried that the numbers are being taken out of context.",
+        "The delay was caused by factors that were outside of our control.",
+    ],
+}
+TONES = list(TONE_SENTENCES)
+
+def iter_sentences(n_words, seed=0, section_words=(150, 600)):
+    # Yields (tone, sentence) until at least n_words words have been produced
+    rng = random.Random(seed)
+    words = 0
+    tone = rng.choice(TONES)
+    while words < n_words:
+        section_end = words + rng.randint(*section_words)
+        while words < min(section_end, n_words):
+            sentence = rng.choice(TONE_SENTENCES[tone])
+            words += len(sentence.split())
+            yield tone, sentence
+        tone = rng.choice([t for t in TONES if t != tone])
+
+def generate_document(n_words, seed=0, sentences_per_paragraph=(3, 7)):
+    rng = random.Random(seed + 1)
+    paragraphs, paragraph = [], []
+    target = rng.randint(*sentences_per_paragraph)
+    for _, sentence in iter_sentences(n_words, seed):
+        paragraph.append(sentence)
+        if len(paragraph) >= target:
+            paragraphs.append(" ".join(paragraph))
+            paragraph = []
+            target = rng.randint(*sentences_per_paragraph)
+    if paragraph:
+        paragraphs.append(" ".join(paragraph))
+    return "\n\n".join(paragraphs)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("words", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate_document(args.words, args.seed))
+
+if __name__ == "__main__":
+    main()
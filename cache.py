@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "EDD_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "emotional-drift-detector")
+)
+
+def normalize_text(text):
+    # Whitespace-only normalization: the classifier is case sensitive, so case
+    # and punctuation changes must still produce a new key
+    return re.sub(r'\s+', ' ', text).strip()
+
+def content_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class TieredCache:
+    # In-memory LRU in front of an on-disk SQLite table. Values are bytes.
+    # Both tiers are bounded by item count; the disk tier drops the least
+    # recently used rows once it grows past its bound.
+
+    def __init__(self, path=None, table="entries", memory_items=4096, disk_items=200_000):
+        self.path = path
+        self.table = table
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._disk_count = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # Opened lazily, and again after a fork, so worker processes never
+        # share a SQLite handle with their parent
+        if self.path is None:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB, accessed REAL)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)")
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+            self._disk_count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return self._conn
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            pending = []
+            for key in keys:
+                if key in found:
+                    continue
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self.memory_hits += 1
+                else:
+                    pending.append(key)
+            pending = list(dict.fromkeys(pending))
+
+            conn = self._connection()
+            if conn is not None and pending:
+                disk_found = {}
+                # Stay under SQLite's bound-parameter limit
+                for i in range(0, len(pending), 500):
+                    batch = pending[i:i + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = conn.execute(
+                        f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    disk_found.update(rows)
+                if disk_found:
+                    now = time.time()
+                    conn.executemany(f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                                     [(now, key) for key in disk_found])
+                    conn.commit()
+                for key, value in disk_found.items():
+                    self._remember(key, value)
+                    found[key] = value
+                self.disk_hits += len(disk_found)
+                self.misses += len(pending) - len(disk_found)
+            else:
+                self.misses += len(pending)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        items = dict(items)
+        if not items:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._remember(key, value)
+            conn = self._connection()
+            if conn is None:
+                return
+            now = time.time()
+            before = conn.total_changes
+            conn.executemany(f"INSERT OR IGNORE INTO {self.table} (key, value, accessed) VALUES (?, ?, ?)",
+                             [(key, value, now) for key, value in items.items()])
+            self._disk_count += conn.total_changes - before
+            if self._disk_count > self.disk_items:
+                # Trim to 90% of the bound so we do not evict on every insert
+                excess = self._disk_count - int(self.disk_items * 0.9)
+                conn.execute(f"DELETE FROM {self.table} WHERE key IN "
+                             f"(SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)", (excess,))
+                self._disk_count -= excess
+            conn.commit()
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            conn = self._connection()
+            if conn is not None:
+                conn.execute(f"DELETE FROM {self.table}")
+                conn.commit()
+                self._disk_count = 0
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_items": len(self._memory),
+            "disk_items": self._disk_count or 0,
+        }
+
+class ScoreCache(TieredCache):
+    # Per-chunk emotion vectors keyed by (normalized chunk text, model id, mapping version)
+
+    def __init__(self, model_id, mapping_version, path=None, **kwargs):
+        super().__init__(path=path, table="scores", **kwargs)
+        self.model_id = model_id
+        self.mapping_version = mapping_version
+
+    def key(self, chunk):
+        return content_key(self.model_id, self.mapping_version, normalize_text(chunk))
+
+    def get_vectors(self, keys):
+        return {key: np.frombuffer(value, dtype=np.float64).tolist() for key, value in self.get_many(keys).items()}
+
+    def put_vectors(self, vectors_by_key):
+        self.put_many({key: np.asarray(vec, dtype=np.float64).tobytes() for key, vec in vectors_by_key.items()})
+
+class RewriteCache(TieredCache):
+    # Generated rewrites keyed by (normalized chunk text, target emotion,
+    # model id, generation parameters including the seed)
+
+    def __init__(self, model_id, path=None, **kwargs):
+        super().__init__(path=path, table="rewrites", **kwargs)
+        self.model_id = model_id
+
+    def key(self, chunk, target_emotion, params):
+        return content_key(self.model_id, json.dumps(params, sort_keys=True), target_emotion, normalize_text(chunk))
+
+    def get_texts(self, keys):
+        return {key: value.decode("utf-8") for key, value in self.get_many(keys).items()}
+
+    def put_texts(self, texts_by_key):
+        self.put_many({key: text.encode("utf-8") for key, text in texts_by_key.items()})
+
+class ResultCache:
+    # Process-wide, memory-only LRU for whole analysis results, bounded by
+    # item count and by an estimate of their size in bytes given at put().
+    # Values are shared between callers as they are, so they must never be
+    # modified in place.
+
+    def __init__(self, max_items=32, max_bytes=256 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        # Returns False, storing nothing, for a value larger than the whole cache
+        with self._lock:
+            self._pop(key)
+            if nbytes > self.max_bytes:
+                return False
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_items or self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+        return entry
+
+    def evict(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "items": len(self._entries),
+            "bytes": self.nbytes,
+        }
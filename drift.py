@@ -0,0 +1,381 @@
+import heapq
+import math
+
+import numpy as np
+
+# Change-point algorithms. n is the number of segments, d = 7 labels.
+#
+#   "pelt-rbf"     ruptures Pelt with the RBF kernel cost (the original detector).
+#                  O(n^2) time and memory for the kernel; fine up to a few hundred segments.
+#   "pelt-l2"      Exact PELT with a squared-error (mean shift) cost computed from
+#                  cumulative sums: O(1) per segment cost. Pruning only fires after a
+#                  change, so this is O(n) with regular changes but O(n^2) on a signal
+#                  without any (about 0.15 s at 2000 segments, 1.1 s at 5000).
+#   "pelt-normal"  Same search with a Gaussian cost (per-label mean and variance), which
+#                  also reacts to the signal getting noisier or calmer. Same bounds,
+#                  about twice as slow.
+#   "binseg"       Greedy binary segmentation with the L2 cost. Each split is one
+#                  vectorized scan of its segment: O(n log n).
+#   "window"       Sliding-window two-sample discrepancy with the L2 cost, peaks above the
+#                  penalty are change points. O(n), but only sees changes inside the window.
+#   "hierarchical" Coarse-to-fine: exact L2 PELT restricted to block boundaries (about
+#                  coarse_points candidates), then a fine search within one block of the
+#                  coarse change points: the exact best split for a lone one, exact PELT
+#                  over a run of them on neighbouring boundaries. O(n) plus the searches.
+#
+# Every algorithm returns segment ends as ruptures does: the change points,
+# then n closing the last segment. n is not a change point, and
+# drifts_from_change_points never reports it as one.
+#
+# "auto" picks pelt-rbf for short inputs (so typical documents keep their
+# results), pelt-l2 while its worst case stays well under a second and
+# hierarchical beyond.
+DRIFT_ALGORITHMS = ("pelt-rbf", "pelt-l2", "pelt-normal", "binseg", "window", "hierarchical")
+AUTO_RBF_MAX_SEGMENTS = 300
+AUTO_PELT_MAX_SEGMENTS = 2000
+
+class DriftDetectionError(RuntimeError):
+    pass
+
+def choose_algorithm(n_segments):
+    if n_segments <= AUTO_RBF_MAX_SEGMENTS:
+        return "pelt-rbf"
+    if n_segments <= AUTO_PELT_MAX_SEGMENTS:
+        return "pelt-l2"
+    return "hierarchical"
+
+class _L2Cost:
+    # Sum of squared deviations from the segment mean, from cumulative sums
+
+    def __init__(self, signal):
+        self.sums = np.vstack([np.zeros((1, signal.shape[1])), np.cumsum(signal, axis=0)])
+        self.squares = np.concatenate([[0.0], np.cumsum((signal ** 2).sum(axis=1))])
+
+    def __call__(self, starts, ends):
+        length = ends - starts
+        diff = self.sums[ends] - self.sums[starts]
+        return self.squares[ends] - self.squares[starts] - (diff ** 2).sum(axis=-1) / length
+
+class _NormalCost:
+    # Gaussian negative log-likelihood with a diagonal covariance:
+    # length * sum(log(variance)) over the labels
+
+    def __init__(self, signal, min_variance=1e-6):
+        self.sums = np.vstack([np.zeros((1, signal.shape[1])), np.cumsum(signal, axis=0)])
+        self.squares = np.vstack([np.zeros((1, signal.shape[1])), np.cumsum(signal ** 2, axis=0)])
+        self.min_variance = min_variance
+
+    def __call__(self, starts, ends):
+        length = np.asarray(ends - starts, dtype=np.float64)[..., None]
+        mean = (self.sums[ends] - self.sums[starts]) / length
+        variance = (self.squares[ends] - self.squares[starts]) / length - mean ** 2
+        return length[..., 0] * np.log(np.maximum(variance, self.min_variance)).sum(axis=-1)
+
+def default_penalty(signal, algorithm):
+    n, d = signal.shape
+    if algorithm == "pelt-rbf":
+        return 10.0
+    if algorithm == "pelt-normal":
+        # BIC: a mean and a variance per label for every extra segment
+        return 2 * d * math.log(n)
+    # BIC-style penalty scaled by the noise level, estimated robustly from the
+    # first differences (median absolute deviation, per label)
+    diffs = np.abs(np.diff(signal, axis=0))
+    noise = ((np.median(diffs, axis=0) / 0.6745) ** 2 / 2).sum() if n > 2 else 0.0
+    return 2 * max(noise, 1e-4) * math.log(n)
+
+def _pelt(cost, positions, pen, min_size):
+    # Optimal partitioning over the candidate split positions (indices into the
+    # signal, positions[0] == 0 and positions[-1] == n) with PELT pruning
+    return _pelt_path(cost, positions, [pen], min_size)[0]
+
+def _pelt_path(cost, positions, penalties, min_size, prune_every=8):
+    # _pelt for several penalties in one pass. Segment costs do not depend on
+    # the penalty, so each is computed once for all of them; a candidate is
+    # pruned once no penalty can use it again (keeping it longer for some
+    # penalties does not change their optimum, so pruning every few steps is
+    # enough).
+    pens = np.asarray(penalties, dtype=np.float64)[:, None]
+    m = len(positions) - 1
+    best = np.full((len(pens), m + 1), np.inf)
+    best[:, 0] = -pens[:, 0]
+    previous = np.zeros((len(pens), m + 1), dtype=np.int64)
+    rows = np.arange(len(pens))
+    # Candidates in order, the first `ready` of them at least min_size before t
+    candidates = np.zeros(m + 1, dtype=np.int64)
+    size, ready = 1, 0
+    for t in range(1, m + 1):
+        end = positions[t]
+        while ready < size and end - positions[candidates[ready]] >= min_size:
+            ready += 1
+        if ready:
+            usable = candidates[:ready]
+            values = best[:, usable] + cost(positions[usable], end) + pens
+            k = np.argmin(values, axis=1)
+            best[:, t] = values[rows, k]
+            previous[:, t] = usable[k]
+            if t % prune_every == 0:
+                # Prune candidates that can never be the last change point again
+                keep = usable[(values - pens <= best[:, t, None]).any(axis=0)]
+                young = candidates[ready:size].copy()
+                candidates[:len(keep)] = keep
+                candidates[len(keep):len(keep) + len(young)] = young
+                size, ready = len(keep) + len(young), len(keep)
+        candidates[size] = t
+        size += 1
+
+    paths = []
+    for row in rows:
+        if not np.isfinite(best[row, m]):
+            paths.append([int(positions[m])])
+            continue
+        change_points = []
+        t = m
+        while t > 0:
+            change_points.append(int(positions[t]))
+            t = previous[row, t]
+        paths.append(change_points[::-1])
+    return paths
+
+def _best_split(cost, start, end, min_size, lo=None, hi=None):
+    # Best single split of [start, end), optionally searching only [lo, hi]
+    first = max(start + min_size, lo if lo is not None else start)
+    last = min(end - min_size, hi if hi is not None else end)
+    if first > last:
+        return None, 0.0
+    splits = np.arange(first, last + 1)
+    gains = cost(np.int64(start), np.int64(end)) - cost(np.int64(start), splits) - cost(splits, np.int64(end))
+    k = int(np.argmax(gains))
+    return int(splits[k]), float(gains[k])
+
+def _binseg(cost, n, pen, min_size, max_change_points=None):
+    change_points = []
+    heap = []
+
+    def push(start, end):
+        split, gain = _best_split(cost, start, end, min_size)
+        if split is not None:
+            heapq.heappush(heap, (-gain, split, start, end))
+
+    push(0, n)
+    while heap:
+        neg_gain, split, start, end = heapq.heappop(heap)
+        if -neg_gain <= pen:
+            break
+        change_points.append(split)
+        if max_change_points and len(change_points) >= max_change_points:
+            break
+        push(start, split)
+        push(split, end)
+    return sorted(change_points) + [n]
+
+def _binseg_path(cost, n, min_pen, min_size, max_change_points=None):
+    # The splits binary segmentation takes, in order, with their gains. Splits
+    # never depend on the penalty, only where the search stops does: the
+    # result for any pen >= min_pen is the prefix whose gains exceed pen.
+    path = []
+    heap = []
+
+    def push(start, end):
+        split, gain = _best_split(cost, start, end, min_size)
+        if split is not None:
+            heapq.heappush(heap, (-gain, split, start, end))
+
+    push(0, n)
+    while heap:
+        neg_gain, split, start, end = heapq.heappop(heap)
+        if -neg_gain <= min_pen:
+            break
+        path.append((split, -neg_gain))
+        if max_change_points and len(path) >= max_change_points:
+            break
+        push(start, split)
+        push(split, end)
+    return path
+
+def _window(cost, n, pen, width):
+    if n < 2 * width:
+        return [n]
+    centers = np.arange(width, n - width + 1)
+    gains = cost(centers - width, centers + width) - cost(centers - width, centers) - cost(centers, centers + width)
+    change_points = []
+    taken = np.zeros(n + 1, dtype=bool)
+    for k in np.argsort(-gains, kind="stable"):
+        if gains[k] <= pen:
+            break
+        center = int(centers[k])
+        if not taken[center]:
+            change_points.append(center)
+            # No second change point within one window of this one
+            taken[max(center - width + 1, 0):center + width] = True
+    return sorted(change_points) + [n]
+
+def _hierarchical(cost, n, pen, min_size, coarse_points):
+    return _hierarchical_path(cost, n, [pen], min_size, coarse_points)[0]
+
+def _hierarchical_path(cost, n, penalties, min_size, coarse_points):
+    block = max(math.ceil(n / coarse_points), min_size)
+    if block <= 1:
+        return _pelt_path(cost, np.arange(n + 1), penalties, min_size)
+    edges = np.append(np.arange(0, n, block), n)
+    if edges[-1] - edges[-2] < min_size and len(edges) > 2:
+        edges = np.delete(edges, -2)
+    return [_refine(cost, n, coarse, pen, min_size, block)
+            for pen, coarse in zip(penalties, _pelt_path(cost, edges, penalties, min_size))]
+
+def _refine(cost, n, coarse, pen, min_size, block):
+    # Coarse change points on neighbouring block edges may bracket one change
+    # or stand for several: each run of them is searched again as a whole,
+    # with exact PELT over the positions within one block of the run. A lone
+    # coarse point is moved to the exact best split within one block of it.
+    groups = []
+    for cp in coarse[:-1]:
+        if groups and cp - groups[-1][-1] <= block:
+            groups[-1].append(cp)
+        else:
+            groups.append([cp])
+    refined = []
+    for i, group in enumerate(groups):
+        start = refined[-1] if refined else 0
+        end = groups[i + 1][0] if i + 1 < len(groups) else n
+        lo, hi = max(group[0] - block, start + 1), min(group[-1] + block, end - 1)
+        if len(group) == 1:
+            split, _ = _best_split(cost, start, end, min_size, lo, hi)
+            refined.extend([] if split is None else [split])
+        else:
+            positions = np.concatenate([[start], np.arange(lo, hi + 1), [end]])
+            refined.extend(_pelt(cost, positions, pen, min_size)[:-1])
+    return refined + [n]
+
+def drifts_from_change_points(change_points, n_segments):
+    drifts = []
+    for i in range(1, len(change_points)):
+        start = change_points[i-1]
+        end = change_points[i]
+        if end < n_segments:
+            drifts.append((start, end))
+    return drifts
+
+def penalty_grid(pen, below=2, above=4, factor=math.sqrt(2)):
+    # Geometric grid around pen: pen / factor**below ... pen * factor**above.
+    # Much lower penalties split on noise (thousands of drifts at a few
+    # thousand segments), and much higher ones slow PELT down as it prunes less
+    return [pen * factor ** k for k in range(-below, above + 1)]
+
+class DriftPath:
+    # Change points of one signal for a range of penalties, lowest penalty
+    # (most change points) first. default_index is the entry at the
+    # algorithm's default penalty, i.e. what detect_change_points returns.
+    # Every entry is computed up front, so looking one up never searches.
+
+    def __init__(self, penalties, change_points, default_index, algorithm):
+        self.penalties = list(penalties)
+        self.change_points = [list(cps) for cps in change_points]
+        self.default_index = default_index
+        self.algorithm = algorithm
+
+    def __len__(self):
+        return len(self.penalties)
+
+    @property
+    def n_segments(self):
+        return self.change_points[0][-1]
+
+    @property
+    def default_change_points(self):
+        return self.change_points[self.default_index]
+
+    def change_points_at(self, index):
+        return self.change_points[index]
+
+    def drifts_at(self, index):
+        return drifts_from_change_points(self.change_points[index], self.n_segments)
+
+    def drift_counts(self):
+        return [len(self.drifts_at(index)) for index in range(len(self))]
+
+def _prepare(signal, algorithm):
+    signal = np.asarray(signal, dtype=np.float64)
+    if signal.ndim == 1:
+        signal = signal[:, None]
+    if not np.isfinite(signal).all():
+        raise DriftDetectionError("emotion vectors contain NaN or infinite values")
+    if algorithm == "auto":
+        algorithm = choose_algorithm(len(signal))
+    if algorithm not in DRIFT_ALGORITHMS:
+        raise ValueError(f"Unknown drift algorithm {algorithm!r}, expected 'auto' or one of {DRIFT_ALGORITHMS}")
+    return signal, algorithm
+
+def _fit_cost(signal, algorithm, min_size):
+    # Everything that does not depend on the penalty: cumulative sums, or for
+    # pelt-rbf the fitted ruptures estimator holding the kernel Gram matrix
+    if algorithm == "pelt-rbf":
+        import ruptures as rpt
+        return rpt.Pelt(model="rbf", min_size=min_size).fit(signal)
+    if algorithm == "pelt-normal":
+        return _NormalCost(signal)
+    return _L2Cost(signal)
+
+def _search(cost, algorithm, n, pen, min_size, width, coarse_points, max_change_points):
+    if algorithm == "pelt-rbf":
+        return [int(cp) for cp in cost.predict(pen=pen)]
+    if algorithm in ("pelt-l2", "pelt-normal"):
+        return _pelt(cost, np.arange(n + 1), pen, min_size)
+    if algorithm == "binseg":
+        return _binseg(cost, n, pen, min_size, max_change_points)
+    if algorithm == "window":
+        return _window(cost, n, pen, max(width, min_size))
+    return _hierarchical(cost, n, pen, min_size, coarse_points)
+
+def detect_change_points(signal, algorithm="auto", pen=None, min_size=2, width=10, coarse_points=2000,
+                         max_change_points=None):
+    # Returns the segment ends, the last one being len(signal)
+    signal, algorithm = _prepare(signal, algorithm)
+    n = len(signal)
+    if n < 2:
+        return [n]
+    if pen is None:
+        pen = default_penalty(signal, algorithm)
+    try:
+        cost = _fit_cost(signal, algorithm, min_size)
+        return _search(cost, algorithm, n, pen, min_size, width, coarse_points, max_change_points)
+    except Exception as e:
+        raise DriftDetectionError(f"{algorithm} change-point detection failed on {n} segments: {e}") from e
+
+def change_point_path(signal, algorithm="auto", pen=None, penalties=None, min_size=2, width=10, coarse_points=2000,
+                      max_change_points=None):
+    # Change points for every penalty in penalties (default: penalty_grid
+    # around pen) from one cost fit. binseg computes its split order once and
+    # cuts it per penalty; the PELT searches (and hierarchical's coarse pass)
+    # run once for all penalties, sharing every segment cost. pelt-rbf and
+    # window re-run only their search, which is cheap at the sizes they serve.
+    signal, algorithm = _prepare(signal, algorithm)
+    n = len(signal)
+    if n < 2:
+        return DriftPath([pen or 0.0], [[n]], 0, algorithm)
+    if pen is None:
+        pen = default_penalty(signal, algorithm)
+    if penalties is None:
+        penalties = penalty_grid(pen)
+    penalties = sorted(penalties)
+    default_index = int(np.argmin([abs(p - pen) for p in penalties]))
+    try:
+        cost = _fit_cost(signal, algorithm, min_size)
+        if algorithm == "binseg":
+            splits = _binseg_path(cost, n, penalties[0], min_size, max_change_points)
+            gains = [gain for _, gain in splits]
+            change_points = []
+            for p in penalties:
+                # Binary segmentation stops at the first split not worth pen
+                stop = next((k for k, gain in enumerate(gains) if gain <= p), len(splits))
+                change_points.append(sorted(split for split, _ in splits[:stop]) + [n])
+        elif algorithm in ("pelt-l2", "pelt-normal"):
+            change_points = _pelt_path(cost, np.arange(n + 1), penalties, min_size)
+        elif algorithm == "hierarchical":
+            change_points = _hierarchical_path(cost, n, penalties, min_size, coarse_points)
+        else:
+            change_points = [_search(cost, algorithm, n, p, min_size, width, coarse_points, max_change_points)
+                             for p in penalties]
+    except Exception as e:
+        raise DriftDetectionError(f"{algorithm} change-point path failed on {n} segments: {e}") from e
+    return DriftPath(penalties, change_points, default_index, algorithm)
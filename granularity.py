@@ -0,0 +1,76 @@
+import numpy as np
+
+from analytics import as_score_array
+
+# Resolutions an emotion curve can be built at from sentence scores:
+#   "sentence"  - every sentence (long ones split at the token budget) on its own
+#   "chunk"     - sentences packed greedily up to max_tokens, like chunk_by_tokens
+#   "paragraph" - blank-line separated paragraphs of the original text
+#   "window"    - a sliding window of `window` sentences, moved by `step`
+GRANULARITIES = ("sentence", "chunk", "paragraph", "window")
+
+class SentenceScores:
+    # Emotion scores of every sentence of a document, from one pass of the
+    # classifier. Curves at coarser granularities are token-weighted means of
+    # these, computed from prefix sums, so switching granularity needs no
+    # inference. Averaged distributions are flatter than a score of the joined
+    # text, so coarse curves show somewhat higher entropy.
+
+    def __init__(self, sentences, spans, token_counts, scores, paragraph_ids):
+        self.sentences = list(sentences)
+        self.spans = list(spans)
+        self.token_counts = np.asarray(token_counts, dtype=np.int64).reshape(-1)
+        self.scores = as_score_array(scores)
+        self.paragraph_ids = np.asarray(paragraph_ids, dtype=np.int64).reshape(-1)
+        # Every sentence counts for at least one token, so no group has zero weight
+        weights = np.maximum(self.token_counts, 1).astype(np.float64)
+        self._weight_sums = np.concatenate(([0.0], np.cumsum(weights)))
+        self._score_sums = np.vstack((np.zeros((1, self.scores.shape[1])),
+                                      np.cumsum(self.scores * weights[:, None], axis=0)))
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def groups(self, granularity="chunk", max_tokens=256, window=5, step=1):
+        # [start, end) sentence ranges of the segments at this granularity
+        n = len(self.sentences)
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity {granularity!r}, expected one of {GRANULARITIES}")
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if granularity == "sentence":
+            starts = np.arange(n)
+        elif granularity == "paragraph":
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(self.paragraph_ids)) + 1))
+        elif granularity == "chunk":
+            # Greedy packing is inherently sequential, but only touches one int per sentence
+            starts, tokens = [0], 0
+            for i, n_tokens in enumerate(self.token_counts.tolist()):
+                if tokens and tokens + n_tokens > max_tokens:
+                    starts.append(i)
+                    tokens = 0
+                tokens += n_tokens
+            starts = np.asarray(starts)
+        else:
+            window, step = max(int(window), 1), max(int(step), 1)
+            if n <= window:
+                return np.zeros(1, dtype=np.int64), np.full(1, n, dtype=np.int64)
+            starts = np.arange(0, n - window + 1, step)
+            if starts[-1] != n - window:
+                # The last sentences always get a window of their own
+                starts = np.append(starts, n - window)
+            return starts.astype(np.int64), (starts + window).astype(np.int64)
+        starts = starts.astype(np.int64)
+        return starts, np.append(starts[1:], n).astype(np.int64)
+
+    def aggregate(self, starts, ends):
+        # Token-weighted mean score of the sentences in each [start, end)
+        weights = self._weight_sums[ends] - self._weight_sums[starts]
+        sums = self._score_sums[ends] - self._score_sums[starts]
+        return (sums / weights[:, None]).astype(np.float32)
+
+    def curve(self, granularity="chunk", **params):
+        # (segment texts, N x 7 scores) at this granularity
+        starts, ends = self.groups(granularity, **params)
+        texts = [" ".join(self.sentences[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
+        return texts, self.aggregate(starts, ends)
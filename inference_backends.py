@@ -0,0 +1,75 @@
+import os
+import re
+import shutil
+
+from cache import DEFAULT_CACHE_DIR
+
+# Inference backends for the text classifier:
+#   "eager" - the fp32 PyTorch model as downloaded
+#   "int8"  - PyTorch dynamic int8 quantization of every nn.Linear
+#   "onnx"  - ONNX export run by ONNX Runtime (needs optimum[onnxruntime])
+# The int8 and ONNX conversions run once and are cached under EDD_CACHE_DIR.
+# torch and transformers are imported on first load, not with this module.
+BACKENDS = ("eager", "int8", "onnx")
+DEFAULT_BACKEND = os.environ.get("EDD_INFERENCE_BACKEND", "eager")
+
+def _converted_dir(backend, model_id):
+    return os.path.join(DEFAULT_CACHE_DIR, "models", backend, re.sub(r"[^\w.-]+", "--", model_id))
+
+def _atomic_save(final_dir, save):
+    # Write into a scratch directory first so an interrupted conversion never
+    # leaves a half-written model behind
+    tmp_dir = final_dir + f".tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    save(tmp_dir)
+    try:
+        os.replace(tmp_dir, final_dir)
+    except OSError:
+        # Another process finished the same conversion first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _load_int8(model_id):
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    model_dir = _converted_dir("int8", model_id)
+    model_path = os.path.join(model_dir, "model.pt")
+    if not os.path.exists(model_path):
+        model = AutoModelForSequenceClassification.from_pretrained(model_id).eval()
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+        def save(path):
+            torch.save(quantized, os.path.join(path, "model.pt"))
+            tokenizer.save_pretrained(path)
+        _atomic_save(model_dir, save)
+    # The quantized modules are pickled whole; the file is one we wrote ourselves
+    model = torch.load(model_path, weights_only=False)
+    return model.eval(), AutoTokenizer.from_pretrained(model_dir)
+
+def _load_onnx(model_id):
+    try:
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+    except ImportError:
+        raise ImportError('The "onnx" backend needs optimum with ONNX Runtime: pip install "optimum[onnxruntime]"')
+    from transformers import AutoTokenizer
+    model_dir = _converted_dir("onnx", model_id)
+    if not os.path.exists(model_dir):
+        model = ORTModelForSequenceClassification.from_pretrained(model_id, export=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+        def save(path):
+            model.save_pretrained(path)
+            tokenizer.save_pretrained(path)
+        _atomic_save(model_dir, save)
+    return ORTModelForSequenceClassification.from_pretrained(model_dir), AutoTokenizer.from_pretrained(model_dir)
+
+def load_text_classifier(model_id, backend=None):
+    from transformers import pipeline
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {BACKENDS}")
+    if backend == "eager":
+        return pipeline("text-classification", model=model_id, top_k=None)
+    model, tokenizer = _load_int8(model_id) if backend == "int8" else _load_onnx(model_id)
+    return pipeline("text-classification", model=model, tokenizer=tokenizer, top_k=None)
@@ -0,0 +1,134 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from instrumentation import current_trace, shared_trace
+
+class InferenceScheduler:
+    # Owns the emotion classifier on one worker thread and serves chunk
+    # requests from every session through it. Pending requests are collected
+    # into micro-batches: a batch is dispatched as soon as it holds
+    # max_batch_size chunks, or max_wait_ms after its first chunk arrived.
+    #
+    # score_fn(chunks, token_ids) runs on the worker thread and returns one
+    # emotion vector per chunk; token_ids is None or one id list per chunk.
+    # It runs with the traces of every request in the group active, so each
+    # trace records the model stages of the batches it took part in.
+
+    def __init__(self, score_fn, max_batch_size=32, max_wait_ms=10):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=1000)
+        self.queue_waits = deque(maxlen=1000)
+        self._thread = threading.Thread(target=self._run, name="emotion-inference", daemon=True)
+        self._thread.start()
+
+    def submit(self, chunk, token_ids=None):
+        return self.submit_many([chunk], None if token_ids is None else [token_ids])[0]
+
+    def submit_many(self, chunks, token_ids=None):
+        if self._closed:
+            raise RuntimeError("InferenceScheduler has been shut down")
+        now = time.perf_counter()
+        trace = current_trace()
+        futures = []
+        for idx, chunk in enumerate(chunks):
+            future = Future()
+            self._queue.put((future, chunk, None if token_ids is None else token_ids[idx], now, trace))
+            futures.append(future)
+        with self._lock:
+            self.submitted += len(chunks)
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return futures
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Shutdown: finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Callers may have given up on some requests while they waited
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.batch_sizes.append(len(batch))
+                self.queue_waits.extend(started - item[3] for item in batch)
+            # Chunks with and without pre-tokenized ids take different model paths
+            with_ids = [item for item in batch if item[2] is not None]
+            without_ids = [item for item in batch if item[2] is None]
+            for group, ids in ((with_ids, [item[2] for item in with_ids]), (without_ids, None)):
+                if not group:
+                    continue
+                try:
+                    with shared_trace(item[4] for item in group):
+                        vectors = self.score_fn([item[1] for item in group], ids)
+                except Exception as e:
+                    for item in group:
+                        item[0].set_exception(e)
+                    with self._lock:
+                        self.failed += len(group)
+                    continue
+                for item, vector in zip(group, vectors):
+                    item[0].set_result(vector)
+                with self._lock:
+                    self.completed += len(group)
+
+    def metrics(self):
+        # Batch-size and queue-wait figures cover the last 1000 batches / requests
+        with self._lock:
+            sizes = list(self.batch_sizes)
+            waits = sorted(self.queue_waits)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "batches": self.batches,
+                "mean_batch_size": sum(sizes) / len(sizes) if sizes else 0.0,
+                "max_batch_size_seen": max(sizes) if sizes else 0,
+                "queue_wait_p50_ms": waits[len(waits) // 2] * 1000 if waits else 0.0,
+                "queue_wait_p99_ms": waits[min(int(len(waits) * 0.99), len(waits) - 1)] * 1000 if waits else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        self._closed = True
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
@@ -0,0 +1,341 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Timings and counters for the pipeline, reported three ways:
+#   - a Trace per analysis (stage wall/CPU time and counters), returned by
+#     run_pipeline(return_trace=True) and emitted as a ("trace", Trace) event
+#   - one JSON log line per finished trace on the "emotional_drift" logger
+#   - process-wide totals in Prometheus text format, written to EDD_METRICS_FILE
+#     after every trace and/or served on EDD_METRICS_PORT
+#
+# Stages record process CPU time: inference runs on torch and scheduler
+# threads, which a per-thread clock would miss. With several analyses running
+# at once, CPU time is shared between their traces.
+
+logger = logging.getLogger("emotional_drift")
+
+_current_trace = contextvars.ContextVar("edd_current_trace", default=None)
+
+class Trace:
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.wall_s = None
+        self.cpu_s = None
+        self.stages = {}  # name -> {"calls", "wall_s", "cpu_s"}
+        self.counters = defaultdict(float)
+        self.observations = {}  # name -> {"count", "sum", "min", "max"}
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def add_stage(self, name, wall_s, cpu_s):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+            stage["calls"] += 1
+            stage["wall_s"] += wall_s
+            stage["cpu_s"] += cpu_s
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self.observations.get(name)
+            if summary is None:
+                self.observations[name] = {"count": 1, "sum": value, "min": value, "max": value}
+            else:
+                summary["count"] += 1
+                summary["sum"] += value
+                summary["min"] = min(summary["min"], value)
+                summary["max"] = max(summary["max"], value)
+
+    def finish(self):
+        if self.wall_s is None:
+            self.wall_s = time.perf_counter() - self._start
+            self.cpu_s = time.process_time() - self._start_cpu
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "attributes": dict(self.attributes),
+                "started_at": self.started_at,
+                "wall_s": self.wall_s,
+                "cpu_s": self.cpu_s,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counters": dict(self.counters),
+                "observations": {name: dict(summary) for name, summary in self.observations.items()},
+            }
+
+    def stage_rows(self):
+        # One row per stage, slowest first, for tables. Stages can nest, so
+        # shares do not have to add up to 100%.
+        total = self.wall_s or time.perf_counter() - self._start
+        rows = []
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]["wall_s"]):
+            rows.append({"stage": name, "calls": stage["calls"], "wall_ms": stage["wall_s"] * 1000,
+                         "cpu_ms": stage["cpu_s"] * 1000,
+                         "share": stage["wall_s"] / total if total else 0.0})
+        return rows
+
+def current_trace():
+    return _current_trace.get()
+
+class _SharedTrace:
+    # Stands in for the traces of several requests served by one shared batch
+    # (the inference scheduler's): each of them records the whole batch
+
+    def __init__(self, traces):
+        self.traces = traces
+
+    def add_stage(self, name, wall_s, cpu_s):
+        for trace in self.traces:
+            trace.add_stage(name, wall_s, cpu_s)
+
+    def count(self, name, value=1):
+        for trace in self.traces:
+            trace.count(name, value)
+
+    def observe(self, name, value):
+        for trace in self.traces:
+            trace.observe(name, value)
+
+@contextmanager
+def shared_trace(traces):
+    # Record into every given trace (None entries skipped) for the block, on
+    # threads such as the scheduler's that run work for other requests
+    traces = list({id(trace): trace for trace in traces if trace is not None}.values())
+    token = _current_trace.set(_SharedTrace(traces) if traces else None)
+    try:
+        yield
+    finally:
+        _current_trace.reset(token)
+
+class MetricsRegistry:
+    # Process-wide totals behind the Prometheus output. Collectors are
+    # callables returning (name, type, help, [(labels, value), ...]) tuples,
+    # evaluated at render time for values owned by other objects.
+
+    def __init__(self, prefix="edd"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stages = defaultdict(lambda: [0, 0.0, 0.0])  # calls, wall, cpu
+        self._counters = defaultdict(float)
+        self._observations = defaultdict(lambda: [0, 0.0])  # count, sum
+        self._gauges = {}
+        self._collectors = []
+
+    def add_stage(self, name, wall_s, cpu_s):
+        with self._lock:
+            stage = self._stages[name]
+            stage[0] += 1
+            stage[1] += wall_s
+            stage[2] += cpu_s
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self._observations[name]
+            summary[0] += 1
+            summary[1] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def register_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def _families(self):
+        p = self.prefix
+        with self._lock:
+            stages = {name: list(values) for name, values in self._stages.items()}
+            counters = dict(self._counters)
+            observations = {name: list(values) for name, values in self._observations.items()}
+            gauges = dict(self._gauges)
+            collectors = list(self._collectors)
+
+        yield (f"{p}_stage_calls_total", "counter", "Calls of each pipeline stage",
+               [({"stage": name}, values[0]) for name, values in stages.items()])
+        yield (f"{p}_stage_wall_seconds_total", "counter", "Wall time spent in each pipeline stage",
+               [({"stage": name}, values[1]) for name, values in stages.items()])
+        yield (f"{p}_stage_cpu_seconds_total", "counter", "Process CPU time spent in each pipeline stage",
+               [({"stage": name}, values[2]) for name, values in stages.items()])
+        for name, value in sorted(counters.items()):
+            yield f"{p}_{name}_total", "counter", name.replace("_", " "), [({}, value)]
+        for name, (count, total) in sorted(observations.items()):
+            yield f"{p}_{name}_count", "counter", f"Observations of {name.replace('_', ' ')}", [({}, count)]
+            yield f"{p}_{name}_sum", "counter", f"Sum of {name.replace('_', ' ')}", [({}, total)]
+        by_name = defaultdict(list)
+        for (name, labels), value in gauges.items():
+            by_name[name].append((dict(labels), value))
+        for name, samples in sorted(by_name.items()):
+            yield f"{p}_{name}", "gauge", name.replace("_", " "), samples
+        for collector in collectors:
+            try:
+                for name, kind, help_text, samples in collector():
+                    yield f"{p}_{name}", kind, help_text, samples
+            except Exception:
+                logger.exception("metrics collector failed")
+
+    def render_prometheus(self):
+        lines = []
+        for name, kind, help_text, samples in self._families():
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {float(value)!r}" if label_text else f"{name} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Written to a temporary file and renamed, so scrapers (e.g. the node
+        # exporter's textfile collector) never read half a file
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+METRICS = MetricsRegistry()
+
+@contextmanager
+def stage(name):
+    # Time a block as one call of the named stage, in the current trace (if
+    # any) and in the process-wide metrics
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall_s = time.perf_counter() - start
+        cpu_s = time.process_time() - start_cpu
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_stage(name, wall_s, cpu_s)
+        METRICS.add_stage(name, wall_s, cpu_s)
+
+def instrumented(name):
+    # Decorator form of stage()
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+    METRICS.count(name, value)
+
+def observe(name, value):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.observe(name, value)
+    METRICS.observe(name, value)
+
+def log_event(event, level=logging.INFO, exc_info=False, **fields):
+    # Structured log line: the message is a JSON object
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({"event": event, **fields}, default=str), exc_info=exc_info)
+
+def finish_trace(trace):
+    trace.finish()
+    METRICS.count("traces")
+    log_event("trace", **trace.as_dict())
+    metrics_file = os.environ.get("EDD_METRICS_FILE")
+    if metrics_file:
+        try:
+            METRICS.write_prometheus(metrics_file)
+        except OSError:
+            logger.exception("could not write metrics file %s", metrics_file)
+    return trace
+
+@contextmanager
+def traced(name, **attributes):
+    trace = Trace(name, **attributes)
+    with trace.activate():
+        yield trace
+    finish_trace(trace)
+
+def trace_events(name, events, **attributes):
+    # Wrap an iter_pipeline-style event generator in a trace. The trace is only
+    # active while the generator itself runs, not while the caller handles an
+    # event. It is finished and emitted as ("trace", trace) right before the
+    # "result" event.
+    trace = Trace(name, **attributes)
+    events = iter(events)
+    while True:
+        with trace.activate():
+            event = next(events, None)
+        if event is None:
+            return
+        if event[0] == "result":
+            finish_trace(trace)
+            yield "trace", trace
+        yield event
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port=None, host="0.0.0.0"):
+    # Serve METRICS on http://host:port/metrics from a daemon thread. The port
+    # defaults to EDD_METRICS_PORT; does nothing when neither is set, and only
+    # starts one server per process.
+    global _metrics_server
+    port = port or os.environ.get("EDD_METRICS_PORT")
+    if not port:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = METRICS.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, name="edd-metrics", daemon=True).start()
+            log_event("metrics_server_started", host=host, port=int(port))
+    return _metrics_server
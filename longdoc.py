@@ -0,0 +1,233 @@
+import mmap
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from analysis_result import AnalysisResult
+from analytics import EMOTION_LABELS, entropy
+from instrumentation import count, instrumented, stage
+from utils import (
+    _bare_ids,
+    _space_sensitive,
+    _split_long_sentence,
+    _with_special_tokens,
+    clean_text,
+    split_sentence_spans,
+)
+
+# Long-document mode: analyzes a UTF-8 file without ever holding all of it.
+#   - the file is read through mmap, one window of bytes at a time
+#   - each window is cleaned and segmented on its own; its last sentence may
+#     run into the next window, so it is held back and read again from there
+#   - chunks are kept as (start_byte, end_byte) spans into the file, not strings
+#   - emotion vectors and spans go to files in workdir, opened as np.memmap
+# Peak memory is set by the window size and the classification batch, not by
+# the document. Drift detection still needs the N x 7 scores (28 bytes per
+# chunk), which is small next to the text they came from.
+
+DEFAULT_WINDOW_BYTES = int(os.environ.get("EDD_LONGDOC_WINDOW_BYTES", 1 << 20))
+# Chunks classified (and written out) together
+FLUSH_CHUNKS = 256
+
+_SURROGATE_ESCAPES = re.compile("[\udc80-\udcff]")
+
+def _clean_with_offsets(raw):
+    # clean_text(raw), plus what is needed to map a position in the cleaned
+    # text back to a byte offset in raw's UTF-8 encoding
+    matches = list(re.finditer(r'\S+', raw))
+    if not matches:
+        return "", None
+    n = len(matches)
+    raw_starts = np.fromiter((m.start() for m in matches), dtype=np.int64, count=n)
+    lengths = np.fromiter((m.end() - m.start() for m in matches), dtype=np.int64, count=n)
+    clean_starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1]))
+    # Bytes per character; undecodable bytes come in as surrogate escapes, one byte each
+    codepoints = np.frombuffer(raw.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+    char_bytes = 1 + (codepoints >= 0x80) + (codepoints >= 0x800) + (codepoints >= 0x10000)
+    char_bytes[(codepoints >= 0xDC80) & (codepoints <= 0xDCFF)] = 1
+    byte_at = np.concatenate(([0], np.cumsum(char_bytes)))
+
+    def byte_offsets(positions, end=False):
+        # Byte offset of each cleaned-text position; with end=True, of the
+        # byte right after the character before each position
+        positions = np.asarray(positions, dtype=np.int64) - (1 if end else 0)
+        word = np.searchsorted(clean_starts, positions, side="right") - 1
+        raw_positions = raw_starts[word] + np.minimum(positions - clean_starts[word], lengths[word] - 1)
+        return byte_at[raw_positions + (1 if end else 0)]
+
+    cleaned = _SURROGATE_ESCAPES.sub("\ufffd", " ".join(m.group() for m in matches))
+    return cleaned, byte_offsets
+
+def iter_sentences(path, window_bytes=DEFAULT_WINDOW_BYTES, segmentation_mode=None):
+    # Yields (cleaned sentence, start_byte, end_byte, byte_offsets) for every
+    # sentence of the file; byte_offsets(positions, end) maps positions within
+    # the sentence to file offsets. A sentence longer than a whole window is
+    # cut at the window's end.
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = 0
+            while position < size:
+                end = min(position + window_bytes, size)
+                # Never cut a multi-byte character in two
+                while position < end < size and mm[end] & 0xC0 == 0x80:
+                    end -= 1
+                last = end >= size
+                with stage("read_window"):
+                    cleaned, byte_offsets = _clean_with_offsets(
+                        mm[position:end].decode("utf-8", errors="surrogateescape"))
+                with stage("segment_sentences"):
+                    spans = split_sentence_spans(cleaned, segmentation_mode) if cleaned else []
+                count("longdoc_windows")
+                if not last and len(spans) > 1:
+                    # The last sentence may go on in the next window, which starts with it
+                    spans, next_position = spans[:-1], position + int(byte_offsets([spans[-1][0]])[0])
+                else:
+                    next_position = end
+                if spans:
+                    starts = position + byte_offsets([start for start, _ in spans])
+                    ends = position + byte_offsets([end for _, end in spans], end=True)
+                    for (start, end_char), start_byte, end_byte in zip(spans, starts.tolist(), ends.tolist()):
+                        def sentence_offsets(positions, end=False, _start=start, _position=position,
+                                             _byte_offsets=byte_offsets):
+                            return _position + _byte_offsets(np.asarray(positions) + _start, end)
+                        yield cleaned[start:end_char], start_byte, end_byte, sentence_offsets
+                position = next_position
+
+class LongDocument:
+    # Result of analyze_long_document. spans (N x 2 byte offsets into the
+    # source file) and scores (N x 7, EMOTION_LABELS order) are read-only
+    # memmaps of files in workdir; chunk texts are read back from the source
+    # on demand.
+
+    def __init__(self, path, workdir, n_chunks, words, drifts, confusions, explanations):
+        self.path = path
+        self.workdir = workdir
+        self.n_chunks = n_chunks
+        self.words = words
+        self.drifts = drifts
+        self.confusions = confusions
+        self.explanations = explanations
+        self.spans = _open_memmap(os.path.join(workdir, "spans.i64"), np.int64, n_chunks, 2)
+        self.scores = _open_memmap(os.path.join(workdir, "scores.f32"), np.float32, n_chunks, len(EMOTION_LABELS))
+
+    def __len__(self):
+        return self.n_chunks
+
+    def chunk_text(self, idx):
+        start, end = self.spans[idx].tolist()
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return clean_text(f.read(end - start).decode("utf-8", errors="replace"))
+
+    def iter_chunks(self):
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start, end in self.spans:
+                yield clean_text(mm[int(start):int(end)].decode("utf-8", errors="replace"))
+
+    def to_result(self):
+        # Everything in memory, chunk texts included; only for documents that fit
+        return AnalysisResult(list(self.iter_chunks()), np.asarray(self.scores), self.drifts, self.confusions,
+                              self.explanations)
+
+    def cleanup(self):
+        # Drop the memmaps and delete workdir
+        self.spans = self.scores = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def _open_memmap(path, dtype, rows, columns):
+    if rows == 0:
+        return np.zeros((0, columns), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(rows, columns))
+
+@instrumented("analyze_long_document")
+def analyze_long_document(path, workdir=None, max_tokens=256, batch_size=16, window_bytes=DEFAULT_WINDOW_BYTES,
+                          segmentation_mode=None, confusion_threshold=0.75):
+    # run_pipeline for a UTF-8 file of any size; returns a LongDocument. Chunks
+    # pack sentences up to max_tokens like chunk_by_tokens (without overlap).
+    import ml_pipeline
+
+    workdir = workdir or tempfile.mkdtemp(prefix="edd-longdoc-")
+    os.makedirs(workdir, exist_ok=True)
+    tokenizer = ml_pipeline.get_emotion_classifier().tokenizer
+    budget = min(max_tokens, tokenizer.model_max_length - tokenizer.num_special_tokens_to_add())
+    # The sentence opening a chunk is tokenized again without the leading space, as in chunk_by_tokens
+    space_sensitive = _space_sensitive(tokenizer)
+
+    n_chunks = 0
+    words = 0
+    pending = []  # (text, token ids, start_byte, end_byte) of chunks not classified yet
+    current = []  # (sentence, token ids, start_byte, end_byte) of the open chunk
+    current_tokens = 0
+
+    with open(os.path.join(workdir, "scores.f32"), "wb") as scores_file, \
+            open(os.path.join(workdir, "spans.i64"), "wb") as spans_file:
+
+        def flush():
+            nonlocal n_chunks
+            if not pending:
+                return
+            vectors, _ = ml_pipeline.classify_emotions([text for text, _, _, _ in pending], batch_size=batch_size,
+                                                       token_ids=[ids for _, ids, _, _ in pending])
+            scores_file.write(np.asarray(vectors, dtype=np.float32).tobytes())
+            spans_file.write(np.asarray([(start, end) for _, _, start, end in pending], dtype=np.int64).tobytes())
+            n_chunks += len(pending)
+            pending.clear()
+
+        def close_chunk():
+            ids = [i for _, sentence_ids, _, _ in current for i in sentence_ids]
+            pending.append((" ".join(sentence for sentence, _, _, _ in current),
+                            _with_special_tokens(tokenizer, ids), current[0][2], current[-1][3]))
+            if len(pending) >= FLUSH_CHUNKS:
+                flush()
+
+        # Tokenized a window's worth of sentences at a time
+        sentences = iter_sentences(path, window_bytes, segmentation_mode)
+        while True:
+            batch = [sentence for _, sentence in zip(range(FLUSH_CHUNKS * 4), sentences)]
+            if not batch:
+                break
+            with stage("tokenize"):
+                batch_ids = tokenizer([" " + sentence for sentence, _, _, _ in batch],
+                                      add_special_tokens=False)["input_ids"]
+            for (sentence, start_byte, end_byte, sentence_offsets), ids in zip(batch, batch_ids):
+                words += len(sentence.split())
+                if current and current_tokens + len(ids) > budget:
+                    close_chunk()
+                    current, current_tokens = [], 0
+                if not current and space_sensitive:
+                    ids = _bare_ids(tokenizer, sentence)
+                if len(ids) > budget:
+                    for piece, piece_ids, start, end in _split_long_sentence(sentence, tokenizer, budget):
+                        current = [(piece, piece_ids, int(sentence_offsets([start])[0]),
+                                    int(sentence_offsets([end], end=True)[0]))]
+                        close_chunk()
+                    current = []
+                    continue
+                current.append((sentence, ids, start_byte, end_byte))
+                current_tokens += len(ids)
+        if current:
+            close_chunk()
+        flush()
+
+    count("chunks", n_chunks)
+    count("words", words)
+    scores = _open_memmap(os.path.join(workdir, "scores.f32"), np.float32, n_chunks, len(EMOTION_LABELS))
+    drifts = ml_pipeline.detect_drift(scores) if n_chunks else []
+    with stage("detect_confusion"):
+        # In blocks, so only the N x 7 scores are ever read at once, never more
+        confusions = []
+        for i in range(0, n_chunks, 1 << 16):
+            confusions.extend((i + np.flatnonzero(entropy(np.asarray(scores[i:i + (1 << 16)]))
+                                                  > confusion_threshold)).tolist())
+    # Explanations only look at the segments where drifts start and end
+    emotion_dicts = {idx: dict(zip(EMOTION_LABELS, scores[idx].tolist()))
+                     for start, end in drifts for idx in (start, end)}
+    explanations = ml_pipeline.build_explanations(drifts, confusions, emotion_dicts)
+    del scores
+    return LongDocument(path, workdir, n_chunks, words, drifts, confusions, explanations)
@@ -1,38 +1,254 @@
-from transformers import pipeline
-import ruptures as rpt
+from inference_backends import DEFAULT_BACKEND, load_text_classifier
+import drift
+from drift import drifts_from_change_points
 import numpy as np
-from utils import preprocess_and_chunk, generate_explanation
+import json
+import os
+from utils import chunk_by_tokens, generate_explanation, paragraph_starts, sentence_units
+from cache import DEFAULT_CACHE_DIR, ResultCache, RewriteCache, ScoreCache, content_key
+from inference_scheduler import InferenceScheduler
+from model_registry import ModelRegistry
+from analytics import EMOTION_LABELS, as_score_array, entropy
+from analysis_result import AnalysisResult
+from granularity import SentenceScores
+from instrumentation import METRICS, count, instrumented, log_event, observe, trace_events, traced
+import logging
+import threading
+import time
+from contextlib import nullcontext
 
-# Global variables to cache models
-_emotion_classifier = None
-_regenerator = None
+# Hub ids or local directories; benchmarks point these at small stand-in models
+EMOTION_MODEL = os.environ.get("EDD_EMOTION_MODEL", "j-hartmann/emotion-english-distilroberta-base")
+REWRITE_MODEL = os.environ.get("EDD_REWRITE_MODEL", "google/flan-t5-small")
+# eager / int8 / onnx, see inference_backends
+INFERENCE_BACKEND = DEFAULT_BACKEND
+# "auto" or one of drift.DRIFT_ALGORITHMS
+DRIFT_ALGORITHM = os.environ.get("EDD_DRIFT_ALGORITHM", "auto")
+
+_score_cache = None
+_rewrite_cache = None
+_result_cache = None
+_inference_scheduler = None
+_inference_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+def _load_regenerator():
+    from transformers import pipeline
+    # Using T5-small for speed and lower memory usage
+    return pipeline("text2text-generation", model=REWRITE_MODEL)
+
+# Every model of the process. EDD_MODEL_MEMORY_MB caps their total size
+# (0: no cap); a model unused for its EDD_*_IDLE_MINUTES is unloaded (0: never)
+MODELS = ModelRegistry(budget_bytes=int(float(os.environ.get("EDD_MODEL_MEMORY_MB", 0)) * 1024 * 1024))
+MODELS.register("emotion", lambda: load_text_classifier(EMOTION_MODEL, INFERENCE_BACKEND),
+                idle_timeout_s=float(os.environ.get("EDD_EMOTION_IDLE_MINUTES", 0)) * 60,
+                model=EMOTION_MODEL, backend=INFERENCE_BACKEND)
+MODELS.register("rewrite", _load_regenerator,
+                idle_timeout_s=float(os.environ.get("EDD_REWRITE_IDLE_MINUTES", 15)) * 60, model=REWRITE_MODEL)
 
 def get_emotion_classifier():
-    global _emotion_classifier
-    if _emotion_classifier is None:
-        _emotion_classifier = pipeline("text-classification", model="j-hartmann/emotion-english-distilroberta-base", top_k=None)
-    return _emotion_classifier
+    return MODELS.get("emotion")
 
 def get_regenerator():
-    global _regenerator
-    if _regenerator is None:
-        # Using T5-small for speed and lower memory usage
-        _regenerator = pipeline(model="google/flan-t5-small")
-    return _regenerator
+    return MODELS.get("rewrite")
+
+# Generation settings; part of every rewrite cache key
+REWRITE_PARAMS = {"max_length": 150, "do_sample": True, "temperature": 0.7}
+# Default sampling seed; a request can pass its own
+REWRITE_SEED = int(os.environ.get("EDD_REWRITE_SEED", 0))
+
+def get_rewrite_cache():
+    # Shared rewrite cache, disabled with EDD_REWRITE_CACHE=0
+    global _rewrite_cache
+    if _rewrite_cache is None and os.environ.get("EDD_REWRITE_CACHE", "1") != "0":
+        _rewrite_cache = RewriteCache(
+            REWRITE_MODEL, path=os.path.join(DEFAULT_CACHE_DIR, "rewrites.sqlite"),
+            memory_items=int(os.environ.get("EDD_REWRITE_CACHE_MEMORY_ITEMS", 1024)),
+            disk_items=int(os.environ.get("EDD_REWRITE_CACHE_DISK_ITEMS", 50_000)),
+        )
+    return _rewrite_cache
+
+def _rewrite_prompt(text, target_emotion):
+    return f"Rewrite the following text to have a {target_emotion} tone: {text}"
+
+def _rewrite_params(seed):
+    return {**REWRITE_PARAMS, "seed": REWRITE_SEED if seed is None else seed}
+
+def cached_rewrites(texts, target_emotion, seed=None):
+    # Rewrites that already exist, by index into texts; never generates
+    cache = get_rewrite_cache()
+    if cache is None or not texts or not target_emotion or target_emotion.startswith("None"):
+        return {}
+    params = _rewrite_params(seed)
+    keys = [cache.key(text, target_emotion, params) for text in texts]
+    found = cache.get_texts(keys)
+    return {idx: found[key] for idx, key in enumerate(keys) if key in found}
+
+def _sampling_processor(prompts, params):
+    # Sampling as a logits processor: the Gumbel-max trick with noise drawn
+    # from one generator per row, seeded by the sampling seed and that row's
+    # prompt. Run with do_sample=False, generate then picks exactly what
+    # sampling at params["temperature"] would, without the global RNG.
+    import torch
+    from transformers import LogitsProcessor
 
-def regenerate_text(text, target_emotion):
+    class SeededSampling(LogitsProcessor):
+        def __init__(self):
+            self.generators = [torch.Generator().manual_seed(int(content_key(str(params["seed"]), prompt)[:8], 16))
+                               for prompt in prompts]
+
+        def __call__(self, input_ids, scores):
+            noise = torch.stack([-torch.empty(scores.shape[-1]).exponential_(generator=generator).log()
+                                 for generator in self.generators])
+            return scores / params["temperature"] + noise.to(scores.device, scores.dtype)
+
+    return SeededSampling()
+
+def _generation_kwargs(prompts, params):
+    if not params["do_sample"]:
+        return {"max_length": params["max_length"], "do_sample": False}
+    from transformers import LogitsProcessorList
+    return {"max_length": params["max_length"], "do_sample": False,
+            "logits_processor": LogitsProcessorList([_sampling_processor(prompts, params)])}
+
+def _generate_rewrites(regenerator, prompts, params):
+    # One batch of prompts, with the rewrite model to itself
+    import torch
+    model, tokenizer = regenerator.model, regenerator.tokenizer
+    with MODELS.using("rewrite", exclusive=True), torch.no_grad():
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True, truncation=True,
+                           return_token_type_ids=False).to(model.device)
+        output_ids = model.generate(**inputs, **_generation_kwargs(prompts, params))
+        return tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+@instrumented("regenerate_texts")
+def regenerate_texts(texts, target_emotion, batch_size=8, seed=None, use_cache=True):
+    # Rewrite every text towards target_emotion. Cached rewrites are reused and
+    # each distinct uncached text is generated once, in batches of prompts of
+    # similar length. Each prompt is sampled from its own generator seeded by
+    # the request's seed and that prompt, so a rewrite is reproducible whatever
+    # it was batched or run concurrently with; the cache then pins whatever was
+    # generated first. Returns one rewrite (or None, if generation failed) per
+    # text.
+    if not texts:
+        return []
     if not target_emotion or target_emotion.startswith("None"):
-        return None
+        return [None] * len(texts)
     
-    regenerator = get_regenerator()
-    prompt = f"Rewrite the following text to have a {target_emotion} tone: {text}"
-    try:
-        # Limit max_length to prevent AI load
-        result = regenerator(prompt, max_length=150, do_sample=True, temperature=0.7)[0]['generated_text']
-        return result
-    except Exception as e:
-        print(f"Error in text regeneration: {str(e)}")
+    params = _rewrite_params(seed)
+    cache = get_rewrite_cache() if use_cache else None
+    keys = [cache.key(text, target_emotion, params) if cache else content_key(target_emotion, text) for text in texts]
+    rewrites = cache.get_texts(keys) if cache else {}
+    misses = {}
+    for idx, key in enumerate(keys):
+        if key not in rewrites and key not in misses:
+            misses[key] = idx
+    count("rewrite_cache_hits", sum(key in rewrites for key in keys))
+    count("rewrite_cache_misses", len(misses))
+    
+    if misses:
+        generated = {}
+        with MODELS.using("rewrite") as regenerator:
+            miss_keys = list(misses)
+            prompts = [_rewrite_prompt(texts[misses[key]], target_emotion) for key in miss_keys]
+            try:
+                lengths = [len(ids) for ids in regenerator.tokenizer(prompts, truncation=True)["input_ids"]]
+            except Exception as e:
+                log_event("regenerate_failed", level=logging.WARNING, target_emotion=target_emotion,
+                          texts=len(prompts), error=str(e))
+                lengths = None
+            order = sorted(range(len(prompts)), key=lengths.__getitem__) if lengths is not None else []
+            for b in range(0, len(order), batch_size):
+                batch = order[b:b + batch_size]
+                observe("rewrite_batch_size", len(batch))
+                try:
+                    outputs = _generate_rewrites(regenerator, [prompts[i] for i in batch], params)
+                except Exception as e:
+                    log_event("regenerate_failed", level=logging.WARNING, target_emotion=target_emotion,
+                              texts=len(batch), error=str(e))
+                    continue
+                for i, output in zip(batch, outputs):
+                    generated[miss_keys[i]] = output
+        if cache is not None:
+            cache.put_texts(generated)
+        rewrites.update(generated)
+    return [rewrites.get(key) for key in keys]
+
+def iter_regenerate_text(text, target_emotion, seed=None, cancel_event=None, use_cache=True):
+    # Streaming regenerate_text: yields the rewrite piece by piece as the model
+    # decodes it. Generation runs on a background thread and stops at the next
+    # token once cancel_event is set, or once the caller stops iterating. A
+    # finished rewrite goes into the rewrite cache; a cached one is yielded
+    # whole. Time to first token is observed as rewrite_ttft_seconds.
+    if not target_emotion or target_emotion.startswith("None"):
+        return
+    params = _rewrite_params(seed)
+    cache = get_rewrite_cache() if use_cache else None
+    key = cache.key(text, target_emotion, params) if cache else None
+    cached = cache.get_texts([key]).get(key) if cache else None
+    if cached is not None:
+        count("rewrite_cache_hits")
+        yield cached
+        return
+    count("rewrite_cache_misses")
+    
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+    # Leased for the whole stream, so the model cannot be unloaded between
+    # loading it and the end of generation
+    with MODELS.using("rewrite") as regenerator:
+        model, tokenizer = regenerator.model, regenerator.tokenizer
+        cancel_event = cancel_event or threading.Event()
+        prompt = _rewrite_prompt(text, target_emotion)
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+        
+        class StopOnCancel(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return torch.full((input_ids.shape[0],), cancel_event.is_set(), dtype=torch.bool, device=input_ids.device)
+        
+        def generate():
+            try:
+                # Seeded like the same prompt in regenerate_texts, so both give one rewrite
+                with MODELS.using("rewrite", exclusive=True), torch.no_grad():
+                    inputs = tokenizer(prompt, return_tensors="pt", truncation=True,
+                                       return_token_type_ids=False).to(model.device)
+                    model.generate(**inputs, streamer=streamer, stopping_criteria=StoppingCriteriaList([StopOnCancel()]),
+                                   **_generation_kwargs([prompt], params))
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+        
+        start = time.perf_counter()
+        thread = threading.Thread(target=generate, name="edd-rewrite-stream", daemon=True)
+        thread.start()
+        pieces = []
+        try:
+            for piece in streamer:
+                if not piece:
+                    continue
+                if not pieces:
+                    observe("rewrite_ttft_seconds", time.perf_counter() - start)
+                pieces.append(piece)
+                yield piece
+        except GeneratorExit:
+            # The caller went away (closed the generator, or an exception unwound it)
+            cancel_event.set()
+            raise
+        thread.join()
+        observe("rewrite_stream_seconds", time.perf_counter() - start)
+        if errors:
+            log_event("regenerate_failed", level=logging.WARNING, target_emotion=target_emotion, error=str(errors[0]))
+        elif cancel_event.is_set():
+            count("rewrites_cancelled")
+        elif cache is not None and pieces:
+            cache.put_texts({key: "".join(pieces).strip()})
+
+@instrumented("regenerate_text")
+def regenerate_text(text, target_emotion, seed=None):
+    if not target_emotion or target_emotion.startswith("None"):
         return None
+    return regenerate_texts([text], target_emotion, seed=seed)[0]
 
 # Map Hartmann's 7 emotions to user labels
 emotion_map = {
@@ -45,89 +261,334 @@ emotion_map = {
     "neutral": "Neutral"
 }
 
-def classify_emotions(chunks):
-    emotion_vectors = []
-    emotion_dicts = []
-    emotion_classifier = get_emotion_classifier()
+# Bump when _map_scores changes so scores cached under the old mapping are not reused
+_MAPPING_REVISION = 1
+MAPPING_VERSION = content_key(json.dumps(emotion_map, sort_keys=True), json.dumps(EMOTION_LABELS), str(_MAPPING_REVISION))[:16]
+
+def get_score_cache():
+    # Shared chunk score cache, disabled with EDD_SCORE_CACHE=0
+    global _score_cache
+    if _score_cache is None and os.environ.get("EDD_SCORE_CACHE", "1") != "0":
+        # Quantized and exported models score slightly differently, so the backend is part of the model id
+        _score_cache = ScoreCache(
+            f"{EMOTION_MODEL}@{INFERENCE_BACKEND}", MAPPING_VERSION,
+            path=os.path.join(DEFAULT_CACHE_DIR, "scores.sqlite"),
+            memory_items=int(os.environ.get("EDD_SCORE_CACHE_MEMORY_ITEMS", 4096)),
+            disk_items=int(os.environ.get("EDD_SCORE_CACHE_DISK_ITEMS", 200_000)),
+        )
+    return _score_cache
+
+# Bump when chunking, drift or confusion detection change, so memoized
+# analyses from the old code are not reused
+_PIPELINE_REVISION = 1
+PIPELINE_VERSION = content_key(EMOTION_MODEL, INFERENCE_BACKEND, MAPPING_VERSION, DRIFT_ALGORITHM,
+                               str(_PIPELINE_REVISION))[:16]
+
+def get_result_cache():
+    # Process-wide memo of whole analyses, disabled with EDD_RESULT_CACHE=0
+    global _result_cache
+    if _result_cache is None and os.environ.get("EDD_RESULT_CACHE", "1") != "0":
+        _result_cache = ResultCache(
+            max_items=int(os.environ.get("EDD_RESULT_CACHE_ITEMS", 32)),
+            max_bytes=int(float(os.environ.get("EDD_RESULT_CACHE_MB", 256)) * 1024 * 1024),
+        )
+    return _result_cache
+
+def analysis_key(text, target_emotion=None, **settings):
+    # Memo key of one analysis: the text, target emotion, pipeline version and
+    # any settings that change the result (max_tokens, segmentation, ...)
+    return content_key(PIPELINE_VERSION, target_emotion or "", json.dumps(settings, sort_keys=True), text)
+
+def _map_scores(scores):
+    # Map Hartmann results to our labels
+    mapped_scores = {label: 0.0 for label in EMOTION_LABELS}
+    
+    for s in scores:
+        if isinstance(s, dict) and 'label' in s and 'score' in s:
+            label = emotion_map.get(s['label'], 'Neutral')
+            mapped_scores[label] += s['score']
     
-    # Define our labels
-    labels = ["Inspirational", "Informative", "Neutral", "Empathetic", "Assertive", "Aggressive", "Defensive"]
+    # Bias Correction: If Neutral is dominant but low intensity
+    if mapped_scores["Neutral"] > 0.4 and mapped_scores["Neutral"] < 0.8:
+        other_max = max([v for k, v in mapped_scores.items() if k != "Neutral"])
+        if other_max > 0.1:
+            # Slightly boost the more "active" emotions to reduce neutral bias
+            mapped_scores["Neutral"] *= 0.8
+    
+    return mapped_scores
 
-    for idx, chunk in enumerate(chunks):
-        try:
-            raw_result = emotion_classifier(chunk)
-            
-            # Extract scores
-            if isinstance(raw_result, list) and len(raw_result) > 0:
-                scores = raw_result[0] if isinstance(raw_result[0], list) else raw_result
+def _length_sorted_order(chunks, tokenizer):
+    # Sort chunk indices by token length so every batch holds chunks of similar
+    # length and dynamic padding (pad to the longest in the batch) stays cheap
+    lengths = [len(ids) for ids in tokenizer(chunks, truncation=True)["input_ids"]]
+    return sorted(range(len(chunks)), key=lengths.__getitem__)
+
+def _classify_token_ids(emotion_classifier, token_ids, order, batch_size):
+    # Run already tokenized chunks straight through the model, skipping the
+    # pipeline's own tokenization. Returns results in the pipeline's format.
+    import torch
+    model = emotion_classifier.model
+    tokenizer = emotion_classifier.tokenizer
+    id2label = model.config.id2label
+    raw_results = [None] * len(token_ids)
+    with torch.no_grad():
+        for b in range(0, len(order), batch_size):
+            batch_idx = order[b:b + batch_size]
+            # Dynamic padding: pad only to the longest chunk in this batch
+            batch = tokenizer.pad({"input_ids": [token_ids[i] for i in batch_idx]}, return_tensors="pt")
+            batch = {k: v.to(model.device) for k, v in batch.items()}
+            probs = torch.softmax(model(**batch).logits, dim=-1).tolist()
+            for idx, row in zip(batch_idx, probs):
+                raw_results[idx] = [{"label": id2label[j], "score": p} for j, p in enumerate(row)]
+    return raw_results
+
+@instrumented("model_inference")
+def _score_chunks(chunks, batch_size, token_ids=None, emotion_classifier=None):
+    # Leased for the whole call, so an idle or budget eviction cannot unload it mid-batch
+    lease = nullcontext(emotion_classifier) if emotion_classifier is not None else MODELS.using("emotion")
+    count("model_chunks", len(chunks))
+    for b in range(0, len(chunks), batch_size):
+        observe("model_batch_size", min(batch_size, len(chunks) - b))
+    
+    try:
+        with lease as emotion_classifier:
+            if token_ids is not None:
+                # Chunks from chunk_by_tokens come with their ids, no need to tokenize again
+                order = sorted(range(len(token_ids)), key=lambda i: len(token_ids[i]))
+                raw_results = _classify_token_ids(emotion_classifier, token_ids, order, batch_size)
             else:
-                scores = []
-            
-            # Map Hartmann results to our labels
-            mapped_scores = {label: 0.0 for label in labels}
-            
-            for s in scores:
-                if isinstance(s, dict) and 'label' in s and 'score' in s:
-                    label = emotion_map.get(s['label'], 'Neutral')
-                    mapped_scores[label] += s['score']
-            
-            # Bias Correction: If Neutral is dominant but low intensity
-            if mapped_scores["Neutral"] > 0.4 and mapped_scores["Neutral"] < 0.8:
-                other_max = max([v for k, v in mapped_scores.items() if k != "Neutral"])
-                if other_max > 0.1:
-                    # Slightly boost the more "active" emotions to reduce neutral bias
-                    mapped_scores["Neutral"] *= 0.8
-            
-            emotion_vectors.append(list(mapped_scores.values()))
-            emotion_dicts.append(mapped_scores)
-            
-        except Exception as e:
-            print(f"ERROR in chunk {idx}: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            raise
+                order = _length_sorted_order(chunks, emotion_classifier.tokenizer)
+                # The pipeline batches consecutive inputs and pads each batch on its own,
+                # so feeding length-sorted chunks gives us length-bucketed batches
+                sorted_results = emotion_classifier([chunks[i] for i in order], batch_size=batch_size, truncation=True)
+                # Put the results back in document order
+                raw_results = [None] * len(chunks)
+                for idx, raw_result in zip(order, sorted_results):
+                    raw_results[idx] = raw_result
+    except Exception as e:
+        log_event("classify_failed", level=logging.ERROR, exc_info=True, chunks=len(chunks), error=str(e))
+        raise
+    
+    emotion_vectors = []
+    for raw_result in raw_results:
+        # Extract scores
+        if isinstance(raw_result, list) and len(raw_result) > 0:
+            scores = raw_result[0] if isinstance(raw_result[0], list) else raw_result
+        else:
+            scores = []
+        emotion_vectors.append(list(_map_scores(scores).values()))
+    return emotion_vectors
+
+def get_inference_scheduler():
+    # Shared micro-batching scheduler for every session in this process.
+    # Disabled with EDD_INFERENCE_SCHEDULER=0; recreated after a fork since the
+    # worker thread does not survive it.
+    global _inference_scheduler, _inference_scheduler_pid
+    if os.environ.get("EDD_INFERENCE_SCHEDULER", "1") == "0":
+        return None
+    with _scheduler_lock:
+        if _inference_scheduler is None or _inference_scheduler_pid != os.getpid():
+            model_batch_size = int(os.environ.get("EDD_MODEL_BATCH_SIZE", 16))
+            _inference_scheduler = InferenceScheduler(
+                lambda chunks, token_ids: _score_chunks(chunks, model_batch_size, token_ids),
+                max_batch_size=int(os.environ.get("EDD_SCHEDULER_MAX_BATCH", 32)),
+                max_wait_ms=float(os.environ.get("EDD_SCHEDULER_MAX_WAIT_MS", 10)),
+            )
+            _inference_scheduler_pid = os.getpid()
+    return _inference_scheduler
+
+def _score_uncached(chunks, batch_size, token_ids=None):
+    # With the scheduler on, its batch settings apply instead of batch_size
+    scheduler = get_inference_scheduler()
+    if scheduler is None:
+        return _score_chunks(chunks, batch_size, token_ids)
+    futures = scheduler.submit_many(chunks, token_ids)
+    return [future.result() for future in futures]
+
+@instrumented("classify_emotions")
+def classify_emotions(chunks, batch_size=16, token_ids=None, use_cache=True):
+    if not chunks:
+        return [], []
     
+    count("chunks_classified", len(chunks))
+    cache = get_score_cache() if use_cache else None
+    if cache is None:
+        emotion_vectors = _score_uncached(chunks, batch_size, token_ids)
+    else:
+        keys = [cache.key(chunk) for chunk in chunks]
+        cached = cache.get_vectors(keys)
+        # Only cache misses go to the model, and each distinct chunk only once
+        misses = {}
+        for idx, key in enumerate(keys):
+            if key not in cached and key not in misses:
+                misses[key] = idx
+        count("score_cache_hits", sum(key in cached for key in keys))
+        count("score_cache_misses", len(misses))
+        if misses:
+            miss_idx = list(misses.values())
+            miss_ids = [token_ids[i] for i in miss_idx] if token_ids is not None else None
+            scored = dict(zip(misses, _score_uncached([chunks[i] for i in miss_idx], batch_size, miss_ids)))
+            cache.put_vectors(scored)
+            cached.update(scored)
+        emotion_vectors = [list(cached[key]) for key in keys]
+    
+    emotion_dicts = [dict(zip(EMOTION_LABELS, vec)) for vec in emotion_vectors]
     return emotion_vectors, emotion_dicts
 
-def detect_drift(emotion_vectors):
-    # Use change-point detection
-    signal = np.array(emotion_vectors)
-    if len(signal) < 2:
-        return []
-    try:
-        algo = rpt.Pelt(model="rbf").fit(signal)
-        change_points = algo.predict(pen=10)  # Penalty for fewer points
-        drifts = []
-        for i in range(1, len(change_points)):
-            start = change_points[i-1]
-            end = change_points[i]
-            if end < len(emotion_vectors):
-                drifts.append((start, end))
-        return drifts
-    except:
-        return []
+def iter_classify_emotions(chunks, batch_size=16, token_ids=None, use_cache=True, window=None):
+    # Classify in document order, one window of chunks at a time, so callers can
+    # show results while the rest of the document is still being scored. The
+    # first window is a single batch to get something on screen quickly.
+    window = window or batch_size * 4
+    start = 0
+    size = batch_size
+    while start < len(chunks):
+        end = min(start + size, len(chunks))
+        window_ids = token_ids[start:end] if token_ids is not None else None
+        emotion_vectors, emotion_dicts = classify_emotions(chunks[start:end], batch_size=batch_size,
+                                                           token_ids=window_ids, use_cache=use_cache)
+        yield start, emotion_vectors, emotion_dicts
+        start = end
+        size = window
+
+@instrumented("detect_drift")
+def detect_change_points(emotion_vectors, pen=None, algorithm=None):
+    # Use change-point detection. Returns the segment ends, the last one being len(emotion_vectors).
+    # Failures raise drift.DriftDetectionError instead of silently reporting no drifts.
+    return drift.detect_change_points(as_score_array(emotion_vectors), algorithm=algorithm or DRIFT_ALGORITHM, pen=pen)
+
+@instrumented("detect_drift")
+def compute_drift_path(emotion_vectors, pen=None, algorithm=None):
+    # Change points for a range of penalties around pen, sharing one cost fit;
+    # see drift.change_point_path
+    return drift.change_point_path(as_score_array(emotion_vectors), algorithm=algorithm or DRIFT_ALGORITHM, pen=pen)
 
+def detect_drift(emotion_vectors, pen=None, algorithm=None):
+    change_points = detect_change_points(emotion_vectors, pen=pen, algorithm=algorithm)
+    return drifts_from_change_points(change_points, len(emotion_vectors))
+
+@instrumented("detect_confusion")
 def detect_confusion(emotion_vectors, threshold=0.75):
-    confusions = []
-    for idx, vec in enumerate(emotion_vectors):
-        p = np.array(vec)
-        p = p / (p.sum() + 1e-9)
-        entropy = -sum(x * np.log(x + 1e-9) for x in p if x > 0)
-        if entropy > threshold:
-            confusions.append(idx)
-    return confusions
-
-def run_pipeline(text, target_emotion=None):
-    chunks = preprocess_and_chunk(text)
-    emotion_vectors, emotion_dicts = classify_emotions(chunks)
-    drifts = detect_drift(emotion_vectors)
-    confusions = detect_confusion(emotion_vectors)
-    
-    # Generate explanations
+    if len(emotion_vectors) == 0:
+        return []
+    return np.flatnonzero(entropy(as_score_array(emotion_vectors)) > threshold).tolist()
+
+@instrumented("build_explanations")
+def build_explanations(drifts, confusions, emotion_dicts):
     explanations = {}
     for start, end in drifts:
         explanations[f"drift_{start}_{end}"] = generate_explanation("drift", start, emotion_dicts[start], emotion_dicts[end])
     for idx in confusions:
         explanations[f"confusion_{idx}"] = generate_explanation("confusion", idx, {}, {})
-            
-    return chunks, emotion_vectors, drifts, confusions, explanations
\ No newline at end of file
+    return explanations
+
+@instrumented("score_sentences")
+def score_sentences(text, batch_size=32, max_tokens=256, segmentation_mode=None, use_cache=True):
+    # One classifier pass over every sentence; see granularity.SentenceScores
+    # for the curves built from it
+    tokenizer = get_emotion_classifier().tokenizer
+    sentences, token_ids, spans = sentence_units(text, tokenizer, max_tokens=max_tokens,
+                                                 segmentation_mode=segmentation_mode)
+    emotion_vectors, _ = classify_emotions(sentences, batch_size=batch_size, token_ids=token_ids, use_cache=use_cache)
+    paragraph_ids = np.searchsorted(paragraph_starts(text), [start for start, _ in spans], side="right") - 1
+    n_special = tokenizer.num_special_tokens_to_add()
+    token_counts = [len(ids) - n_special for ids in token_ids]
+    return SentenceScores(sentences, spans, token_counts, emotion_vectors, paragraph_ids)
+
+def result_at(chunks, emotion_vectors, drift_path, path_index):
+    # AnalysisResult of already scored segments, with the drifts of one entry of their drift path
+    scores = as_score_array(emotion_vectors)
+    drifts = drift_path.drifts_at(path_index)
+    confusions = detect_confusion(scores)
+    emotion_dicts = [dict(zip(EMOTION_LABELS, vec)) for vec in scores.tolist()]
+    return AnalysisResult(chunks, scores, drifts, confusions, build_explanations(drifts, confusions, emotion_dicts))
+
+def analyze_granularity(sentence_scores, granularity="chunk", **params):
+    # Drift and confusion detection on the curve at one granularity, without
+    # any inference. params go to SentenceScores.groups (max_tokens, window,
+    # step). Returns (AnalysisResult, DriftPath).
+    chunks, scores = sentence_scores.curve(granularity, **params)
+    drift_path = compute_drift_path(scores)
+    return result_at(chunks, scores, drift_path, drift_path.default_index), drift_path
+
+def iter_pipeline(text, target_emotion=None, batch_size=16, max_tokens=256, overlap_sentences=0, segmentation_mode=None):
+    # Streaming version of run_pipeline. Yields, in order:
+    #   ("chunks", chunks)
+    #   ("scores", start_index, emotion_vectors, emotion_dicts)  for every window of chunks
+    #   ("drift_path", drift.DriftPath)  drifts for every sensitivity setting
+    #   ("trace", instrumentation.Trace)  timings and counters of this run
+    #   ("result", AnalysisResult)
+    events = _pipeline_events(text, batch_size, max_tokens, overlap_sentences, segmentation_mode)
+    yield from trace_events("iter_pipeline", events, characters=len(text))
+
+def _pipeline_events(text, batch_size, max_tokens, overlap_sentences, segmentation_mode):
+    tokenizer = get_emotion_classifier().tokenizer
+    chunks, token_ids = chunk_by_tokens(text, tokenizer, max_tokens=max_tokens, overlap_sentences=overlap_sentences,
+                                        segmentation_mode=segmentation_mode)
+    yield "chunks", chunks
+    
+    emotion_vectors, emotion_dicts = [], []
+    for start, vectors, dicts in iter_classify_emotions(chunks, batch_size=batch_size, token_ids=token_ids):
+        emotion_vectors.extend(vectors)
+        emotion_dicts.extend(dicts)
+        yield "scores", start, vectors, dicts
+    
+    drift_path = compute_drift_path(emotion_vectors)
+    yield "drift_path", drift_path
+    drifts = drift_path.drifts_at(drift_path.default_index)
+    confusions = detect_confusion(emotion_vectors)
+    explanations = build_explanations(drifts, confusions, emotion_dicts)
+    yield "result", AnalysisResult(chunks, emotion_vectors, drifts, confusions, explanations)
+
+def run_pipeline(text, target_emotion=None, batch_size=16, max_tokens=256, overlap_sentences=0, segmentation_mode=None,
+                 return_trace=False):
+    # Returns an AnalysisResult, which still unpacks as (chunks, emotion_vectors,
+    # drifts, confusions, explanations). With return_trace=True, returns
+    # (result, trace) with the instrumentation.Trace of this run.
+    with traced("run_pipeline", characters=len(text)) as trace:
+        # Chunk on the classifier's own tokens so no chunk is silently truncated
+        tokenizer = get_emotion_classifier().tokenizer
+        chunks, token_ids = chunk_by_tokens(text, tokenizer, max_tokens=max_tokens, overlap_sentences=overlap_sentences,
+                                            segmentation_mode=segmentation_mode)
+        emotion_vectors, emotion_dicts = classify_emotions(chunks, batch_size=batch_size, token_ids=token_ids)
+        drifts = detect_drift(emotion_vectors)
+        confusions = detect_confusion(emotion_vectors)
+        
+        # Generate explanations
+        explanations = build_explanations(drifts, confusions, emotion_dicts)
+        result = AnalysisResult(chunks, emotion_vectors, drifts, confusions, explanations)
+    
+    if return_trace:
+        return result, trace
+    return result
+
+def _runtime_metrics():
+    # Cache and scheduler state for the Prometheus output
+    if _score_cache is not None:
+        stats = _score_cache.stats()
+        yield "score_cache_hit_rate", "gauge", "Share of score cache lookups served from memory or disk", \
+            [({}, stats["hit_rate"])]
+        yield "score_cache_items", "gauge", "Entries in each score cache tier", \
+            [({"tier": "memory"}, stats["memory_items"]), ({"tier": "disk"}, stats["disk_items"])]
+    if _result_cache is not None:
+        stats = _result_cache.stats()
+        yield "result_cache_hit_rate", "gauge", "Share of analyses served from the result memo", \
+            [({}, stats["hit_rate"])]
+        yield "result_cache_items", "gauge", "Analyses held in the result memo", [({}, stats["items"])]
+        yield "result_cache_bytes", "gauge", "Estimated size of the analyses in the result memo", \
+            [({}, stats["bytes"])]
+        yield "result_cache_evictions_total", "counter", "Analyses dropped from the result memo to stay in bounds", \
+            [({}, stats["evictions"])]
+    if _inference_scheduler is not None and _inference_scheduler_pid == os.getpid():
+        metrics = _inference_scheduler.metrics()
+        yield "scheduler_queue_depth", "gauge", "Chunks waiting for the inference scheduler", \
+            [({}, metrics["queue_depth"])]
+        yield "scheduler_batches_total", "counter", "Micro-batches run by the inference scheduler", \
+            [({}, metrics["batches"])]
+        yield "scheduler_mean_batch_size", "gauge", "Mean micro-batch size over the last 1000 batches", \
+            [({}, metrics["mean_batch_size"])]
+        yield "scheduler_queue_wait_p99_seconds", "gauge", "99th percentile queue wait over the last 1000 chunks", \
+            [({}, metrics["queue_wait_p99_ms"] / 1000)]
+
+METRICS.register_collector(_runtime_metrics)
+METRICS.register_collector(MODELS.metrics)
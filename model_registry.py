@@ -0,0 +1,278 @@
+import functools
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import METRICS, log_event, stage
+
+# Models loaded on first use and shared by the whole process:
+#   - each model is loaded once, under its own lock, however many threads ask
+#   - its resident size is measured at load time (parameter and buffer bytes
+#     of a torch model, otherwise the growth of the process RSS)
+#   - past the memory budget, the models idle the longest are unloaded first
+#   - a model with an idle timeout is unloaded once unused for that long
+# Models being used inside using() are never unloaded. A plain get() only
+# marks the model as used now, so callers that hold on to a model for a long
+# call (generation, a batch of inference) should use using() instead.
+# A model's tokenizer is shared by every thread, so each call into it holds
+# the model's use lock; using(name, exclusive=True) holds that lock for the
+# whole block, for calls such as generation that must not interleave.
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def model_bytes(model):
+    # Parameter and buffer bytes of a torch model or a pipeline around one;
+    # None when model is something else (an ONNX session, ...)
+    module = getattr(model, "model", model)
+    if not hasattr(module, "parameters") or not hasattr(module, "buffers"):
+        return None
+    try:
+        tensors = list(module.parameters()) + list(module.buffers())
+    except TypeError:
+        return None
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+class SerializedTokenizer:
+    # Tokenizer proxy whose method calls hold lock. A fast tokenizer fails with
+    # "Already borrowed" when one thread encodes while another encodes or
+    # changes its truncation and padding settings.
+
+    def __init__(self, tokenizer, lock):
+        object.__setattr__(self, "_tokenizer", tokenizer)
+        object.__setattr__(self, "_lock", lock)
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            return self._tokenizer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        value = getattr(self._tokenizer, name)
+        if not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return value(*args, **kwargs)
+        return locked
+
+    def __setattr__(self, name, value):
+        setattr(self._tokenizer, name, value)
+
+    def __len__(self):
+        return len(self._tokenizer)
+
+class _Entry:
+    def __init__(self, name, load, idle_timeout_s, labels):
+        self.name = name
+        self.load = load
+        self.idle_timeout_s = idle_timeout_s
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.use_lock = threading.RLock()
+        self.model = None
+        self.bytes = 0
+        self.last_used = 0.0
+        self.in_use = 0
+        self.loads = 0
+        self.unloads = 0
+
+class ModelRegistry:
+    # budget_bytes=None (or 0) means no budget. Listeners are called as
+    # listener(event, name, info) with event "load" or "unload".
+
+    def __init__(self, budget_bytes=None, reap_interval_s=30.0):
+        self.budget_bytes = budget_bytes or None
+        self.reap_interval_s = reap_interval_s
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._reaper = None
+        self._reaper_pid = None
+        self._stop = threading.Event()
+
+    def register(self, name, load, idle_timeout_s=None, **labels):
+        # load() returns the model; labels go into events, logs and metrics
+        with self._lock:
+            if name in self._entries:
+                raise ValueError(f"Model {name!r} is already registered")
+            self._entries[name] = _Entry(name, load, idle_timeout_s or None, labels)
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def _emit(self, event, entry, **info):
+        info = {**entry.labels, "bytes": entry.bytes, **info}
+        log_event(f"model_{event}ed", kind=entry.name, **info)
+        for listener in list(self._listeners):
+            try:
+                listener(event, entry.name, info)
+            except Exception:
+                logging.getLogger(__name__).exception("model registry listener failed")
+
+    def get(self, name):
+        entry = self._entries[name]
+        model = entry.model
+        if model is None:
+            with entry.lock:
+                model = entry.model
+                if model is None:
+                    model = self._load(entry)
+        entry.last_used = time.monotonic()
+        return model
+
+    @contextmanager
+    def using(self, name, exclusive=False):
+        # The model, kept resident until the block exits; with exclusive=True
+        # no other thread uses it (or its tokenizer) until then
+        entry = self._entries[name]
+        with self._lock:
+            entry.in_use += 1
+        try:
+            if exclusive:
+                with entry.use_lock:
+                    yield self.get(name)
+            else:
+                yield self.get(name)
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    def _load(self, entry):
+        # Called with entry.lock held; other models keep loading and serving
+        if entry.bytes:
+            # Make room for what it took last time before loading it again
+            self._enforce_budget(entry.bytes, keep=entry.name)
+        rss_before = _rss_bytes()
+        start = time.perf_counter()
+        with stage(f"load_{entry.name}_model"):
+            model = entry.load()
+        if getattr(model, "tokenizer", None) is not None:
+            model.tokenizer = SerializedTokenizer(model.tokenizer, entry.use_lock)
+        elapsed = time.perf_counter() - start
+        size = model_bytes(model)
+        entry.bytes = size if size is not None else max(_rss_bytes() - rss_before, 0)
+        entry.model = model
+        entry.loads += 1
+        entry.last_used = time.monotonic()
+        METRICS.set_gauge("model_load_seconds", elapsed, kind=entry.name, **entry.labels)
+        self._emit("load", entry, seconds=elapsed)
+        self._enforce_budget(0, keep=entry.name)
+        if entry.idle_timeout_s:
+            self._start_reaper()
+        return model
+
+    def unload(self, name, reason="manual", wait=True):
+        # False if the model is not loaded, in use, or (wait=False) busy loading
+        entry = self._entries[name]
+        if not entry.lock.acquire(blocking=wait):
+            return False
+        try:
+            if entry.model is None:
+                return False
+            with self._lock:
+                if entry.in_use:
+                    return False
+                entry.model = None
+            entry.unloads += 1
+        finally:
+            entry.lock.release()
+        METRICS.count(f"model_unloads_{reason}")
+        self._emit("unload", entry, reason=reason, idle_s=time.monotonic() - entry.last_used)
+        _free_memory()
+        return True
+
+    def resident_bytes(self):
+        return sum(entry.bytes for entry in self._entries.values() if entry.model is not None)
+
+    def _enforce_budget(self, incoming_bytes, keep=None):
+        # Unload the longest idle models until incoming_bytes more fit the budget
+        if not self.budget_bytes:
+            return
+        skipped = {keep}
+        while self.resident_bytes() + incoming_bytes > self.budget_bytes:
+            with self._lock:
+                candidates = [entry for entry in self._entries.values()
+                              if entry.model is not None and not entry.in_use and entry.name not in skipped]
+            if not candidates:
+                log_event("model_budget_exceeded", level=logging.WARNING, resident_bytes=self.resident_bytes(),
+                          incoming_bytes=incoming_bytes, budget_bytes=self.budget_bytes)
+                return
+            victim = min(candidates, key=lambda entry: entry.last_used)
+            # Never wait for another model's lock here: its loader may be
+            # waiting on ours to evict us
+            if not self.unload(victim.name, reason="budget", wait=False):
+                skipped.add(victim.name)
+
+    def unload_idle(self, now=None):
+        # Unload every model idle past its timeout; returns their names
+        now = time.monotonic() if now is None else now
+        unloaded = []
+        for entry in list(self._entries.values()):
+            if (entry.idle_timeout_s and entry.model is not None and not entry.in_use
+                    and now - entry.last_used >= entry.idle_timeout_s
+                    and self.unload(entry.name, reason="idle", wait=False)):
+                unloaded.append(entry.name)
+        return unloaded
+
+    def _start_reaper(self):
+        # One daemon thread per process, started with the first model that can go idle
+        with self._lock:
+            if self._reaper is not None and self._reaper_pid == os.getpid() and self._reaper.is_alive():
+                return
+            self._reaper = threading.Thread(target=self._reap, name="edd-model-reaper", daemon=True)
+            self._reaper_pid = os.getpid()
+            self._reaper.start()
+
+    def _reap(self):
+        while not self._stop.wait(self.reap_interval_s):
+            try:
+                self.unload_idle()
+            except Exception:
+                logging.getLogger(__name__).exception("idle model eviction failed")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            name: {
+                "loaded": entry.model is not None,
+                "bytes": entry.bytes if entry.model is not None else 0,
+                "last_bytes": entry.bytes,
+                "idle_s": now - entry.last_used if entry.model is not None else None,
+                "idle_timeout_s": entry.idle_timeout_s,
+                "in_use": entry.in_use,
+                "loads": entry.loads,
+                "unloads": entry.unloads,
+                **entry.labels,
+            }
+            for name, entry in self._entries.items()
+        }
+
+    def metrics(self):
+        # Collector for METRICS.register_collector
+        stats = self.stats()
+        yield "model_resident_bytes", "gauge", "Memory held by each loaded model", \
+            [({"kind": name}, s["bytes"]) for name, s in stats.items()]
+        yield "model_loaded", "gauge", "Whether each model is loaded", \
+            [({"kind": name}, int(s["loaded"])) for name, s in stats.items()]
+        yield "model_loads_total", "counter", "Times each model was loaded", \
+            [({"kind": name}, s["loads"]) for name, s in stats.items()]
+        if self.budget_bytes:
+            yield "model_budget_bytes", "gauge", "Memory budget for loaded models", [({}, self.budget_bytes)]
+
+def _free_memory():
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
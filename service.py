@@ -0,0 +1,324 @@
+"""Headless HTTP service for the emotional drift pipeline.
+
+    uvicorn service:app --host 0.0.0.0 --port 8000
+    python service.py --port 8000
+
+Endpoints:
+    POST   /analyze        run_pipeline on a document, result in the response
+    POST   /rewrite        regenerate_text for one passage
+    POST   /jobs           queue a (long) document, returns a job id (202)
+    GET    /jobs/{job_id}  job status, and the result once it is done
+    DELETE /jobs/{job_id}  cancel a job that has not started yet
+    GET    /health         model and queue state
+    GET    /metrics        Prometheus metrics
+
+Model calls run on a bounded thread pool, never on the event loop. At most
+EDD_API_WORKERS + EDD_API_MAX_QUEUE requests and jobs are admitted at once;
+beyond that the service answers 429 with the current queue length. Texts
+longer than EDD_API_MAX_CHARS (EDD_API_MAX_JOB_CHARS for jobs) get a 413.
+
+With EDD_ARC_INDEX set, analyses can be added to an emotional-arc
+similarity index ("index_id") and return the most similar indexed
+documents ("similar": how many).
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+
+import ml_pipeline
+from instrumentation import METRICS, log_event
+from similarity_index import get_arc_index
+from utils import get_nlp
+
+API_WORKERS = int(os.environ.get("EDD_API_WORKERS", 2))
+API_MAX_QUEUE = int(os.environ.get("EDD_API_MAX_QUEUE", 8))
+API_MAX_CHARS = int(os.environ.get("EDD_API_MAX_CHARS", 200_000))
+API_MAX_JOB_CHARS = int(os.environ.get("EDD_API_MAX_JOB_CHARS", 5_000_000))
+# Raw request bodies are refused above this before they are parsed; JSON
+# escaping can make a body a few times longer than its text
+API_MAX_BODY_BYTES = int(os.environ.get("EDD_API_MAX_BODY_BYTES", API_MAX_JOB_CHARS * 4))
+API_MAX_JOBS = int(os.environ.get("EDD_API_MAX_JOBS", 1000))
+API_JOB_TTL_S = float(os.environ.get("EDD_API_JOB_TTL_S", 3600))
+API_PRELOAD_REWRITER = os.environ.get("EDD_API_PRELOAD_REWRITER", "1") != "0"
+
+class AnalyzeRequest(BaseModel):
+    text: str
+    target_emotion: Optional[str] = None
+    max_tokens: int = Field(256, ge=16, le=512)
+    overlap_sentences: int = Field(0, ge=0, le=5)
+    include_chunks: bool = False
+    index_id: Optional[str] = None
+    similar: int = Field(0, ge=0, le=100)
+
+class RewriteRequest(BaseModel):
+    text: str
+    target_emotion: str
+
+class Admission:
+    # Counts admitted work (running or waiting for a worker) against a fixed
+    # limit. Released from worker threads, hence the lock.
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.limit = workers + max_queue
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def queue_length(self):
+        # Admitted work that is not running yet
+        return max(self.in_flight - self.workers, 0)
+
+class JobStore:
+    # Bounded, in-memory. Finished jobs are dropped after ttl seconds, and the
+    # oldest finished ones first when the store is full.
+
+    def __init__(self, max_jobs, ttl):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] is not None and now - job["finished_at"] > self.ttl]:
+            del self._jobs[job_id]
+
+    def create(self):
+        with self._lock:
+            self._expire()
+            if len(self._jobs) >= self.max_jobs:
+                finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+                if not finished:
+                    return None
+                del self._jobs[finished[0]]
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {"id": job_id, "status": "queued", "created_at": time.time(), "started_at": None,
+                                  "finished_at": None, "result": None, "error": None, "future": None}
+            return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+            return None if job is None else {key: value for key, value in job.items() if key != "future"}
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] == "queued" and job["future"] is not None and job["future"].cancel():
+                job.update(status="cancelled", finished_at=time.time())
+            return job["status"]
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+def _too_many_requests(admission):
+    queue_length = admission.queue_length()
+    METRICS.count("api_rejected")
+    return JSONResponse(status_code=429, headers={"Retry-After": "1"},
+                        content={"detail": "Too many requests in flight, retry later",
+                                 "queue_length": queue_length, "in_flight": admission.in_flight})
+
+def _check_size(text, limit):
+    if len(text) > limit:
+        raise HTTPException(status_code=413, detail=f"Text is {len(text)} characters, the limit is {limit}")
+    if not text.strip():
+        raise HTTPException(status_code=422, detail="Text is empty")
+
+def _check_index(request):
+    if (request.index_id or request.similar) and get_arc_index() is None:
+        raise HTTPException(status_code=422, detail="No similarity index configured (set EDD_ARC_INDEX)")
+
+def analyze(request):
+    result, trace = ml_pipeline.run_pipeline(
+        request.text, request.target_emotion, max_tokens=request.max_tokens,
+        overlap_sentences=request.overlap_sentences, return_trace=True)
+    response = result.to_dict(include_chunks=request.include_chunks)
+    index = get_arc_index()
+    if index is not None and result.n_segments:
+        if request.similar:
+            response["similar"] = [{"id": doc_id, "similarity": similarity} for doc_id, similarity in
+                                   index.query(result.scores, k=request.similar, exclude=(request.index_id,))]
+        if request.index_id:
+            index.add(request.index_id, result.scores, {"words": len(request.text.split()),
+                                                        "n_chunks": result.n_segments})
+    response["timings"] = {"wall_s": trace.wall_s, "cpu_s": trace.cpu_s,
+                           "stages": {row["stage"]: row["wall_ms"] / 1000 for row in trace.stage_rows()}}
+    return response
+
+def preload():
+    # Load everything the first request would otherwise wait for
+    start = time.perf_counter()
+    get_nlp()
+    ml_pipeline.get_emotion_classifier()
+    ml_pipeline.classify_emotions(["Warming up the classifier."], use_cache=False)
+    if API_PRELOAD_REWRITER:
+        ml_pipeline.get_regenerator()
+    log_event("service_ready", seconds=time.perf_counter() - start)
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.executor = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="edd-api")
+    app.state.admission = Admission(API_WORKERS, API_MAX_QUEUE)
+    app.state.jobs = JobStore(API_MAX_JOBS, API_JOB_TTL_S)
+    app.state.ready = False
+    await asyncio.get_running_loop().run_in_executor(app.state.executor, preload)
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.executor.shutdown(wait=False, cancel_futures=True)
+
+def _service_metrics(app):
+    admission = getattr(app.state, "admission", None)
+    if admission is None:
+        return
+    yield "api_in_flight", "gauge", "Requests and jobs admitted and not finished", [({}, admission.in_flight)]
+    yield "api_queue_length", "gauge", "Admitted requests and jobs waiting for a worker", \
+        [({}, admission.queue_length())]
+    yield "api_jobs", "gauge", "Jobs in the job store by status", \
+        [({"status": status}, n) for status, n in app.state.jobs.counts().items()]
+    index = get_arc_index()
+    if index is not None:
+        yield "arc_index_documents", "gauge", "Documents in the emotional-arc similarity index", [({}, len(index))]
+
+app = FastAPI(title="Emotional Drift Detector", lifespan=lifespan)
+METRICS.register_collector(lambda: _service_metrics(app))
+
+@app.middleware("http")
+async def limit_body_size(request: Request, call_next):
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > API_MAX_BODY_BYTES:
+        return JSONResponse(status_code=413, content={"detail": f"Request body is over {API_MAX_BODY_BYTES} bytes"})
+    return await call_next(request)
+
+async def _run_admitted(request: Request, fn, *args):
+    admission = request.app.state.admission
+    if not admission.try_acquire():
+        return _too_many_requests(admission)
+    try:
+        future = request.app.state.executor.submit(fn, *args)
+    except BaseException:
+        admission.release()
+        raise
+    # Released when the work itself ends: a client that disconnects cancels
+    # the await below, not the call still running on the executor
+    future.add_done_callback(lambda _: admission.release())
+    return await asyncio.wrap_future(future)
+
+@app.post("/analyze")
+async def analyze_endpoint(body: AnalyzeRequest, request: Request):
+    _check_size(body.text, API_MAX_CHARS)
+    _check_index(body)
+    return await _run_admitted(request, analyze, body)
+
+@app.post("/rewrite")
+async def rewrite_endpoint(body: RewriteRequest, request: Request):
+    _check_size(body.text, API_MAX_CHARS)
+    if body.target_emotion not in ml_pipeline.EMOTION_LABELS:
+        raise HTTPException(status_code=422, detail=f"target_emotion must be one of {ml_pipeline.EMOTION_LABELS}")
+    rewrite = await _run_admitted(request, ml_pipeline.regenerate_text, body.text, body.target_emotion)
+    if isinstance(rewrite, JSONResponse):
+        return rewrite
+    if rewrite is None:
+        raise HTTPException(status_code=500, detail="Rewrite failed")
+    return {"rewrite": rewrite}
+
+@app.post("/jobs", status_code=202)
+async def create_job(body: AnalyzeRequest, request: Request):
+    _check_size(body.text, API_MAX_JOB_CHARS)
+    _check_index(body)
+    state = request.app.state
+    if not state.admission.try_acquire():
+        return _too_many_requests(state.admission)
+    job_id = state.jobs.create()
+    if job_id is None:
+        state.admission.release()
+        return _too_many_requests(state.admission)
+
+    def run_job():
+        state.jobs.update(job_id, status="running", started_at=time.time())
+        try:
+            state.jobs.update(job_id, status="done", result=analyze(body), finished_at=time.time())
+        except Exception as e:
+            log_event("job_failed", job_id=job_id, error=str(e))
+            state.jobs.update(job_id, status="failed", error=str(e), finished_at=time.time())
+
+    future = state.executor.submit(run_job)
+    # Runs whether the job finished, failed or was cancelled before it started
+    future.add_done_callback(lambda _: state.admission.release())
+    state.jobs.update(job_id, future=future)
+    return JSONResponse(status_code=202, headers={"Location": f"/jobs/{job_id}"},
+                        content={"job_id": job_id, "status": "queued", "queue_length": state.admission.queue_length()})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    job = request.app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, request: Request):
+    status = request.app.state.jobs.cancel(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    if status != "cancelled":
+        raise HTTPException(status_code=409, detail=f"Job is already {status}")
+    return {"job_id": job_id, "status": status}
+
+@app.get("/health")
+async def health(request: Request):
+    state = request.app.state
+    return {"status": "ok" if state.ready else "starting", "emotion_model": ml_pipeline.EMOTION_MODEL,
+            "in_flight": state.admission.in_flight, "queue_length": state.admission.queue_length(),
+            "capacity": state.admission.limit, "jobs": state.jobs.counts(), "models": ml_pipeline.MODELS.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(METRICS.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
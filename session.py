@@ -0,0 +1,300 @@
+import ml_pipeline
+from analysis_result import AnalysisResult
+from analytics import as_score_array
+from drift import DriftPath, change_point_path, choose_algorithm, default_penalty
+from instrumentation import current_trace, stage, trace_events
+from ml_pipeline import (
+    analysis_key,
+    build_explanations,
+    classify_emotions,
+    detect_confusion,
+    drifts_from_change_points,
+    get_emotion_classifier,
+    get_result_cache,
+    iter_classify_emotions,
+)
+from utils import chunk_by_tokens, clean_text
+
+def _final_result(events):
+    # Drain an iter_update/iter_refresh generator and return its result
+    for event in events:
+        if event[0] == "result":
+            return event[1]
+
+# What the result memo stores of a session, and a rough per-segment size of it
+# (score list and dict, span, and object headers) for the memo's memory cap
+_SNAPSHOT_FIELDS = ("text", "chunks", "spans", "emotion_vectors", "emotion_dicts", "change_points", "drift_path",
+                    "drifts", "confusions", "explanations", "result")
+_SEGMENT_OVERHEAD_BYTES = 1000
+
+def _common_prefix_len(a, b):
+    # Binary search over slice comparisons, so the scan itself runs in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _common_suffix_len(a, b, limit):
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class AnalysisSession:
+    # Keeps the last analysis of a document so an edited revision only
+    # re-chunks and re-scores the region around the edit, and re-runs drift
+    # detection only between the change points on either side of it.
+    #
+    # update() returns an AnalysisResult like run_pipeline; iter_update() yields
+    # the same events as iter_pipeline. last_update describes what the most recent call reused.
+    #
+    # The drift path (change points for a range of penalties) is kept up to
+    # date the same way, so results_at() can switch drift sensitivity without
+    # any re-fit.
+    #
+    # Finished analyses are also memoized process-wide (get_result_cache), so
+    # going back to a revision, or another session analyzing the same text,
+    # restores it without any work.
+
+    def __init__(self, batch_size=16, max_tokens=256, overlap_sentences=0, segmentation_mode=None,
+                 drift_margin=5, drift_window=100, full_refresh_ratio=0.5):
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.overlap_sentences = overlap_sentences
+        self.segmentation_mode = segmentation_mode
+        # Change points this many segments away from the edit are kept as they are
+        self.drift_margin = drift_margin
+        # ...and the re-fit never reaches further than this from the edit
+        self.drift_window = drift_window
+        # Above this share of the document, incremental work stops paying off
+        self.full_refresh_ratio = full_refresh_ratio
+        self.reset()
+
+    def reset(self):
+        self.text = None  # cleaned text of the last revision
+        self.chunks = []
+        self.spans = []  # (start_char, end_char) of each chunk in self.text
+        self.emotion_vectors = []
+        self.emotion_dicts = []
+        self.change_points = []
+        # Algorithm and penalties are fixed at the last full fit so local re-fits match it
+        self.drift_path = None
+        self.drifts = []
+        self.confusions = []
+        self.explanations = {}
+        self.result = AnalysisResult([], [], [], [], [])
+        self.last_update = {}
+        self.last_trace = None
+
+    def results(self):
+        return self.result
+
+    def results_at(self, path_index):
+        # results() with the drifts of another entry of the drift path
+        if path_index == self.drift_path.default_index:
+            return self.result
+        drifts = self.drift_path.drifts_at(path_index)
+        explanations = build_explanations(drifts, self.confusions, self.emotion_dicts)
+        return AnalysisResult(self.chunks, self.result.scores, drifts, self.confusions, explanations)
+
+    def _chunk(self, text):
+        tokenizer = get_emotion_classifier().tokenizer
+        return chunk_by_tokens(text, tokenizer, max_tokens=self.max_tokens, overlap_sentences=self.overlap_sentences,
+                               segmentation_mode=self.segmentation_mode, return_spans=True)
+
+    def _finish(self):
+        self.drifts = drifts_from_change_points(self.change_points, len(self.chunks))
+        self.explanations = build_explanations(self.drifts, self.confusions, self.emotion_dicts)
+        self.result = AnalysisResult(self.chunks, self.emotion_vectors, self.drifts, self.confusions, self.explanations)
+
+    def refresh(self, text):
+        return _final_result(self.iter_refresh(text))
+
+    def iter_refresh(self, text):
+        # Full re-analysis; unchanged chunks still come out of the score cache
+        yield from self._traced("session_refresh", self._refresh_events(text))
+
+    def _traced(self, name, events):
+        for event in trace_events(name, events):
+            if event[0] == "trace":
+                self.last_trace = event[1]
+            yield event
+
+    def _record_update(self, last_update):
+        self.last_update = last_update
+        trace = current_trace()
+        if trace is not None:
+            trace.attributes.update(last_update)
+
+    def _refresh_events(self, text):
+        text = clean_text(text)
+        chunks, token_ids, spans = self._chunk(text)
+        yield "chunks", chunks
+        emotion_vectors, emotion_dicts = [], []
+        for start, vectors, dicts in iter_classify_emotions(chunks, batch_size=self.batch_size, token_ids=token_ids):
+            emotion_vectors.extend(vectors)
+            emotion_dicts.extend(dicts)
+            yield "scores", start, vectors, dicts
+        self.text, self.chunks, self.spans = text, chunks, spans
+        self.emotion_vectors, self.emotion_dicts = emotion_vectors, emotion_dicts
+        with stage("detect_drift"):
+            self._fit_change_points()
+        self.confusions = detect_confusion(self.emotion_vectors)
+        self._finish()
+        self._record_update({"mode": "full", "reused_chunks": 0, "rescored_chunks": len(chunks), "drift": "full"})
+        yield "drift_path", self.drift_path
+        yield "result", self.results()
+
+    def update(self, text, target_emotion=None):
+        return _final_result(self.iter_update(text, target_emotion))
+
+    def iter_update(self, text, target_emotion=None):
+        yield from self._traced("session_update", self._memo_events(text, target_emotion))
+
+    def result_key(self, text, target_emotion=None):
+        # Memo key of an analysis of text (already cleaned) with these settings
+        return analysis_key(text, target_emotion, max_tokens=self.max_tokens,
+                            overlap_sentences=self.overlap_sentences, segmentation_mode=self.segmentation_mode)
+
+    def _memo_events(self, text, target_emotion):
+        text = clean_text(text)
+        memo = get_result_cache()
+        key = self.result_key(text, target_emotion)
+        if memo is not None and text != self.text:
+            snapshot = memo.get(key)
+            if snapshot is not None:
+                for field in _SNAPSHOT_FIELDS:
+                    setattr(self, field, snapshot[field])
+                self._record_update({"mode": "memo", "reused_chunks": len(self.chunks), "rescored_chunks": 0,
+                                    "drift": "reused"})
+                yield "drift_path", self.drift_path
+                yield "result", self.results()
+                return
+        for event in self._update_events(text):
+            # Before the result is handed out: callers may stop iterating there.
+            # Only full analyses are memoized: an incremental one keeps the
+            # segment boundaries of the edits that led to it, which a fresh
+            # analysis of the same text would not reproduce.
+            if event[0] == "result" and memo is not None and self.last_update["mode"] == "full":
+                snapshot = {field: getattr(self, field) for field in _SNAPSHOT_FIELDS}
+                nbytes = len(self.text) + sum(len(chunk) for chunk in self.chunks) \
+                    + _SEGMENT_OVERHEAD_BYTES * len(self.chunks)
+                memo.put(key, snapshot, nbytes)
+            yield event
+
+    def _update_events(self, text):
+        if self.text is None or not self.chunks:
+            yield from self._refresh_events(text)
+            return
+        if text == self.text:
+            self._record_update({"mode": "unchanged", "reused_chunks": len(self.chunks), "rescored_chunks": 0,
+                                "drift": "reused"})
+            yield "drift_path", self.drift_path
+            yield "result", self.results()
+            return
+
+        old = self.text
+        n_old = len(self.chunks)
+        prefix = _common_prefix_len(old, text)
+        suffix = _common_suffix_len(old, text, min(len(old), len(text)) - prefix)
+        delta = len(text) - len(old)
+
+        # Old chunks entirely inside the unchanged head and tail are kept. The
+        # chunk right next to the edit on each side is redone as well, since its
+        # sentence boundary or token packing may depend on the edited text.
+        head = 0
+        while head < n_old and self.spans[head][1] <= prefix:
+            head += 1
+        head = max(head - 1, 0)
+        tail = n_old
+        while tail > head and self.spans[tail - 1][0] >= len(old) - suffix:
+            tail -= 1
+        tail = min(tail + 1, n_old)
+
+        if (tail - head) > self.full_refresh_ratio * n_old:
+            yield from self._refresh_events(text)
+            return
+
+        region_start = self.spans[head][0] if head < n_old else len(old)
+        region_end = (self.spans[tail][0] if tail < n_old else len(old)) + delta
+        region = text[region_start:region_end]
+        region_start += len(region) - len(region.lstrip())
+        if region.strip():
+            new_chunks, new_ids, new_spans = self._chunk(region)
+        else:
+            new_chunks, new_ids, new_spans = [], [], []
+        new_spans = [(start + region_start, end + region_start) for start, end in new_spans]
+        new_vectors, new_dicts = classify_emotions(new_chunks, batch_size=self.batch_size, token_ids=new_ids)
+
+        # Splice the re-scored region between the kept head and tail
+        shift = head + len(new_chunks) - tail
+        self.chunks = self.chunks[:head] + new_chunks + self.chunks[tail:]
+        self.spans = self.spans[:head] + new_spans + [(start + delta, end + delta) for start, end in self.spans[tail:]]
+        self.emotion_vectors = self.emotion_vectors[:head] + new_vectors + self.emotion_vectors[tail:]
+        self.emotion_dicts = self.emotion_dicts[:head] + new_dicts + self.emotion_dicts[tail:]
+        self.confusions = ([idx for idx in self.confusions if idx < head]
+                           + [head + idx for idx in detect_confusion(new_vectors)]
+                           + [idx + shift for idx in self.confusions if idx >= tail])
+        self.text = text
+        with stage("detect_drift"):
+            drift_mode = self._update_change_points(head, head + len(new_chunks), tail, shift)
+        self._finish()
+        self._record_update({"mode": "incremental", "reused_chunks": len(self.chunks) - len(new_chunks),
+                            "rescored_chunks": len(new_chunks), "drift": drift_mode})
+        yield "drift_path", self.drift_path
+        yield "result", self.results()
+
+    def _fit_change_points(self):
+        # Choose the algorithm and penalty grid for the whole document, so
+        # windows re-fitted later use the same ones rather than their own
+        scores = as_score_array(self.emotion_vectors)
+        algorithm = ml_pipeline.DRIFT_ALGORITHM
+        if algorithm == "auto":
+            algorithm = choose_algorithm(len(scores))
+        pen = default_penalty(scores, algorithm) if len(scores) >= 2 else None
+        self.drift_path = change_point_path(scores, algorithm=algorithm, pen=pen)
+        self.change_points = self.drift_path.default_change_points
+
+    def _update_change_points(self, start, end, old_end, shift):
+        # Re-fit only the window around the edited segments [start, end): from
+        # the nearest old change point on each side, but no further than
+        # drift_window segments. One window covers every penalty of the path,
+        # so the re-fit shares its costs too. Change points outside the window
+        # are kept. Falls back to a full fit when the window is most of the
+        # document anyway.
+        n = len(self.emotion_vectors)
+        path = self.drift_path
+        if path is None or len(path) < 2:
+            self._fit_change_points()
+            return "full"
+        lo, hi = n, 0
+        for change_points in path.change_points:
+            inner = change_points[:-1]
+            lo = min(lo, max([cp for cp in inner if cp <= start - self.drift_margin]
+                             + [start - self.drift_window, 0]))
+            hi = max(hi, min([cp + shift for cp in inner if cp >= old_end + self.drift_margin]
+                             + [end + self.drift_window, n]))
+        if hi - lo > self.full_refresh_ratio * n:
+            self._fit_change_points()
+            return "full"
+        local = change_point_path(as_score_array(self.emotion_vectors[lo:hi]), algorithm=path.algorithm,
+                                  pen=path.penalties[path.default_index], penalties=path.penalties)
+        # A window too short to split comes back as a single entry
+        local_change_points = local.change_points if len(local) == len(path) else [[hi - lo]] * len(path)
+        updated = []
+        for change_points, local_points in zip(path.change_points, local_change_points):
+            inner = change_points[:-1]
+            before = [cp for cp in inner if cp <= lo]
+            after = [cp + shift for cp in inner if cp + shift >= hi and cp >= old_end]
+            updated.append(before + [lo + cp for cp in local_points[:-1]] + after + [n])
+        self.drift_path = DriftPath(path.penalties, updated, path.default_index, path.algorithm)
+        self.change_points = self.drift_path.default_change_points
+        return "local"
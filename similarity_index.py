@@ -0,0 +1,392 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from analytics import EMOTION_LABELS, as_score_array
+
+# Emotional-arc signatures and an index of them for "which documents have an
+# arc like this one" queries. A signature is one L2-normalized float32 vector:
+#   - the N x 7 curve resampled to SIGNATURE_POINTS points, minus its mean
+#     (the shape of the arc), scaled by 1/sqrt(points) so it weighs about as
+#     much as one of the per-label blocks below
+#   - the mean, standard deviation and mean step size of each label
+# so the dot product of two signatures is their cosine similarity.
+
+SIGNATURE_POINTS = int(os.environ.get("EDD_SIGNATURE_POINTS", 32))
+# Bump when arc_signature changes; an index refuses signatures of another version
+SIGNATURE_VERSION = 1
+# Below this many documents an exact scan is as fast as ANN (both ~1.5 ms a
+# query at 20k), so ANN only kicks in above it; at 50k it is ~1.4x faster
+ANN_MIN_ITEMS = int(os.environ.get("EDD_ARC_ANN_MIN_ITEMS", 20_000))
+# Clusters an ANN query looks in; 32 of ~sqrt(N) finds ~97% of the exact top 10
+ANN_NPROBE = int(os.environ.get("EDD_ARC_ANN_NPROBE", 32))
+# Rows scored per matrix product, to bound the temporary similarity matrix
+_BLOCK_ROWS = 1 << 16
+
+def signature_size(points=SIGNATURE_POINTS):
+    return (points + 3) * len(EMOTION_LABELS)
+
+def resample_curve(scores, points=SIGNATURE_POINTS):
+    # points x 7: bin means when the curve is longer, linear interpolation when shorter
+    scores = as_score_array(scores).astype(np.float64)
+    n = len(scores)
+    if n == 0:
+        raise ValueError("Cannot build an arc signature from an empty analysis")
+    if n >= points:
+        edges = np.linspace(0, n, points + 1).astype(np.int64)
+        sums = np.add.reduceat(scores, edges[:-1], axis=0)
+        return sums / np.diff(edges)[:, None]
+    positions = np.clip((np.arange(points) + 0.5) * n / points - 0.5, 0, n - 1)
+    lo = np.floor(positions).astype(np.int64)
+    hi = np.minimum(lo + 1, n - 1)
+    weight = (positions - lo)[:, None]
+    return scores[lo] * (1 - weight) + scores[hi] * weight
+
+def arc_signature(emotion_vectors, points=SIGNATURE_POINTS):
+    scores = as_score_array(emotion_vectors).astype(np.float64)
+    curve = resample_curve(scores, points)
+    mean = scores.mean(axis=0)
+    std = scores.std(axis=0)
+    steps = np.abs(np.diff(scores, axis=0)).mean(axis=0) if len(scores) > 1 else np.zeros(len(EMOTION_LABELS))
+    signature = np.concatenate((((curve - mean) / np.sqrt(points)).ravel(), mean, std, steps))
+    norm = np.linalg.norm(signature)
+    return (signature / norm if norm else signature).astype(np.float32)
+
+def cosine_similarities(a, b):
+    # len(a) x len(b) cosine similarities of the rows of a and b; zero rows score 0
+    a = np.atleast_2d(np.asarray(a, dtype=np.float32))
+    b = np.atleast_2d(np.asarray(b, dtype=np.float32))
+    a_norm = np.linalg.norm(a, axis=1, keepdims=True)
+    b_norm = np.linalg.norm(b, axis=1, keepdims=True)
+    return (a / np.where(a_norm, a_norm, 1)) @ (b / np.where(b_norm, b_norm, 1)).T
+
+def _top_k(similarities, k):
+    # Indices of the k largest values of each row, best first
+    k = min(k, similarities.shape[1])
+    if k == 0:
+        return np.zeros((len(similarities), 0), dtype=np.int64)
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+def _spherical_kmeans(data, n_clusters, iterations=10, seed=0):
+    # Centroids (unit length) of unit-length rows, by cosine similarity
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _assign(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their old centroid
+        centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+    return centroids.astype(np.float32)
+
+def _assign(rows, centroids):
+    return np.concatenate([(rows[i:i + _BLOCK_ROWS] @ centroids.T).argmax(axis=1)
+                           for i in range(0, len(rows), _BLOCK_ROWS)] or [np.zeros(0, dtype=np.int64)])
+
+class ArcIndex:
+    # Arc signatures of a document library, held as one float32 matrix and
+    # persisted to SQLite (path=None keeps it in memory only). Every add is
+    # written through, so the index grows with each finished analysis and is
+    # read back whole on open.
+    #
+    # Queries are an exact blocked matrix product below ann_min_items
+    # documents; above it they are approximate: signatures are clustered
+    # (spherical k-means, about sqrt(N) clusters), a query scores only the
+    # documents in its nprobe nearest clusters, and new documents join their
+    # nearest cluster. Clusters are retrained once the index doubles in size.
+    # ANN queries keep a cluster-ordered copy of the signatures. Changes do
+    # not rebuild it: a changed or removed row's copy is marked dead, and new
+    # or changed rows are scored directly by every query until enough have
+    # piled up (1/16 of the index) to make a rebuild worth it.
+
+    def __init__(self, path=None, points=SIGNATURE_POINTS, ann_min_items=ANN_MIN_ITEMS, nprobe=ANN_NPROBE):
+        self.path = path
+        self.points = points
+        self.ann_min_items = ann_min_items
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._conn = None
+        self._conn_pid = None
+        self._ids = []
+        self._rows = {}
+        self._metadata = []
+        self._signatures = np.zeros((0, signature_size(points)), dtype=np.float32)
+        self._size = 0
+        self._centroids = None
+        self._assignment = np.zeros(0, dtype=np.int32)
+        # Cluster-ordered copy (order, offsets, signatures, row -> position,
+        # alive), rows missing from it, and how many of its entries are dead
+        self._lists = None
+        self._pending = set()
+        self._dead = 0
+        self._trained_size = 0
+        self.queries = 0
+        self.ann_queries = 0
+        self._load()
+
+    def _connection(self):
+        # Opened lazily, and again after a fork, like TieredCache
+        if self.path is None:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS arcs "
+                         "(doc_id TEXT PRIMARY KEY, signature BLOB, metadata TEXT, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _load(self):
+        conn = self._connection()
+        if conn is None:
+            return
+        expected = {"signature_version": str(SIGNATURE_VERSION), "points": str(self.points),
+                    "labels": json.dumps(EMOTION_LABELS)}
+        stored = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        for key, value in expected.items():
+            if key in stored and stored[key] != value:
+                raise ValueError(f"Arc index {self.path} has {key}={stored[key]}, expected {value}")
+        conn.executemany("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", expected.items())
+        conn.commit()
+        rows = conn.execute("SELECT doc_id, signature, metadata FROM arcs ORDER BY rowid").fetchall()
+        self._reserve(len(rows))
+        for doc_id, blob, metadata in rows:
+            self._set(doc_id, np.frombuffer(blob, dtype=np.float32), json.loads(metadata) if metadata else None)
+
+    def _reserve(self, n):
+        if n > len(self._signatures):
+            grown = np.zeros((max(n, 2 * len(self._signatures), 1024), self._signatures.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._signatures[:self._size]
+            self._signatures = grown
+
+    def _set(self, doc_id, signature, metadata):
+        row = self._rows.get(doc_id)
+        if row is None:
+            row = self._size
+            self._reserve(row + 1)
+            self._rows[doc_id] = row
+            self._ids.append(doc_id)
+            self._metadata.append(metadata)
+            self._size += 1
+        else:
+            self._metadata[row] = metadata
+            self._unlist(row)
+        self._signatures[row] = signature
+        if self._lists is not None:
+            self._pending.add(row)
+        if self._centroids is not None:
+            if self._size > 2 * self._trained_size:
+                self._centroids = None
+            else:
+                cluster = int((self._centroids @ signature).argmax())
+                if row == len(self._assignment):
+                    self._assignment = np.append(self._assignment, np.int32(cluster))
+                else:
+                    self._assignment[row] = cluster
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, doc_id):
+        return doc_id in self._rows
+
+    def add(self, doc_id, emotion_vectors, metadata=None):
+        self.add_many([(doc_id, emotion_vectors, metadata)])
+
+    def add_many(self, items):
+        # items: (doc_id, emotion_vectors, metadata) triples; re-adding an id replaces it
+        items = [(str(doc_id), arc_signature(vectors, self.points), metadata) for doc_id, vectors, metadata in items]
+        if not items:
+            return
+        with self._lock:
+            for doc_id, signature, metadata in items:
+                self._set(doc_id, signature, metadata)
+            conn = self._connection()
+            if conn is not None:
+                now = time.time()
+                conn.executemany("INSERT OR REPLACE INTO arcs (doc_id, signature, metadata, updated) "
+                                 "VALUES (?, ?, ?, ?)",
+                                 [(doc_id, signature.tobytes(), json.dumps(metadata) if metadata is not None else None,
+                                   now) for doc_id, signature, metadata in items])
+                conn.commit()
+
+    def remove(self, doc_id):
+        with self._lock:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                return False
+            # Move the last row into the gap
+            last = self._size - 1
+            if row != last:
+                moved = self._ids[last]
+                self._ids[row], self._metadata[row] = moved, self._metadata[last]
+                self._signatures[row] = self._signatures[last]
+                self._rows[moved] = row
+                if self._centroids is not None:
+                    self._assignment[row] = self._assignment[last]
+            self._ids.pop()
+            self._metadata.pop()
+            self._size = last
+            self._unlist(row)
+            if row != last:
+                self._unlist(last)
+                if self._lists is not None:
+                    self._pending.add(row)
+            if self._centroids is not None:
+                self._assignment = self._assignment[:last]
+            conn = self._connection()
+            if conn is not None:
+                conn.execute("DELETE FROM arcs WHERE doc_id = ?", (doc_id,))
+                conn.commit()
+            return True
+
+    def signature(self, doc_id):
+        with self._lock:
+            return self._signatures[self._rows[doc_id]].copy()
+
+    def metadata(self, doc_id):
+        with self._lock:
+            return self._metadata[self._rows[doc_id]]
+
+    def _train(self):
+        n = self._size
+        n_clusters = int(np.clip(np.sqrt(n), 1, 4096))
+        signatures = self._signatures[:n]
+        # k-means on a sample; every document is then assigned to its nearest centroid
+        sample_size = min(n, 64 * n_clusters)
+        sample = signatures[np.random.default_rng(0).choice(n, sample_size, replace=False)]
+        self._centroids = _spherical_kmeans(sample, n_clusters)
+        self._assignment = _assign(signatures, self._centroids).astype(np.int32)
+        self._lists = None
+        self._pending = set()
+        self._dead = 0
+        self._trained_size = n
+
+    def query_signatures(self, signatures, k=10, exact=None, exclude=()):
+        # [(doc_id, similarity), ...] best first, for each row of signatures.
+        # exact=None picks ANN from the index size.
+        queries = np.atleast_2d(np.asarray(signatures, dtype=np.float32))
+        exclude = set(exclude or ())
+        with self._lock:
+            n = self._size
+            self.queries += len(queries)
+            if n == 0:
+                return [[] for _ in queries]
+            # Ask for extra hits so excluded ids can be dropped afterwards
+            want = k + len(exclude)
+            if exact is None:
+                exact = n < self.ann_min_items
+            if exact:
+                rows_per_query = self._exact(queries, want)
+            else:
+                self.ann_queries += len(queries)
+                if self._centroids is None:
+                    self._train()
+                rows_per_query = [self._approximate(query, want) for query in queries]
+            results = []
+            for rows, sims in rows_per_query:
+                hits = [(self._ids[row], float(sim)) for row, sim in zip(rows.tolist(), sims.tolist())
+                        if self._ids[row] not in exclude]
+                results.append(hits[:k])
+            return results
+
+    def _exact(self, queries, k):
+        # Running top-k over blocks of the library
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_sims = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, self._size, _BLOCK_ROWS):
+            end = min(start + _BLOCK_ROWS, self._size)
+            sims = np.hstack((best_sims, queries @ self._signatures[start:end].T))
+            rows = np.hstack((best_rows, np.broadcast_to(np.arange(start, end), (len(queries), end - start))))
+            top = _top_k(sims, k)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+            best_sims = np.take_along_axis(sims, top, axis=1)
+        return list(zip(best_rows, best_sims))
+
+    def _unlist(self, row):
+        # Row no longer holds what the cluster-ordered copy has for it
+        self._pending.discard(row)
+        if self._lists is None:
+            return
+        position, alive = self._lists[3], self._lists[4]
+        if row < len(position) and alive[position[row]]:
+            alive[position[row]] = False
+            self._dead += 1
+
+    def _build_lists(self):
+        order = np.argsort(self._assignment, kind="stable")
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        self._lists = (order, np.searchsorted(self._assignment[order], np.arange(len(self._centroids) + 1)),
+                       self._signatures[order], position, np.ones(len(order), dtype=bool))
+        self._pending = set()
+        self._dead = 0
+
+    def _approximate(self, query, k):
+        if self._lists is None or len(self._pending) + self._dead > max(1024, self._size // 16):
+            self._build_lists()
+        order, offsets, packed, _, alive = self._lists
+        clusters = _top_k((self._centroids @ query)[None, :], self.nprobe)[0].tolist()
+        # Each probed cluster is one contiguous slice of the copy
+        slices = [slice(offsets[c], offsets[c + 1]) for c in clusters]
+        rows = np.concatenate([order[part] for part in slices])
+        sims = np.concatenate([packed[part] @ query for part in slices])
+        if self._dead:
+            live = np.concatenate([alive[part] for part in slices])
+            rows, sims = rows[live], sims[live]
+        if self._pending:
+            pending = np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))
+            rows = np.concatenate([rows, pending])
+            sims = np.concatenate([sims, self._signatures[pending] @ query])
+        top = _top_k(sims[None, :], k)[0]
+        return rows[top], sims[top]
+
+    def query(self, emotion_vectors, k=10, exact=None, exclude=()):
+        return self.query_signatures(arc_signature(emotion_vectors, self.points), k, exact, exclude)[0]
+
+    def query_many(self, emotion_vector_lists, k=10, exact=None):
+        signatures = np.vstack([arc_signature(vectors, self.points) for vectors in emotion_vector_lists])
+        return self.query_signatures(signatures, k, exact)
+
+    def similar_to(self, doc_id, k=10, exact=None):
+        # Documents with an arc like an indexed one, not counting itself
+        return self.query_signatures(self.signature(doc_id), k, exact, exclude=(doc_id,))[0]
+
+    def similarity_matrix(self, doc_ids):
+        # Pairwise similarities of indexed documents
+        with self._lock:
+            signatures = self._signatures[[self._rows[doc_id] for doc_id in doc_ids]]
+        return signatures @ signatures.T
+
+    def stats(self):
+        return {
+            "documents": self._size,
+            "clusters": 0 if self._centroids is None else len(self._centroids),
+            "queries": self.queries,
+            "ann_queries": self.ann_queries,
+        }
+
+_arc_index = None
+_arc_index_lock = threading.Lock()
+
+def get_arc_index():
+    # Process-wide index at EDD_ARC_INDEX (a SQLite path); None when unset
+    global _arc_index
+    path = os.environ.get("EDD_ARC_INDEX")
+    if not path:
+        return None
+    with _arc_index_lock:
+        if _arc_index is None:
+            _arc_index = ArcIndex(path)
+    return _arc_index
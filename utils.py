@@ -1,28 +1,235 @@
-import spacy
 import re
-from sklearn.metrics.pairwise import cosine_similarity
+import os
+import threading
 import numpy as np
+from instrumentation import count, instrumented, stage
 
-nlp = spacy.load("en_core_web_sm")  # For chunking
+# Sentence segmentation modes:
+#   "sentencizer" - spaCy's rule-based splitter, no trained pipeline needed
+#   "parser"      - en_core_web_sm's dependency parser with every other component disabled
+SEGMENTATION_MODES = ("sentencizer", "parser")
+DEFAULT_SEGMENTATION_MODE = os.environ.get("EDD_SEGMENTATION_MODE", "sentencizer")
 
-def preprocess_and_chunk(text, chunk_size=200):
+# Loaded on first use, one pipeline per mode
+_nlp_by_mode = {}
+_nlp_lock = threading.Lock()
+
+def get_nlp(mode=None):
+    mode = mode or DEFAULT_SEGMENTATION_MODE
+    if mode not in SEGMENTATION_MODES:
+        raise ValueError(f"Unknown segmentation mode {mode!r}, expected one of {SEGMENTATION_MODES}")
+    if mode not in _nlp_by_mode:
+        with _nlp_lock:
+            if mode not in _nlp_by_mode:
+                # Imported on first use so importing utils stays cheap
+                import spacy
+                if mode == "sentencizer":
+                    nlp = spacy.blank("en")
+                    nlp.add_pipe("sentencizer")
+                    # The sentencizer keeps no per-token model state, so long texts are cheap
+                    nlp.max_length = 100_000_000
+                else:
+                    # The parser only needs tok2vec; tagging, lemmas and NER are wasted work
+                    nlp = spacy.load("en_core_web_sm", exclude=["tagger", "attribute_ruler", "lemmatizer", "ner"])
+                _nlp_by_mode[mode] = nlp
+    return _nlp_by_mode[mode]
+
+def clean_text(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+def split_sentences(text, mode=None):
+    return [sent.text for sent in get_nlp(mode)(text).sents]
+
+def split_sentence_spans(text, mode=None):
+    # (start_char, end_char) of every sentence, without trailing whitespace
+    return [(sent.start_char, sent.end_char) for sent in get_nlp(mode)(text).sents]
+
+def split_sentences_batch(texts, mode=None, n_process=1, batch_size=64):
+    # nlp.pipe streams the documents through the pipeline in batches and can
+    # fan out to several worker processes
+    nlp = get_nlp(mode)
+    return [[sent.text for sent in doc.sents] for doc in nlp.pipe(texts, n_process=n_process, batch_size=batch_size)]
+
+@instrumented("preprocess_and_chunk")
+def preprocess_and_chunk(text, chunk_size=200, segmentation_mode=None):
     # Clean text
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = clean_text(text)
     # Split into paragraphs or fixed windows
-    doc = nlp(text)
     chunks = []
-    current_chunk = ""
-    for sent in doc.sents:
-        current_chunk += sent.text + " "
-        if len(current_chunk.split()) > chunk_size:
-            chunks.append(current_chunk.strip())
-            current_chunk = ""
+    current_chunk = []
+    current_words = 0
+    for sent in split_sentences(text, segmentation_mode):
+        current_chunk.append(sent)
+        # Keep a running word count instead of re-splitting the growing chunk
+        current_words += len(sent.split())
+        if current_words > chunk_size:
+            chunks.append(" ".join(current_chunk).strip())
+            current_chunk = []
+            current_words = 0
     if current_chunk:
-        chunks.append(current_chunk.strip())
+        chunks.append(" ".join(current_chunk).strip())
     return chunks
 
+def _with_special_tokens(tokenizer, ids):
+    # <s> ... </s> for RoBERTa-style classifiers
+    return [tokenizer.cls_token_id] + ids + [tokenizer.sep_token_id]
+
+def _space_sensitive(tokenizer):
+    # Byte-level BPE tokenizers (GPT-2, RoBERTa) give a word other ids with a
+    # space in front of it; WordPiece ones (BERT) give it the same
+    bare, spaced = tokenizer(["Hello", " Hello"], add_special_tokens=False)["input_ids"]
+    return bare != spaced
+
+def _bare_ids(tokenizer, sentence):
+    # Ids of a sentence with nothing in front of it, as it is at the start of a chunk
+    return tokenizer(sentence, add_special_tokens=False)["input_ids"]
+
+def _split_long_sentence(sentence, tokenizer, budget):
+    # A single sentence longer than the budget is cut into budget-sized pieces
+    # along token boundaries, using the offsets to recover each piece's text.
+    # Each piece is tokenized again on its own, since a word cut in two or the
+    # space dropped in front of it changes its ids, and is made shorter if that
+    # takes it over the budget.
+    encoded = tokenizer(sentence, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = encoded["offset_mapping"]
+    pieces = []
+    k = 0
+    while k < len(offsets):
+        take = min(budget, len(offsets) - k)
+        while True:
+            start, end = offsets[k][0], offsets[k + take - 1][1]
+            raw = sentence[start:end]
+            start += len(raw) - len(raw.lstrip())
+            end -= len(raw) - len(raw.rstrip())
+            piece_ids = _bare_ids(tokenizer, sentence[start:end])
+            if len(piece_ids) <= budget or take == 1:
+                break
+            take -= 1
+        if start < end:
+            pieces.append((sentence[start:end], piece_ids, start, end))
+        k += take
+    return pieces
+
+@instrumented("chunk_by_tokens")
+def chunk_by_tokens(text, tokenizer, max_tokens=256, overlap_sentences=0, segmentation_mode=None, return_spans=False):
+    # Clean text
+    text = clean_text(text)
+    with stage("segment_sentences"):
+        sentence_spans = split_sentence_spans(text, segmentation_mode)
+    sentences = [text[start:end] for start, end in sentence_spans]
+    if not sentences:
+        return ([], [], []) if return_spans else ([], [])
+    
+    # Never go past what the model can take once special tokens are added
+    budget = min(max_tokens, tokenizer.model_max_length - tokenizer.num_special_tokens_to_add())
+    # Tokenize every sentence in one batched call. The leading space matches how
+    # a byte-level BPE tokenizer sees the sentence inside the joined chunk text;
+    # the one opening a chunk has no space in front of it and is tokenized
+    # again without it, so the chunk ids are exactly those of the chunk text.
+    with stage("tokenize"):
+        sentence_ids = tokenizer([" " + s for s in sentences], add_special_tokens=False)["input_ids"]
+        space_sensitive = _space_sensitive(tokenizer)
+    
+    chunks = []
+    chunk_ids = []
+    chunk_spans = []  # (start_char, end_char) of each chunk in the cleaned text
+    current = []  # (sentence text, token ids, start_char, end_char) of the open chunk
+    current_tokens = 0
+    
+    def close_chunk():
+        chunks.append(" ".join(sent for sent, _, _, _ in current))
+        ids = [i for _, sent_ids, _, _ in current for i in sent_ids]
+        chunk_ids.append(_with_special_tokens(tokenizer, ids))
+        chunk_spans.append((current[0][2], current[-1][3]))
+    
+    def opening(entry):
+        sentence, ids, start, end = entry
+        return (sentence, _bare_ids(tokenizer, sentence) if space_sensitive else ids, start, end)
+    
+    for sentence, ids, (sent_start, sent_end) in zip(sentences, sentence_ids, sentence_spans):
+        entry = (sentence, ids, sent_start, sent_end)
+        if current and current_tokens + len(ids) > budget:
+            close_chunk()
+            # Carry the last few sentences over as context, as long as they
+            # still leave room for the sentence that did not fit
+            current = current[-overlap_sentences:] if overlap_sentences > 0 and len(ids) <= budget else []
+            while current:
+                current[0] = opening(current[0])
+                current_tokens = sum(len(sent_ids) for _, sent_ids, _, _ in current)
+                if current_tokens + len(ids) <= budget:
+                    break
+                current.pop(0)
+        
+        if not current:
+            entry = opening(entry)
+            if len(entry[1]) > budget:
+                for piece, piece_ids, start, end in _split_long_sentence(sentence, tokenizer, budget):
+                    chunks.append(piece)
+                    chunk_ids.append(_with_special_tokens(tokenizer, piece_ids))
+                    chunk_spans.append((sent_start + start, sent_start + end))
+                continue
+            current_tokens = 0
+        
+        current.append(entry)
+        current_tokens += len(entry[1])
+    
+    if current:
+        close_chunk()
+    count("sentences", len(sentences))
+    count("chunks", len(chunks))
+    count("tokens", sum(len(ids) for ids in chunk_ids))
+    if return_spans:
+        return chunks, chunk_ids, chunk_spans
+    return chunks, chunk_ids
+
+def paragraph_starts(text):
+    # Character offset in clean_text(text) where each blank-line separated
+    # paragraph starts; cleaning joins paragraphs with a single space
+    starts, position = [], 0
+    for paragraph in re.split(r'\n\s*\n', text):
+        cleaned = clean_text(paragraph)
+        if cleaned:
+            starts.append(position)
+            position += len(cleaned) + 1
+    return np.asarray(starts or [0], dtype=np.int64)
+
+@instrumented("sentence_units")
+def sentence_units(text, tokenizer, max_tokens=256, segmentation_mode=None):
+    # Every sentence as its own model input, split like chunk_by_tokens when
+    # it is over the token budget. Returns (sentences, token ids with special
+    # tokens, (start_char, end_char) spans in the cleaned text).
+    text = clean_text(text)
+    with stage("segment_sentences"):
+        sentence_spans = split_sentence_spans(text, segmentation_mode)
+    sentences = [text[start:end] for start, end in sentence_spans]
+    if not sentences:
+        return [], [], []
+    budget = min(max_tokens, tokenizer.model_max_length - tokenizer.num_special_tokens_to_add())
+    with stage("tokenize"):
+        sentence_ids = tokenizer(sentences, add_special_tokens=False)["input_ids"]
+    
+    units, unit_ids, unit_spans = [], [], []
+    for sentence, ids, (sent_start, sent_end) in zip(sentences, sentence_ids, sentence_spans):
+        if len(ids) > budget:
+            for piece, piece_ids, start, end in _split_long_sentence(sentence, tokenizer, budget):
+                units.append(piece)
+                unit_ids.append(_with_special_tokens(tokenizer, piece_ids))
+                unit_spans.append((sent_start + start, sent_start + end))
+        else:
+            units.append(sentence)
+            unit_ids.append(_with_special_tokens(tokenizer, ids))
+            unit_spans.append((sent_start, sent_end))
+    count("sentences", len(sentences))
+    count("tokens", sum(len(ids) for ids in unit_ids))
+    return units, unit_ids, unit_spans
+
 def compute_similarity(vec1, vec2):
-    return cosine_similarity([vec1], [vec2])[0][0]
+    # Cosine similarity of two vectors, 0 if either is all zeros. For many
+    # vectors at once use similarity_index.cosine_similarities
+    vec1 = np.asarray(vec1, dtype=np.float64).ravel()
+    vec2 = np.asarray(vec2, dtype=np.float64).ravel()
+    norm = np.linalg.norm(vec1) * np.linalg.norm(vec2)
+    return float(vec1 @ vec2 / norm) if norm else 0.0
 
 def generate_explanation(flag_type, chunk_idx, emotions_before, emotions_after, contradiction_details=None):
     if flag_type == "drift":
@@ -0,0 +1,42 @@
+import threading
+import time
+
+from instrumentation import log_event
+
+# Background warm-up of everything the analyzer needs: the model libraries,
+# the emotion classifier and the sentence segmenter. Started once per
+# process; the first analysis waits for whatever is still loading.
+
+_thread = None
+_lock = threading.Lock()
+_done = threading.Event()
+_error = None
+
+def _warm_up():
+    global _error
+    start = time.perf_counter()
+    try:
+        import ml_pipeline
+        from utils import get_nlp
+        get_nlp()
+        ml_pipeline.get_emotion_classifier()
+        # One tiny batch so the first real request skips lazy framework setup too
+        ml_pipeline.classify_emotions(["Warming up."], use_cache=False)
+        log_event("warmup_done", seconds=time.perf_counter() - start)
+    except Exception as e:
+        # The analysis will load (and report) the same thing again when it runs
+        _error = e
+        log_event("warmup_failed", error=str(e))
+    finally:
+        _done.set()
+
+def start_warmup():
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_warm_up, name="edd-warmup", daemon=True)
+            _thread.start()
+    return _thread
+
+def is_ready():
+    return _done.is_set() and _error is None